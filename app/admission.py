@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import time
+from collections import OrderedDict
+
+from . import metrics
+
+# === Контроль допуска и сброс нагрузки ===
+#
+# Перед пулом БД стоит ограничение одновременных запросов воркера и короткая
+# очередь ожидания. Очередь с приоритетами: освободившийся слот получает самый
+# важный ожидающий запрос. У каждого класса свой предел длины очереди — при
+# всплеске первыми получают быстрый 503 с Retry-After дешёвые чтения биржи,
+# последними — операции с деньгами. Лучше быстро отказать, чем держать запрос,
+# пока uvicorn или клиент не оборвут его по таймауту.
+#
+# Отдельно — лимит запросов на игрока (token bucket по vk_id) в verify_auth.
+
+CRITICAL, NORMAL, LOW = 0, 1, 2
+PRIORITY_NAMES = {CRITICAL: "critical", NORMAL: "normal", LOW: "low"}
+
+# Доля очереди, которую может занять класс
+QUEUE_SHARE = {CRITICAL: 1.0, NORMAL: 0.75, LOW: 0.5}
+
+# POST-запросы, двигающие золото и предметы
+CRITICAL_PREFIXES = (
+    "/api/market/buy",
+    "/api/market/orders",
+    "/api/market/sell",
+    "/api/player/spend-",
+    "/api/player/add-",
+    "/api/player/buy-skin",
+)
+# Долгие потоки и служебные маршруты — без ограничения
+EXEMPT_PATHS = frozenset(("/metrics", "/api/market/stream"))
+
+RETRY_AFTER_SECONDS = 1
+
+
+def classify(method: str, path: str) -> int:
+    if method == "POST" and path.startswith(CRITICAL_PREFIXES):
+        return CRITICAL
+    if method in ("GET", "HEAD") and path.startswith("/api/market"):
+        return LOW
+    return NORMAL
+
+
+class Shed(Exception):
+    """Запрос не допущен: reason — queue_full / timeout"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """Слоты выполнения и очередь с приоритетами. Используется из event loop"""
+
+    def __init__(self, max_inflight: int, max_queue: int, max_wait: float):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.queue_limits = {cls: int(max_queue * share) for cls, share in QUEUE_SHARE.items()}
+        self.inflight = 0
+        self.queued = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int) -> float:
+        """Занять слот. Возвращает время ожидания в очереди, Shed — запрос сброшен"""
+        if self.inflight < self.max_inflight and not self.queued:
+            self.inflight += 1
+            return 0.0
+        if self.queued >= self.queue_limits[priority]:
+            raise Shed("queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self.queued += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            raise Shed("timeout")
+        except asyncio.CancelledError:
+            # Клиент ушёл в момент, когда слот уже передали, — возвращаем его следующему
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self.queued -= 1
+        return time.perf_counter() - started
+
+    def release(self):
+        # Слот переходит к самому важному ожидающему, не освобождаясь
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.inflight -= 1
+
+    def stats(self) -> dict:
+        return {"inflight": self.inflight, "queued": self.queued, "max_inflight": self.max_inflight}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware: допускает HTTP-запрос к обработчику или отвечает 503"""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"] in EXEMPT_PATHS
+            or self.controller.max_inflight <= 0
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        priority = classify(scope["method"], scope["path"])
+        name = PRIORITY_NAMES[priority]
+        try:
+            wait = await self.controller.acquire(priority)
+        except Shed as e:
+            metrics.admission_shed.inc((name, e.reason))
+            await _send_unavailable(send)
+            return
+
+        metrics.admission_wait.observe(wait, (name,))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+
+async def _send_unavailable(send):
+    body = json.dumps({"detail": "Server is busy, try again later"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(RETRY_AFTER_SECONDS).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+# === Лимит запросов на игрока ===
+
+class RateLimiter:
+    """
+    Token bucket на ключ: rate запросов в секунду, всплеск до burst.
+    Хранит не больше maxsize ключей (вытесняются давно не приходившие)
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def acquire(self, key) -> float:
+        """0 — запрос разрешён, иначе через сколько секунд появится токен"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens >= 1:
+            tokens -= 1
+            retry_after = 0.0
+        else:
+            retry_after = (1 - tokens) / self.rate
+
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Ограниченный LRU-кэш с TTL.
+    Не потокобезопасен — используется из event loop
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class Snapshot:
+    """Готовый ответ: тело в байтах, ETag и время изменения"""
+    __slots__ = ("body", "etag", "last_modified")
+
+    def __init__(self, body: bytes, etag: str, last_modified: float):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class SnapshotCache:
+    """
+    Кэш сериализованных ответов с TTL, сбросом по записи и склейкой промахов:
+    параллельные запросы одного ключа ждут одну загрузку, а не идут в БД каждый.
+    Не потокобезопасен — используется из event loop
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 2.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # Растёт на каждой записи; снимки прошлых поколений считаются устаревшими
+        self.generation = 0
+        self._data = OrderedDict()
+        self._inflight = {}
+
+    def invalidate(self):
+        self.generation += 1
+
+    async def get_or_load(self, key, load) -> Snapshot:
+        """
+        load() — корутина, возвращающая тело ответа в байтах. Выполняется отдельной задачей:
+        отмена запроса, который её запустил, не обрывает загрузку для остальных
+        """
+        entry = self._data.get(key)
+        if entry is not None:
+            snapshot, expires, generation = entry
+            if generation == self.generation and expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return snapshot
+
+        task = self._inflight.get((key, self.generation))
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._load(key, self.generation, load))
+            self._inflight[(key, self.generation)] = task
+            # Ожидающих может не остаться — исключение не должно уйти в лог как «не прочитанное»
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(task)
+
+    async def _load(self, key, generation: int, load) -> Snapshot:
+        try:
+            body = await load()
+        finally:
+            self._inflight.pop((key, generation), None)
+
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        previous = self._data.get(key)
+        # Тело не изменилось — время изменения прежнее, If-Modified-Since продолжает работать
+        if previous is not None and previous[0].etag == etag:
+            snapshot = previous[0]
+        else:
+            snapshot = Snapshot(body, etag, time.time())
+        # Запись во время загрузки — снимок мог устареть, отдаём его только своим ожидающим
+        if generation == self.generation:
+            self._data[key] = (snapshot, time.monotonic() + self.ttl, generation)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return snapshot
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
@@ -1,73 +1,139 @@
-from sqlalchemy.orm import Session
-from . import models, schemas
-from typing import List, Optional
+from sqlalchemy import and_, case, delete, func, insert, literal, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, joinedload, selectinload
+from . import models, schemas, currency, inventory_sync, ledger, price_history
+from typing import Callable, Dict, List, Optional, Tuple
+from types import SimpleNamespace
+from datetime import datetime
+import base64
 
 # === Игрок ===
 
+def get_player(db: Session, player_id: int) -> Optional[models.Player]:
+    return db.get(models.Player, player_id)
+
+
 def get_player_by_vk_id(db: Session, vk_id: int) -> Optional[models.Player]:
     return db.query(models.Player).filter(models.Player.vk_id == vk_id).first()
 
 
-def create_player(db: Session, vk_id: int) -> models.Player:
-    # Создаём игрока
-    player = models.Player(
-        vk_id=vk_id,
-        name=f"Игрок {vk_id}",
-    )
-    db.add(player)
-    db.commit()
-    db.refresh(player)
-    
-    # Создаём экипировку
-    equipment = models.Equipment(
-        player_id=player.id,
-        weapon_name="Деревянный меч",
-        weapon_icon="🗡️",
-        weapon_attack=5,
-    )
-    db.add(equipment)
+def get_player_names(db: Session, player_ids: List[int]) -> dict:
+    """Имена игроков одним запросом: {id: имя}"""
+    if not player_ids:
+        return {}
+    rows = db.execute(select(models.Player.id, models.Player.name).where(models.Player.id.in_(player_ids)))
+    return {row.id: row.name for row in rows}
+
+
+# Шаблон стартового набора: строки собираются один раз при импорте,
+# на каждого нового игрока подставляется только player_id
+STARTER_EQUIPMENT = {"weapon_name": "Деревянный меч", "weapon_icon": "🗡️", "weapon_attack": 5}
+
+STARTER_ITEMS = [
+    {"name": "Дерево", "icon": "🪵", "quantity": 20, "item_type": "material", "rarity": "common"},
+    {"name": "Зелье HP", "icon": "❤️", "quantity": 5, "item_type": "potion", "rarity": "common"},
+    {"name": "Еда", "icon": "🍖", "quantity": 10, "item_type": "food", "rarity": "common"},
+]
+
+STARTER_SKIN = {"skin_id": "default"}
+
+_equipment_insert = insert(models.Equipment)
+_items_insert = insert(models.InventoryItem)
+_skin_insert = insert(models.OwnedSkin)
+
+
+def dialect_insert(db: Session, model):
+    """INSERT с поддержкой ON CONFLICT для текущего диалекта (Postgres / SQLite)"""
+    if db.get_bind().dialect.name == "postgresql":
+        return pg_insert(model)
+    return sqlite_insert(model)
+
+
+def player_name(vk_id: int) -> str:
+    return f"Игрок {vk_id}"
+
+
+def create_player(db: Session, vk_id: int, player_id: Optional[int] = None) -> models.Player:
+    """
+    Создаёт игрока со стартовым набором одной транзакцией.
+    Если игрок с таким vk_id уже есть (параллельный первый запрос) — возвращает его.
+    player_id — id из справочника игроков при шардировании (app/shards.py)
+    """
+    values = {"vk_id": vk_id, "name": player_name(vk_id)}
+    if player_id is not None:
+        values["id"] = player_id
+    # Создаём игрока или получаем существующего. Без цели ON CONFLICT — при заданном id
+    # параллельная вставка конфликтует и по первичному ключу
+    player = db.scalars(
+        dialect_insert(db, models.Player)
+        .values(**values)
+        .on_conflict_do_nothing()
+        .returning(models.Player)
+    ).first()
     
-    # Добавляем стартовые предметы
-    starter_items = [
-        {"name": "Дерево", "icon": "🪵", "quantity": 20, "item_type": "material", "rarity": "common"},
-        {"name": "Зелье HP", "icon": "❤️", "quantity": 5, "item_type": "potion", "rarity": "common"},
-        {"name": "Еда", "icon": "🍖", "quantity": 10, "item_type": "food", "rarity": "common"},
-    ]
+    if player is None:
+        db.rollback()
+        return get_player_by_vk_id(db, vk_id)
     
-    for item_data in starter_items:
-        item = models.InventoryItem(player_id=player.id, **item_data)
-        db.add(item)
+    # Экипировка, стартовые предметы и скин — пакетными вставками
+    db.execute(_equipment_insert, [{"player_id": player.id, **STARTER_EQUIPMENT}])
+    db.execute(_items_insert, [{"player_id": player.id, **item} for item in STARTER_ITEMS])
+    db.execute(_skin_insert, [{"player_id": player.id, **STARTER_SKIN}])
     
-    # Добавляем стартовый скин
-    skin = models.OwnedSkin(player_id=player.id, skin_id="default")
-    db.add(skin)
+    ledger.record(db, player.id, "currency", "gold", player.gold, player.gold, "signup")
+    ledger.record(db, player.id, "currency", "crystals", player.crystals, player.crystals, "signup")
+    for item in STARTER_ITEMS:
+        ledger.record(db, player.id, "item", item["name"], item["quantity"], item["quantity"], "signup")
     
     db.commit()
-    db.refresh(player)
-    
     return player
 
 
-def update_player_gold(db: Session, player_id: int, amount: int) -> models.Player:
-    player = db.query(models.Player).filter(models.Player.id == player_id).first()
-    if player:
-        player.gold += amount
-        if player.gold < 0:
-            player.gold = 0
-        db.commit()
-        db.refresh(player)
-    return player
+def get_player_bootstrap(db: Session, player_id: int) -> Optional[models.Player]:
+    """
+    Игрок со снаряжением, инвентарём и скинами для первого экрана — ровно три запроса:
+    игрок JOIN снаряжение, затем инвентарь и скины по player_id (selectin)
+    """
+    return db.execute(
+        select(models.Player)
+        .where(models.Player.id == player_id)
+        .options(
+            joinedload(models.Player.equipment),
+            selectinload(models.Player.inventory),
+            selectinload(models.Player.owned_skins),
+        )
+    ).unique().scalar_one_or_none()
 
 
-def update_player_crystals(db: Session, player_id: int, amount: int) -> models.Player:
-    player = db.query(models.Player).filter(models.Player.id == player_id).first()
-    if player:
-        player.crystals += amount
-        if player.crystals < 0:
-            player.crystals = 0
-        db.commit()
-        db.refresh(player)
-    return player
+def get_equipment(db: Session, player_id: int) -> Optional[models.Equipment]:
+    return db.query(models.Equipment).filter(models.Equipment.player_id == player_id).first()
+
+
+def credit_player(
+    db: Session, player_id: int, gold: int = 0, items: List[dict] = (), reason: str = "credit"
+):
+    """
+    Начисление игроку: золото и предметы [{item_name, item_icon, item_rarity, quantity}].
+    Начисление не может не пройти, поэтому при шардировании его можно отложить
+    и доставить на шард игрока сообщением (app/shards.py). Без commit
+    """
+    if gold:
+        currency.change_balance(db, player_id, {"gold": gold}, commit=False, reason=reason)
+    if items:
+        _stack_inventory_items(db, player_id, [SimpleNamespace(**item) for item in items], reason)
+
+
+def update_player_gold(db: Session, player_id: int, amount: int) -> Optional[int]:
+    """Изменить золото (не ниже нуля). Возвращает новый баланс"""
+    balances = currency.change_balance(db, player_id, {"gold": amount}, clamp=True, reason="update_gold")
+    return balances["gold"] if balances else None
+
+
+def update_player_crystals(db: Session, player_id: int, amount: int) -> Optional[int]:
+    """Изменить кристаллы (не ниже нуля). Возвращает новый баланс"""
+    balances = currency.change_balance(db, player_id, {"crystals": amount}, clamp=True, reason="update_crystals")
+    return balances["crystals"] if balances else None
 
 
 # === Инвентарь ===
@@ -78,49 +144,278 @@ def get_inventory(db: Session, player_id: int) -> List[models.InventoryItem]:
     ).all()
 
 
-def add_inventory_item(db: Session, player_id: int, item: schemas.InventoryItemCreate) -> models.InventoryItem:
-    # Проверяем, есть ли уже такой предмет
-    existing = db.query(models.InventoryItem).filter(
-        models.InventoryItem.player_id == player_id,
-        models.InventoryItem.name == item.name
-    ).first()
+def _stack_inventory_item(
+    db: Session, player_id: int, item: schemas.InventoryItemCreate, reason: str = "add_item"
+) -> models.InventoryItem:
+    """
+    Кладёт предмет в стопку игрока одним запросом:
+    INSERT ... ON CONFLICT (player_id, name) DO UPDATE SET quantity = quantity + excluded.quantity.
+    Без commit
+    """
+    version = inventory_sync.bump(db, player_id)
+    stmt = dialect_insert(db, models.InventoryItem).values(player_id=player_id, version=version, **item.dict())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["player_id", "name"],
+        set_={"quantity": models.InventoryItem.quantity + stmt.excluded.quantity, "version": stmt.excluded.version}
+    ).returning(models.InventoryItem)
     
-    if existing:
-        existing.quantity += item.quantity
-        db.commit()
-        db.refresh(existing)
-        return existing
-    else:
-        db_item = models.InventoryItem(player_id=player_id, **item.dict())
-        db.add(db_item)
-        db.commit()
-        db.refresh(db_item)
-        return db_item
+    db_item = db.scalars(stmt, execution_options={"populate_existing": True}).one()
+    ledger.record(db, player_id, "item", item.name, item.quantity, db_item.quantity, reason)
+    return db_item
 
 
-def remove_inventory_item(db: Session, player_id: int, item_id: int, quantity: int = 1) -> bool:
-    item = db.query(models.InventoryItem).filter(
-        models.InventoryItem.id == item_id,
-        models.InventoryItem.player_id == player_id
+def add_inventory_item(
+    db: Session, player_id: int, item: schemas.InventoryItemCreate, reason: str = "add_item"
+) -> models.InventoryItem:
+    db_item = _stack_inventory_item(db, player_id, item, reason)
+    db.commit()
+    return db_item
+
+
+def _decrement_inventory(db: Session, player_id: int, condition, quantity: int, reason: str) -> bool:
+    """
+    Условно уменьшает стопку без предварительного чтения и удаляет её, если она опустела.
+    Без commit
+    """
+    if quantity <= 0:
+        return False
+    
+    version = inventory_sync.bump(db, player_id)
+    row = db.execute(
+        update(models.InventoryItem)
+        .where(models.InventoryItem.player_id == player_id, condition)
+        .values(quantity=models.InventoryItem.quantity - quantity, version=version)
+        .returning(models.InventoryItem.id, models.InventoryItem.name, models.InventoryItem.quantity)
+        .execution_options(synchronize_session=False)
     ).first()
     
-    if not item:
+    if row is None:
         return False
     
-    item.quantity -= quantity
-    if item.quantity <= 0:
-        db.delete(item)
+    # Если убрали больше, чем было, стопка просто удаляется целиком
+    removed = quantity if row.quantity >= 0 else quantity + row.quantity
+    if row.quantity <= 0:
+        db.execute(
+            delete(models.InventoryItem)
+            .where(models.InventoryItem.id == row.id, models.InventoryItem.quantity <= 0)
+            .execution_options(synchronize_session=False)
+        )
+        inventory_sync.record_deleted(db, player_id, [row.id], version)
     
+    ledger.record(db, player_id, "item", row.name, -removed, max(row.quantity, 0), reason)
+    return True
+
+
+def remove_inventory_item(
+    db: Session, player_id: int, item_id: int, quantity: int = 1, reason: str = "remove_item"
+) -> bool:
+    if not _decrement_inventory(db, player_id, models.InventoryItem.id == item_id, quantity, reason):
+        db.rollback()
+        return False
     db.commit()
     return True
 
 
+def take_inventory_item(db: Session, player_id: int, name: str, quantity: int, reason: str) -> bool:
+    """Забирает quantity предметов по имени, только если их хватает. Без commit"""
+    condition = and_(models.InventoryItem.name == name, models.InventoryItem.quantity >= quantity)
+    return _decrement_inventory(db, player_id, condition, quantity, reason)
+
+
+class InventoryBatchError(Exception):
+    """Операция пакета не применима — весь пакет отменяется"""
+
+    def __init__(self, index: int, detail: str):
+        super().__init__(detail)
+        self.index = index
+        self.detail = detail
+
+
+def apply_inventory_batch(
+    db: Session, player_id: int, operations: List[schemas.InventoryOperation]
+) -> List[dict]:
+    """
+    Применяет пакет add/use/remove одной транзакцией: всё или ничего.
+    Сначала поднимается версия инвентаря: её строка заблокирована до commit, и другие
+    изменения инвентаря игрока ждут, поэтому пакет не теряет параллельных изменений.
+    Затем инвентарь читается один раз и пакет применяется в памяти. Возвращает итоговые
+    количества затронутых стопок (0 — стопка удалена)
+    """
+    if not operations:
+        return []
+    touched = []
+    
+    try:
+        version = inventory_sync.bump(db, player_id)
+        items = get_inventory(db, player_id)
+        by_id = {item.id: item for item in items}
+        by_name = {item.name: item for item in items}
+        
+        for index, operation in enumerate(operations):
+            if operation.quantity <= 0:
+                raise InventoryBatchError(index, "Invalid quantity")
+            
+            if operation.op == "add":
+                if not operation.name or not operation.icon:
+                    raise InventoryBatchError(index, "Item name and icon required")
+                item = by_name.get(operation.name)
+                if item is None:
+                    item = models.InventoryItem(
+                        player_id=player_id,
+                        name=operation.name,
+                        icon=operation.icon,
+                        quantity=0,
+                        item_type=operation.item_type,
+                        rarity=operation.rarity
+                    )
+                    db.add(item)
+                    by_name[item.name] = item
+                item.quantity += operation.quantity
+                ledger.record(db, player_id, "item", item.name, operation.quantity, item.quantity, "batch_add")
+            
+            elif operation.op in ("use", "remove"):
+                item = by_id.get(operation.item_id)
+                if item is None or item.quantity <= 0:
+                    raise InventoryBatchError(index, "Item not found")
+                quantity = 1 if operation.op == "use" else operation.quantity
+                removed = min(quantity, item.quantity)
+                item.quantity -= removed
+                ledger.record(db, player_id, "item", item.name, -removed, item.quantity, f"batch_{operation.op}")
+            
+            else:
+                raise InventoryBatchError(index, "Unknown operation")
+            
+            if item not in touched:
+                touched.append(item)
+                item.version = version
+        
+        # Опустевшие стопки удаляем в конце — на них ещё могли ссылаться операции пакета
+        deleted = []
+        for item in touched:
+            if item.quantity <= 0:
+                if item.id in by_id:
+                    db.delete(item)
+                    deleted.append(item.id)
+                else:
+                    db.expunge(item)
+        inventory_sync.record_deleted(db, player_id, deleted, version)
+        
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    
+    return [
+        {"item_id": item.id, "name": item.name, "quantity": item.quantity}
+        for item in touched
+    ]
+
+
 # === Биржа ===
 
-def get_market_listings(db: Session, skip: int = 0, limit: int = 50) -> List[models.MarketListing]:
-    return db.query(models.MarketListing).filter(
-        models.MarketListing.is_active == True
-    ).offset(skip).limit(limit).all()
+MARKET_SORTS = ("newest", "price")
+
+
+def encode_market_cursor(listing: models.MarketListing, sort: str = "newest") -> str:
+    """Ключ последнего лота страницы: (created_at, id) или (price, id) — по сортировке"""
+    key = listing.price if sort == "price" else listing.created_at.isoformat()
+    raw = f"{key}|{listing.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_market_cursor(cursor: str, sort: str = "newest") -> Tuple[object, int]:
+    """Обратное к encode_market_cursor. ValueError на мусорный курсор или курсор другой сортировки"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        key, listing_id = raw.split("|")
+        key = int(key) if sort == "price" else datetime.fromisoformat(key)
+        return key, int(listing_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _item_name_prefix(db: Session, prefix: str):
+    column = models.MarketListing.item_name
+    if db.get_bind().dialect.name == "postgresql":
+        # LIKE 'префикс%' идёт по индексу с varchar_pattern_ops
+        pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return column.like(pattern, escape="\\")
+    # SQLite сравнивает строки побайтно — префикс превращается в диапазон по индексу
+    return and_(column >= prefix, column < prefix + "\U0010ffff")
+
+
+def get_market_listings(
+    db: Session,
+    search: Optional[schemas.MarketSearch] = None,
+    after: Optional[Tuple[object, int]] = None,
+    limit: int = 50,
+    directory: bool = False,
+) -> List[Tuple[models.MarketListing, str]]:
+    """
+    Активные лоты по фильтрам, с именем продавца одним запросом.
+    Keyset-пагинация: after — ключ последнего лота предыдущей страницы
+    ((created_at, id) для newest, (price, id) для price).
+    directory — игроки на шардах, имя продавца берётся из справочника игроков
+    """
+    listing = models.MarketListing
+    search = search or schemas.MarketSearch()
+    sellers = models.PlayerDirectory if directory else models.Player
+    
+    query = db.query(listing, sellers.name).join(
+        sellers, sellers.id == listing.seller_id
+    ).filter(
+        listing.is_active == True
+    )
+    
+    if search.item_name:
+        query = query.filter(listing.item_name == search.item_name)
+    elif search.item_prefix:
+        query = query.filter(_item_name_prefix(db, search.item_prefix))
+    if search.rarity:
+        query = query.filter(listing.item_rarity == search.rarity)
+    if search.min_price is not None:
+        query = query.filter(listing.price >= search.min_price)
+    if search.max_price is not None:
+        query = query.filter(listing.price <= search.max_price)
+    if search.seller_id is not None:
+        query = query.filter(listing.seller_id == search.seller_id)
+    
+    if search.sort == "price":
+        if after is not None:
+            query = query.filter(tuple_(listing.price, listing.id) > tuple_(*after))
+        query = query.order_by(listing.price, listing.id)
+    else:
+        if after is not None:
+            created_at, listing_id = after
+            query = query.filter(
+                tuple_(listing.created_at, listing.id) < tuple_(
+                    literal(created_at, listing.created_at.type), listing_id
+                )
+            )
+        query = query.order_by(listing.created_at.desc(), listing.id.desc())
+    
+    return query.limit(limit).all()
+
+
+def get_market_summary(db: Session) -> List[dict]:
+    """Витрина биржи: по каждому предмету самая низкая цена, число лотов и штук. Один проход по индексу"""
+    listing = models.MarketListing
+    rows = db.execute(
+        select(
+            listing.item_name,
+            func.min(listing.item_icon),
+            func.min(listing.price),
+            func.count(),
+            func.sum(listing.quantity),
+        )
+        .where(listing.is_active == True)
+        .group_by(listing.item_name)
+        .order_by(listing.item_name)
+    ).all()
+    return [
+        {"item_name": name, "item_icon": icon, "min_price": min_price, "listings": count, "quantity": quantity}
+        for name, icon, min_price, count, quantity in rows
+    ]
 
 
 def create_market_listing(db: Session, seller_id: int, listing: schemas.MarketListingCreate) -> models.MarketListing:
@@ -131,38 +426,375 @@ def create_market_listing(db: Session, seller_id: int, listing: schemas.MarketLi
     return db_listing
 
 
-def buy_market_listing(db: Session, buyer_id: int, listing_id: int) -> bool:
-    listing = db.query(models.MarketListing).filter(
-        models.MarketListing.id == listing_id,
-        models.MarketListing.is_active == True
-    ).first()
+def list_inventory_item(
+    db: Session, seller_id: int, listing: schemas.MarketListingCreate
+) -> Optional[models.MarketListing]:
+    """Снимает предметы из инвентаря и выставляет лот одной транзакцией. None — предметов не хватает"""
+    if not take_inventory_item(db, seller_id, listing.item_name, listing.quantity, "market_listing"):
+        db.rollback()
+        return None
     
-    if not listing:
-        return False
+    db_listing = models.MarketListing(seller_id=seller_id, **listing.dict())
+    db.add(db_listing)
+    db.commit()
+    return db_listing
+
+
+def buy_market_listing(db: Session, buyer_id: int, listing_id: int) -> Optional[dict]:
+    """Покупка лота целиком. Возвращает проданный лот или None, если купить нельзя"""
+    result = buy_market_listings(db, buyer_id, [listing_id])[0]
+    if result["status"] != "bought":
+        return None
+    return {key: result[key] for key in ("listing_id", "item_name", "price", "quantity")}
+
+
+def _claim_listings(db: Session, listing_ids: List[int]) -> List:
+    """
+    Снимает активные лоты с продажи и возвращает их строки. Лот, который уже продан
+    или прямо сейчас покупает другой, не возвращается — двойной продажи нет.
+    Postgres: SELECT ... FOR UPDATE SKIP LOCKED — занятые строки пропускаются без ожидания.
+    SQLite: условный UPDATE ... RETURNING под блокировкой записи базы
+    """
+    listing = models.MarketListing
+    query = select(listing.id).where(listing.id.in_(listing_ids), listing.is_active == True)
+    if db.get_bind().dialect.name == "postgresql":
+        query = query.order_by(listing.id).with_for_update(skip_locked=True)
+    # На SQLite это дешёвая предпроверка: проигравшие гонку не встают в очередь за блокировкой записи
+    ids = db.scalars(query).all()
+    if not ids:
+        return []
+    return db.execute(
+        update(listing)
+        .where(listing.id.in_(ids), listing.is_active == True)
+        .values(is_active=False)
+        .returning(
+            listing.id, listing.seller_id, listing.item_name, listing.item_icon,
+            listing.item_rarity, listing.price, listing.quantity
+        )
+        .execution_options(synchronize_session=False)
+    ).all()
+
+
+def buy_market_listings(db: Session, buyer_id: int, listing_ids: List[int]) -> List[dict]:
+    """
+    Покупка нескольких лотов одной транзакцией. Результат по каждому лоту в порядке запроса:
+    status — bought / unavailable (продан, снят или занят другим покупателем) /
+    not_enough_gold (покупаются лоты по порядку, пока хватает золота)
+    """
+    listing_ids = list(dict.fromkeys(listing_ids))
+    try:
+        claimed = {row.id: row for row in _claim_listings(db, listing_ids)}
+        
+        gold = db.execute(select(models.Player.gold).where(models.Player.id == buyer_id)).scalar() or 0
+        bought, unaffordable, results = [], [], []
+        for listing_id in listing_ids:
+            row = claimed.get(listing_id)
+            if row is None:
+                results.append({"listing_id": listing_id, "status": "unavailable"})
+                continue
+            cost = row.price * row.quantity
+            if cost > gold:
+                unaffordable.append(listing_id)
+                results.append({"listing_id": listing_id, "status": "not_enough_gold"})
+                continue
+            gold -= cost
+            bought.append(row)
+            results.append({
+                "listing_id": listing_id, "status": "bought", "item_name": row.item_name,
+                "price": row.price, "quantity": row.quantity,
+            })
+        
+        if unaffordable:
+            # Вернуть на продажу то, на что не хватило
+            db.execute(
+                update(models.MarketListing)
+                .where(models.MarketListing.id.in_(unaffordable))
+                .values(is_active=True)
+                .execution_options(synchronize_session=False)
+            )
+        if not bought:
+            db.commit()
+            return results
+        
+        # Все переводы золота одним UPDATE: покупатель платит, продавцы получают 95%
+        deltas = {buyer_id: 0}
+        reasons = {}
+        for row in bought:
+            deltas[buyer_id] -= row.price * row.quantity
+            deltas[row.seller_id] = deltas.get(row.seller_id, 0) + int(row.price * row.quantity * MARKET_FEE_KEEP)
+            reasons[row.seller_id] = "market_sale"
+        reasons[buyer_id] = "market_buy"
+        if currency.transfer(db, "gold", deltas, reasons) is None:
+            # Параллельная трата того же покупателя — золота уже не хватает
+            db.rollback()
+            return [
+                {"listing_id": r["listing_id"], "status": "not_enough_gold" if r["status"] == "bought" else r["status"]}
+                for r in results
+            ]
+        
+        _stack_inventory_items(db, buyer_id, bought, reason="market_buy")
+        
+        by_item = {}
+        for row in bought:
+            by_item.setdefault(row.item_name, []).append({
+                "price": row.price, "quantity": row.quantity,
+                "buyer_id": buyer_id, "seller_id": row.seller_id, "listing_id": row.id,
+            })
+        for item_name, trades in by_item.items():
+            price_history.record_trades(db, item_name, trades)
+        
+        db.commit()
+        return results
+    except Exception:
+        db.rollback()
+        raise
+
+
+def settle_listing_purchase(
+    db: Session, buyer_id: int, paid: Dict[int, int], credit: Callable = credit_player
+) -> Dict[int, str]:
+    """
+    Вторая половина покупки, когда золото покупателя уже списано на другой БД
+    (paid — {id лота: списано}): снимает лоты с продажи, пишет сделки и начисляет
+    продавцам выручку, а покупателю — предметы и возврат за лоты, которые успели купить
+    другие. Возвращает {id лота: bought / unavailable}. Без commit
+    """
+    claimed = {row.id: row for row in _claim_listings(db, list(paid))}
+    statuses = {}
+    items = []
+    refund = 0
+    by_item = {}
+    for listing_id, cost in paid.items():
+        row = claimed.get(listing_id)
+        if row is None:
+            statuses[listing_id] = "unavailable"
+            refund += cost
+            continue
+        statuses[listing_id] = "bought"
+        items.append({
+            "item_name": row.item_name, "item_icon": row.item_icon,
+            "item_rarity": row.item_rarity, "quantity": row.quantity,
+        })
+        credit(db, row.seller_id, gold=int(row.price * row.quantity * MARKET_FEE_KEEP), reason="market_sale")
+        by_item.setdefault(row.item_name, []).append({
+            "price": row.price, "quantity": row.quantity,
+            "buyer_id": buyer_id, "seller_id": row.seller_id, "listing_id": row.id,
+        })
     
-    buyer = db.query(models.Player).filter(models.Player.id == buyer_id).first()
-    seller = db.query(models.Player).filter(models.Player.id == listing.seller_id).first()
+    if items:
+        credit(db, buyer_id, items=items, reason="market_buy")
+    if refund:
+        credit(db, buyer_id, gold=refund, reason="market_refund")
+    for item_name, trades in by_item.items():
+        price_history.record_trades(db, item_name, trades)
+    return statuses
+
+
+def _stack_inventory_items(db: Session, player_id: int, listings: List, reason: str):
+    """Купленные лоты в инвентарь одним INSERT ... ON CONFLICT на все предметы. Без commit"""
+    version = inventory_sync.bump(db, player_id)
+    items = {}
+    for row in listings:
+        if row.item_name in items:
+            items[row.item_name]["quantity"] += row.quantity
+        else:
+            items[row.item_name] = {
+                "player_id": player_id, "name": row.item_name, "icon": row.item_icon,
+                "quantity": row.quantity, "item_type": "material", "rarity": row.item_rarity,
+                "version": version,
+            }
     
-    total_price = listing.price * listing.quantity
+    stmt = dialect_insert(db, models.InventoryItem).values(list(items.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["player_id", "name"],
+        set_={"quantity": models.InventoryItem.quantity + stmt.excluded.quantity, "version": stmt.excluded.version}
+    ).returning(models.InventoryItem.name, models.InventoryItem.quantity)
     
-    # Проверяем золото
-    if buyer.gold < total_price:
-        return False
+    for name, quantity in db.execute(stmt):
+        ledger.record(db, player_id, "item", name, items[name]["quantity"], quantity, reason)
+
+
+# === Ордера биржи ===
+
+# Продавец получает 95% суммы сделки, как и при покупке лота
+MARKET_FEE_KEEP = 0.95
+
+
+class OrderRejected(Exception):
+    """Заявку нельзя принять: не хватает золота или предметов"""
+
+
+class BookConflict(Exception):
+    """Встречная заявка уже исполнена или отменена — стакан в памяти устарел"""
+
+
+def get_open_market_orders(db: Session, item_name: Optional[str] = None) -> List[models.MarketOrder]:
+    query = db.query(models.MarketOrder).filter(models.MarketOrder.status == "open")
+    if item_name is not None:
+        query = query.filter(models.MarketOrder.item_name == item_name)
+    return query.order_by(models.MarketOrder.id).all()
+
+
+def bump_market_book(db: Session, item_name: str) -> int:
+    """
+    Новая версия стакана предмета — в транзакции, меняющей его заявки. Строка
+    заблокирована до commit, поэтому версии стакана коммитятся строго по порядку. Без commit
+    """
+    versions = models.MarketBookVersion.__table__
+    stmt = dialect_insert(db, versions).values(item_name=item_name, version=1).on_conflict_do_update(
+        index_elements=["item_name"],
+        set_={"version": versions.c.version + 1},
+    ).returning(versions.c.version)
+    return db.execute(stmt).scalar_one()
+
+
+def get_market_book_version(db: Session, item_name: str) -> int:
+    """Версия стакана предмета: одна строка по ключу. 0 — заявок по предмету не было"""
+    return db.scalar(
+        select(models.MarketBookVersion.version).where(models.MarketBookVersion.item_name == item_name)
+    ) or 0
+
+
+def get_market_book(db: Session, item_name: str) -> Tuple[List[models.MarketOrder], int]:
+    """
+    Открытые заявки предмета и версия стакана. Версия читается первой: изменение между
+    двумя запросами попадёт в заявки, но не в версию, и стакан просто перечитается ещё раз
+    """
+    version = get_market_book_version(db, item_name)
+    return get_open_market_orders(db, item_name), version
+
+
+def get_market_books(db: Session) -> Tuple[List[models.MarketOrder], Dict[str, int]]:
+    """Как get_market_book, но для всех предметов — первая загрузка стаканов"""
+    versions = dict(db.execute(select(models.MarketBookVersion.item_name, models.MarketBookVersion.version)).all())
+    return get_open_market_orders(db), versions
+
+
+def reserve_for_order(db: Session, player_id: int, order: schemas.MarketOrderCreate) -> bool:
+    if order.side == "buy":
+        cost = order.price * order.quantity
+        return currency.change_balance(
+            db, player_id, {"gold": -cost}, commit=False, reason="order_reserve"
+        ) is not None
     
-    # Переводим золото (минус 5% комиссия)
-    buyer.gold -= total_price
-    seller.gold += int(total_price * 0.95)
+    return take_inventory_item(db, player_id, order.item_name, order.quantity, "order_reserve")
+
+
+def place_market_order(
+    db: Session,
+    player_id: int,
+    order: schemas.MarketOrderCreate,
+    fills: List[Tuple[int, int, int]],
+    reserve: Optional[Callable[[Session], bool]] = None,
+    credit: Callable = credit_player,
+) -> Tuple[models.MarketOrder, List[dict], int]:
+    """
+    Резервирует золото/предметы, создаёт заявку и исполняет её по плану fills
+    [(id встречной заявки, количество, цена)] — всё одной транзакцией.
+    При шардировании резерв уже снят на шарде игрока (reserve подтверждает его),
+    а начисления участникам уходят сообщениями (credit) — app/shard_market.py.
+    Третье значение — версия стакана после заявки.
+    OrderRejected — не хватает ресурсов, BookConflict — план устарел
+    """
+    try:
+        version = bump_market_book(db, order.item_name)
+        reserved = reserve(db) if reserve is not None else reserve_for_order(db, player_id, order)
+        if not reserved:
+            raise OrderRejected()
+        
+        db_order = models.MarketOrder(
+            player_id=player_id, remaining=order.quantity, status="open", **order.dict()
+        )
+        db.add(db_order)
+        db.flush()
+        
+        trades = []
+        fills_done = []
+        for resting_id, quantity, price in fills:
+            # Условное списание: встречная заявка должна быть открыта и не меньше объёма сделки
+            resting = db.execute(
+                update(models.MarketOrder)
+                .where(
+                    models.MarketOrder.id == resting_id,
+                    models.MarketOrder.status == "open",
+                    models.MarketOrder.remaining >= quantity
+                )
+                .values(
+                    remaining=models.MarketOrder.remaining - quantity,
+                    status=case((models.MarketOrder.remaining == quantity, "filled"), else_="open")
+                )
+                .returning(models.MarketOrder.player_id)
+            ).first()
+            if resting is None:
+                raise BookConflict(resting_id)
+            
+            if order.side == "buy":
+                buyer_id, seller_id = player_id, resting.player_id
+                # Сделка по цене встречной заявки — возвращаем разницу с лимитом
+                if price < order.price:
+                    credit(db, player_id, gold=(order.price - price) * quantity, reason="order_refund")
+            else:
+                buyer_id, seller_id = resting.player_id, player_id
+            
+            credit(db, seller_id, gold=int(price * quantity * MARKET_FEE_KEEP), reason="order_trade")
+            credit(db, buyer_id, items=[_order_item(order, quantity)], reason="order_trade")
+            
+            db_order.remaining -= quantity
+            trades.append({"order_id": resting_id, "price": price, "quantity": quantity})
+            fills_done.append({
+                "price": price, "quantity": quantity,
+                "buyer_id": buyer_id, "seller_id": seller_id, "order_id": resting_id,
+            })
+        
+        price_history.record_trades(db, order.item_name, fills_done)
+        
+        if db_order.remaining == 0:
+            db_order.status = "filled"
+        
+        db.commit()
+        return db_order, trades, version
+    except Exception:
+        db.rollback()
+        raise
+
+
+def _order_item(order, quantity: int) -> dict:
+    return {
+        "item_name": order.item_name, "item_icon": order.item_icon,
+        "item_rarity": order.item_rarity, "quantity": quantity,
+    }
+
+
+def cancel_market_order(
+    db: Session, player_id: int, order_id: int, credit: Callable = credit_player
+) -> Optional[Tuple[models.MarketOrder, int]]:
+    """
+    Отменяет открытую заявку игрока и возвращает зарезервированное (credit — как в place_market_order).
+    Возвращает заявку и версию стакана после отмены; None — заявки нет
+    """
+    order = db.query(models.MarketOrder).filter(
+        models.MarketOrder.id == order_id,
+        models.MarketOrder.player_id == player_id,
+        models.MarketOrder.status == "open"
+    ).first()
     
-    # Добавляем предмет покупателю
-    add_inventory_item(db, buyer_id, schemas.InventoryItemCreate(
-        name=listing.item_name,
-        icon=listing.item_icon,
-        quantity=listing.quantity,
-        rarity=listing.item_rarity
-    ))
+    if not order:
+        return None
     
-    # Деактивируем лот
-    listing.is_active = False
+    result = db.execute(
+        update(models.MarketOrder)
+        .where(models.MarketOrder.id == order_id, models.MarketOrder.status == "open")
+        .values(status="cancelled")
+    )
+    if result.rowcount != 1:
+        db.rollback()
+        return None
+    
+    version = bump_market_book(db, order.item_name)
+    if order.side == "buy":
+        credit(db, player_id, gold=order.price * order.remaining, reason="order_cancel")
+    else:
+        credit(db, player_id, items=[_order_item(order, order.remaining)], reason="order_cancel")
     
     db.commit()
-    return True
\ No newline at end of file
+    return order, version
\ No newline at end of file
@@ -0,0 +1,122 @@
+from typing import Dict, Optional
+
+from sqlalchemy import case, select, update
+from sqlalchemy.orm import Session
+
+from . import models, ledger
+
+# === Валюта игрока ===
+#
+# Каждое изменение — один условный UPDATE:
+#   UPDATE players SET gold = gold + :d WHERE id = :id AND gold + :d >= 0 RETURNING gold
+# Чтение, проверка и запись происходят в БД атомарно, поэтому параллельные
+# запросы не теряют обновления и не уводят баланс в минус.
+
+CURRENCIES = ("gold", "crystals")
+
+
+def change_balance(
+    db: Session,
+    player_id: int,
+    deltas: Dict[str, int],
+    set_values: Optional[dict] = None,
+    clamp: bool = False,
+    commit: bool = True,
+    reason: str = "",
+) -> Optional[Dict[str, int]]:
+    """
+    Применяет дельты {"gold": -10, "crystals": 5} одним UPDATE и возвращает новые балансы.
+    None — игрока нет или какой-то валюты не хватает (ничего не изменено).
+    clamp=True — не отказывать, а обрезать баланс до нуля.
+    set_values — дополнительные колонки игрока в том же UPDATE (например, current_skin).
+    reason — причина для журнала экономики
+    """
+    values = {}
+    conditions = [models.Player.id == player_id]
+
+    for name, delta in deltas.items():
+        if name not in CURRENCIES:
+            raise ValueError(f"Unknown currency: {name}")
+        column = getattr(models.Player, name)
+        if clamp:
+            values[name] = case((column + delta < 0, 0), else_=column + delta)
+        else:
+            values[name] = column + delta
+            if delta < 0:
+                conditions.append(column + delta >= 0)
+
+    if set_values:
+        values.update(set_values)
+
+    stmt = (
+        update(models.Player)
+        .where(*conditions)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    columns = [getattr(models.Player, name) for name in deltas]
+
+    if db.get_bind().dialect.update_returning:
+        row = db.execute(stmt.returning(*columns)).first()
+    else:
+        # SQLite < 3.35 без RETURNING: читаем балансы в той же транзакции
+        row = None
+        if db.execute(stmt).rowcount == 1:
+            row = db.execute(select(*columns).where(models.Player.id == player_id)).first()
+
+    if row is None:
+        return None
+
+    for (name, delta), balance in zip(deltas.items(), row):
+        # При обрезке до нуля точное изменение неизвестно — в журнал идёт только баланс
+        if clamp and delta < 0 and balance == 0:
+            delta = None
+        ledger.record(db, player_id, "currency", name, delta, balance, reason)
+
+    if commit:
+        db.commit()
+    return dict(zip(deltas, row))
+
+
+def transfer(
+    db: Session,
+    currency: str,
+    deltas: Dict[int, int],
+    reasons: Dict[int, str],
+) -> Optional[Dict[int, int]]:
+    """
+    Изменения одной валюты у нескольких игроков одним UPDATE ... CASE по id.
+    Списания условные: если кому-то не хватает, возвращает None — часть строк
+    при этом уже могла измениться, вызывающий откатывает транзакцию.
+    Одна инструкция блокирует строки игроков в порядке индекса, без взаимных блокировок
+    между встречными сделками. Без commit
+    """
+    if currency not in CURRENCIES:
+        raise ValueError(f"Unknown currency: {currency}")
+    deltas = {player_id: delta for player_id, delta in deltas.items() if delta}
+    if not deltas:
+        return {}
+
+    column = getattr(models.Player, currency)
+    delta = case(deltas, value=models.Player.id)
+    stmt = (
+        update(models.Player)
+        .where(models.Player.id.in_(deltas), column + delta >= 0)
+        .values({column: column + delta})
+        .execution_options(synchronize_session=False)
+    )
+
+    if db.get_bind().dialect.update_returning:
+        rows = db.execute(stmt.returning(models.Player.id, column)).all()
+    else:
+        rows = []
+        if db.execute(stmt).rowcount == len(deltas):
+            rows = db.execute(select(models.Player.id, column).where(models.Player.id.in_(deltas))).all()
+
+    if len(rows) != len(deltas):
+        return None
+
+    balances = dict(rows)
+    for player_id, change in deltas.items():
+        ledger.record(db, player_id, "currency", currency, change, balances[player_id], reasons.get(player_id, ""))
+    return balances
@@ -1,8 +1,16 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import contextvars
+import time
 import os
 
+from . import metrics
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
 # Supabase/Heroku используют postgres://, SQLAlchemy нужен postgresql://
@@ -13,11 +21,183 @@ if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
 if not DATABASE_URL:
     DATABASE_URL = "sqlite:///./mmorpg_game.db"
 
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+
+# === Профили engine ===
+#
+# Выбираются через DB_PROFILE, по умолчанию "postgres" или "sqlite" по DATABASE_URL.
+# Размер пула можно переопределить через DB_POOL_SIZE / DB_MAX_OVERFLOW.
+
+ENGINE_PROFILES = {
+    # Продакшен: один uvicorn-воркер на выделенном Postgres
+    "postgres": {
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_timeout_ms": 5000,
+    },
+    # Маленький инстанс / Supabase free tier: лимит соединений ~20 на всех воркеров
+    "postgres-small": {
+        "pool_size": 3,
+        "max_overflow": 2,
+        "pool_timeout": 10,
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+        "statement_timeout_ms": 5000,
+    },
+    # SQLite: WAL — читатели не блокируют писателя, synchronous=NORMAL — fsync только на checkpoint
+    "sqlite": {
+        "pool_size": 8,
+        "max_overflow": 8,
+        "pool_timeout": 10,
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "busy_timeout": 5000,
+        },
+    },
+    # Старое поведение SQLite (rollback journal) — для сравнения в бенчмарках
+    "sqlite-legacy": {
+        "pool_size": 8,
+        "max_overflow": 8,
+        "pool_timeout": 10,
+        "pragmas": {},
+    },
+}
+
+DB_PROFILE = os.getenv("DB_PROFILE", "sqlite" if IS_SQLITE else "postgres")
+
+
+def get_profile(name: str) -> dict:
+    if name not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE: {name}")
+    profile = dict(ENGINE_PROFILES[name])
+    if os.getenv("DB_POOL_SIZE"):
+        profile["pool_size"] = int(os.getenv("DB_POOL_SIZE"))
+    if os.getenv("DB_MAX_OVERFLOW"):
+        profile["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW"))
+    return profile
+
+
+# === Статистика пула ===
+
+class PoolStats:
+    """Счётчики ожидания checkout. Обновляются без блокировок — значения приблизительные"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float):
+        self.checkouts += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+
+
+class _TimedPoolMixin:
+    metrics_name = "sync"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - started
+            self.stats.record(wait)
+            metrics.observe_pool_wait(self.metrics_name, wait)
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    metrics_name = "async"
+
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def to_async_url(url: str) -> str:
+    """postgresql://... -> postgresql+asyncpg://..."""
+    scheme, rest = url.split("://", 1)
+    return f"{ASYNC_DRIVERS[scheme.split('+')[0]]}://{rest}"
+
+
+def _engine_kwargs(url: str, profile: dict, is_async: bool) -> dict:
+    kwargs = {
+        "poolclass": TimedAsyncQueuePool if is_async else TimedQueuePool,
+        "pool_size": profile["pool_size"],
+        "max_overflow": profile["max_overflow"],
+        "pool_timeout": profile["pool_timeout"],
+    }
+    if "pool_recycle" in profile:
+        kwargs["pool_recycle"] = profile["pool_recycle"]
+    if profile.get("pool_pre_ping"):
+        kwargs["pool_pre_ping"] = True
+
+    timeout_ms = profile.get("statement_timeout_ms")
+    if url.startswith("sqlite"):
+        if not is_async:
+            kwargs["connect_args"] = {"check_same_thread": False}
+    elif timeout_ms:
+        if is_async:
+            kwargs["connect_args"] = {"server_settings": {"statement_timeout": str(timeout_ms)}}
+        else:
+            kwargs["connect_args"] = {"options": f"-c statement_timeout={timeout_ms}"}
+    return kwargs
+
+
+def _install_pragmas(sync_engine, pragmas: dict):
+    if not pragmas:
+        return
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def make_engine(url: str, profile_name: str):
+    """Синхронный engine с настройками профиля"""
+    profile = get_profile(profile_name)
+    sync_engine = create_engine(url, **_engine_kwargs(url, profile, is_async=False))
+    _install_pragmas(sync_engine, profile.get("pragmas"))
+    return sync_engine
+
+
+def make_async_engine(url: str, profile_name: str):
+    """Асинхронный engine с настройками профиля"""
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    profile = get_profile(profile_name)
+    async_url = to_async_url(url)
+    engine_ = create_async_engine(async_url, **_engine_kwargs(async_url, profile, is_async=True))
+    _install_pragmas(engine_.sync_engine, profile.get("pragmas"))
+    return engine_
+
+
 # Создаём engine
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-else:
-    engine = create_engine(DATABASE_URL)
+engine = make_engine(DATABASE_URL, DB_PROFILE)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -27,4 +207,202 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+# === Асинхронный доступ к БД ===
+#
+# DB_MODE:
+#   async   — AsyncSession на асинхронном драйвере (asyncpg / aiosqlite)
+#   threads — синхронная Session в ограниченном пуле потоков (по умолчанию для SQLite)
+#   inline  — синхронные вызовы прямо в event loop (старое поведение, для отладки и бенчмарков)
+
+DB_MODE = os.getenv("DB_MODE", "threads" if IS_SQLITE else "async").lower()
+DB_THREADS = int(os.getenv("DB_THREADS", "8"))
+
+if DB_MODE not in ("async", "threads", "inline"):
+    raise ValueError(f"Unknown DB_MODE: {DB_MODE}")
+
+
+async_engine = None
+AsyncSessionLocal = None
+
+if DB_MODE == "async":
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    async_engine = make_async_engine(DATABASE_URL, DB_PROFILE)
+    # expire_on_commit=False: после commit объекты читаются без похода в БД
+    AsyncSessionLocal = async_sessionmaker(
+        async_engine, autoflush=False, expire_on_commit=False
+    )
+
+# Сессии для потокового режима тоже не протухают после commit —
+# иначе чтение атрибута в event loop сделало бы блокирующий запрос
+ThreadSessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+)
+
+_executor = None
+_session_slots = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+    return _executor
+
+
+def get_session_slots() -> asyncio.Semaphore:
+    # Сессий не больше, чем потоков: иначе потоки блокируются на checkout из пула,
+    # а запросы, держащие соединения, не могут получить поток, чтобы их вернуть
+    global _session_slots
+    if _session_slots is None:
+        _session_slots = asyncio.Semaphore(DB_THREADS)
+    return _session_slots
+
+
+def _rollback_on_error(session: Session, fn, *args, **kwargs):
+    # Транзакция, прерванная исключением, откатывается в том же потоке: иначе блокировки
+    # записи держатся до close, а close ждёт свободный поток БД — их могут занять как раз
+    # запросы, которые ждут этих блокировок
+    try:
+        return fn(session, *args, **kwargs)
+    except BaseException:
+        try:
+            session.rollback()
+        except Exception:
+            pass
+        raise
+
+
+class AsyncDB:
+    """
+    Сессия на один запрос. Выполняет синхронные функции crud (fn(db, ...))
+    так, чтобы они не блокировали event loop.
+    replica — реплика для чтения (app.replicas); если она отказала, чтение повторяется на основной БД.
+    shard — шард с данными игроков (app.shards)
+    """
+
+    def __init__(self, mode: str = None, replica=None, shard=None):
+        self.mode = mode or DB_MODE
+        self.replica = replica
+        self.shard = shard
+        self._session = None
+
+    async def _open(self):
+        bind = self.replica or self.shard
+        if self.mode == "async":
+            self._session = (bind.async_sessions if bind is not None else AsyncSessionLocal)()
+        else:
+            await get_session_slots().acquire()
+            if bind is not None:
+                self._session = bind.sessions()
+            elif self.mode == "threads":
+                self._session = ThreadSessionLocal()
+            else:
+                self._session = SessionLocal()
+        if self.replica is not None:
+            self.replica.inflight += 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Выполнить fn(session, *args, **kwargs)"""
+        if self._session is None:
+            await self._open()
+        session = self._session
+        # SQL из fn попадёт в метрики под её именем
+        token = metrics.current_source.set(getattr(fn, "__name__", "other"))
+        try:
+            if self.mode == "async":
+                # run_sync исполняет ORM-код на асинхронном драйвере через greenlet
+                return await session.run_sync(_rollback_on_error, fn, *args, **kwargs)
+            if self.mode == "inline":
+                return _rollback_on_error(session, fn, *args, **kwargs)
+            # Контекст копируется в поток, чтобы счётчики запроса видели его SQL
+            call = partial(contextvars.copy_context().run, _rollback_on_error, session, fn, *args, **kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_executor(), call)
+        except exc.OperationalError:
+            if self.replica is None or fn is Session.close:
+                raise
+            # Реплика недоступна: выводим её из ротации, чтение повторяем на основной БД
+            self.replica.eject("query failed")
+        finally:
+            metrics.current_source.reset(token)
+        await self.use_primary()
+        return await self.run(fn, *args, **kwargs)
+
+    async def use_primary(self):
+        """Дальше читать с основной БД (реплика отказала или ещё не видит нужных данных)"""
+        if self.replica is None:
+            return
+        try:
+            await self.close()
+        except exc.DBAPIError:
+            pass
+        self.replica = None
+
+    async def add(self, obj):
+        if self._session is None:
+            await self._open()
+        self._session.add(obj)
+
+    async def commit(self):
+        await self.run(Session.commit)
+
+    async def close(self):
+        if self._session is None:
+            return
+        try:
+            if self.mode == "async":
+                await self._session.close()
+            else:
+                await self.run(Session.close)
+        finally:
+            self._session = None
+            if self.replica is not None:
+                self.replica.inflight -= 1
+            if self.mode != "async":
+                get_session_slots().release()
+
+
+def db_concurrency() -> int:
+    """Сколько сессий воркер может держать одновременно: потоки БД или ёмкость async-пула"""
+    if async_engine is not None:
+        pool = async_engine.sync_engine.pool
+        return pool.size() + max(pool._max_overflow, 0)
+    return DB_THREADS
+
+
+def pool_stats() -> dict:
+    """Состояние пулов: занятость и время ожидания checkout"""
+    engines = {"sync": engine}
+    if async_engine is not None:
+        engines["async"] = async_engine.sync_engine
+
+    result = {}
+    for name, eng in engines.items():
+        pool = eng.pool
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        checked_out = pool.checkedout()
+        stats = pool.stats
+        result[name] = {
+            "profile": DB_PROFILE,
+            "size": pool.size(),
+            "capacity": capacity,
+            "checked_out": checked_out,
+            "saturation": round(checked_out / capacity, 3) if capacity else 0.0,
+            "checkouts": stats.checkouts,
+            "timeouts": stats.timeouts,
+            "wait_avg_ms": round(stats.wait_total / stats.checkouts * 1000, 3) if stats.checkouts else 0.0,
+            "wait_max_ms": round(stats.wait_max * 1000, 3),
+        }
+    return result
+
+
+async def get_async_db():
+    db = AsyncDB()
+    try:
+        yield db
+    finally:
+        await db.close()
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import delete, event, func, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import AsyncDB
+
+logger = logging.getLogger(__name__)
+
+# === Версии инвентаря ===
+#
+# У каждого игрока счётчик изменений инвентаря (inventory_versions). Любое изменение
+# стопки в транзакции сначала поднимает счётчик, затем пишет новую версию в саму
+# стопку; удалённая стопка оставляет запись в inventory_tombstones. Строка счётчика
+# заблокирована до commit, поэтому версии игрока коммитятся строго по порядку.
+#
+# Клиент хранит версию последнего ответа и получает либо 304 (версия не изменилась —
+# это один запрос к inventory_versions, без чтения стопок), либо только изменённые
+# стопки и id удалённых. Записи об удалениях старше срока хранения вычищаются;
+# от версии раньше вычищенной клиент получает инвентарь целиком.
+
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("INVENTORY_TOMBSTONE_RETENTION_DAYS", "7"))
+INVENTORY_PRUNE_INTERVAL = float(os.getenv("INVENTORY_PRUNE_INTERVAL", "3600"))
+
+_SESSION_KEY = "inventory_versions"
+
+
+def bump(db: Session, player_id: int) -> int:
+    """
+    Новая версия инвентаря игрока для текущей транзакции: один upsert на игрока,
+    повторные изменения в той же транзакции получают ту же версию. Без commit
+    """
+    versions = db.info.setdefault(_SESSION_KEY, {})
+    version = versions.get(player_id)
+    if version is not None:
+        return version
+
+    counters = models.InventoryVersion.__table__
+    stmt = (pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert)(counters)
+    stmt = stmt.values(player_id=player_id, version=1, pruned_version=0).on_conflict_do_update(
+        index_elements=["player_id"],
+        set_={"version": counters.c.version + 1},
+    ).returning(counters.c.version)
+    version = versions[player_id] = db.execute(stmt).scalar_one()
+    return version
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _forget_versions(session):
+    session.info.pop(_SESSION_KEY, None)
+
+
+def record_deleted(db: Session, player_id: int, item_ids: List[int], version: int):
+    """Запомнить удалённые стопки. Без commit — в транзакции удаления"""
+    if not item_ids:
+        return
+    deleted_at = datetime.utcnow()
+    db.execute(insert(models.InventoryTombstone), [
+        {"player_id": player_id, "item_id": item_id, "version": version, "deleted_at": deleted_at}
+        for item_id in item_ids
+    ])
+
+
+def current_version(db: Session, player_id: int) -> Tuple[int, int]:
+    """(версия, вычищенная версия) игрока. (0, 0) — инвентарь ещё не менялся"""
+    row = db.execute(
+        select(models.InventoryVersion.version, models.InventoryVersion.pruned_version)
+        .where(models.InventoryVersion.player_id == player_id)
+    ).first()
+    return (row.version, row.pruned_version) if row else (0, 0)
+
+
+def get_inventory(db: Session, player_id: int) -> Tuple[List[models.InventoryItem], int]:
+    """Весь инвентарь и его версия одним запросом — из одного снимка БД"""
+    version = select(models.InventoryVersion.version).where(
+        models.InventoryVersion.player_id == player_id
+    ).scalar_subquery()
+    rows = db.execute(
+        select(models.InventoryItem, version).where(models.InventoryItem.player_id == player_id)
+    ).all()
+    if not rows:
+        return [], current_version(db, player_id)[0]
+    return [item for item, _ in rows], rows[0][1] or 0
+
+
+def get_changes(db: Session, player_id: int, since: int) -> Tuple[List[models.InventoryItem], List[int]]:
+    """
+    Стопки, изменённые после версии since, и id удалённых после неё.
+    Версию ответа вызывающий читает заранее (current_version): изменения новее неё
+    могут попасть в ответ и придут повторно в следующий раз — это безопасно
+    """
+    items = db.query(models.InventoryItem).filter(
+        models.InventoryItem.player_id == player_id,
+        models.InventoryItem.version > since
+    ).all()
+    changed = {item.id for item in items}
+    # SQLite может выдать id удалённой стопки новой — такая стопка отдаётся как изменённая
+    deleted = [
+        item_id for item_id in db.scalars(
+            select(models.InventoryTombstone.item_id).where(
+                models.InventoryTombstone.player_id == player_id,
+                models.InventoryTombstone.version > since
+            ).distinct()
+        )
+        if item_id not in changed
+    ]
+    return items, deleted
+
+
+def prune(db: Session, now: Optional[float] = None) -> int:
+    """Вычистить записи об удалениях старше срока хранения. Возвращает число удалённых строк"""
+    now = time.time() if now is None else now
+    cutoff = datetime.utcfromtimestamp(now) - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    tombstones = models.InventoryTombstone
+    counters = models.InventoryVersion
+
+    # Сначала поднять границу: клиент с версией раньше неё получит инвентарь целиком
+    expired = tombstones.deleted_at < cutoff
+    db.execute(
+        update(counters)
+        .where(counters.player_id.in_(select(tombstones.player_id).where(expired)))
+        .values(pruned_version=select(func.max(tombstones.version)).where(
+            tombstones.player_id == counters.player_id, expired
+        ).scalar_subquery())
+        .execution_options(synchronize_session=False)
+    )
+    deleted = db.execute(delete(tombstones).where(tombstones.deleted_at < cutoff)).rowcount
+    db.commit()
+    return deleted
+
+
+async def prune_loop(interval: float = INVENTORY_PRUNE_INTERVAL, sessions: Callable[[], List[AsyncDB]] = None):
+    """
+    Периодическая очистка удалений. Запускается из lifespan, останавливается отменой задачи.
+    sessions — по сессии на каждую БД с игроками (шарды), по умолчанию основная БД
+    """
+    while True:
+        for db in sessions() if sessions is not None else [AsyncDB()]:
+            try:
+                deleted = await db.run(prune)
+                if deleted:
+                    logger.info("Inventory sync pruned %d tombstones", deleted)
+            except Exception:
+                logger.exception("Inventory tombstone pruning failed")
+            finally:
+                await db.close()
+        await asyncio.sleep(interval)
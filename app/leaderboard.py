@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import os
+import threading
+from array import array
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import ledger, models
+from .database import AsyncDB
+from .shards import shard_router
+
+logger = logging.getLogger(__name__)
+
+# === Таблица лидеров ===
+#
+# По каждой метрике (уровень, золото, кристаллы) в памяти воркера лежит
+# упорядоченный индекс: место игрока, топ-N и окно «вокруг меня» — O(log n)
+# вместо COUNT(*) по всей таблице players.
+#
+# Индекс строится из БД при первом обращении (как стаканы биржи) и обновляется
+# по событиям журнала экономики после commit — то есть на каждое изменение золота
+# и кристаллов через currency.change_balance. Изменения из других воркеров и в обход
+# журнала подтягивает периодическая сверка с БД небольшими порциями.
+
+METRICS = ("level", "gold", "crystals")
+
+LEADERBOARD_RECONCILE_INTERVAL = float(os.getenv("LEADERBOARD_RECONCILE_INTERVAL", "300"))
+RECONCILE_CHUNK = 5000
+LOAD_BATCH = 10000
+
+# Ключ индекса — одно целое: меньше ключ — выше место. Больше очков — выше,
+# при равенстве выше тот, кто зарегистрировался раньше (меньший id)
+_ID_SPACE = 1 << 32
+_MISSING = -(1 << 63)
+
+
+def _key(score: int, player_id: int) -> int:
+    return -score * _ID_SPACE + player_id
+
+
+def _unkey(key: int) -> Tuple[int, int]:
+    player_id = key % _ID_SPACE
+    return player_id, -((key - player_id) // _ID_SPACE)
+
+
+class RankIndex:
+    """
+    Упорядоченный список целых с поиском по позиции: отсортированные блоки
+    до 2 * LOAD элементов и дерево Фенвика по их длинам.
+    Позиция ключа и ключ по позиции — O(log n), вставка — O(log n) + сдвиг внутри блока
+    """
+
+    LOAD = 1000
+
+    def __init__(self, keys: Iterable[int] = ()):
+        keys = sorted(keys)
+        self._lists = [keys[i:i + self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self._maxes = [lst[-1] for lst in self._lists]
+        self._len = len(keys)
+        self._rebuild()
+
+    def __len__(self):
+        return self._len
+
+    def _rebuild(self):
+        # Дерево Фенвика по длинам блоков; перестраивается только при делении и удалении блока
+        size = len(self._lists)
+        tree = [0] * (size + 1)
+        for i, lst in enumerate(self._lists, 1):
+            tree[i] += len(lst)
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._top_bit = 1 << (size.bit_length() - 1) if size else 0
+
+    def _tree_add(self, block: int, delta: int):
+        i = block + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _before(self, block: int) -> int:
+        """Число элементов в блоках до block"""
+        total = 0
+        tree = self._tree
+        while block:
+            total += tree[block]
+            block -= block & -block
+        return total
+
+    def _locate(self, position: int) -> Tuple[int, int]:
+        """(блок, смещение в блоке) для позиции"""
+        block = 0
+        tree = self._tree
+        step = self._top_bit
+        while step:
+            nxt = block + step
+            if nxt < len(tree) and tree[nxt] <= position:
+                block = nxt
+                position -= tree[nxt]
+            step >>= 1
+        return block, position
+
+    def add(self, key: int):
+        if not self._lists:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._rebuild()
+            return
+        block = bisect_left(self._maxes, key)
+        if block == len(self._maxes):
+            block -= 1
+        lst = self._lists[block]
+        insort(lst, key)
+        self._maxes[block] = lst[-1]
+        self._len += 1
+        if len(lst) > 2 * self.LOAD:
+            self._lists[block:block + 1] = [lst[:self.LOAD], lst[self.LOAD:]]
+            self._maxes[block:block + 1] = [lst[self.LOAD - 1], lst[-1]]
+            self._rebuild()
+        else:
+            self._tree_add(block, 1)
+
+    def remove(self, key: int):
+        block = bisect_left(self._maxes, key)
+        if block == len(self._maxes):
+            raise KeyError(key)
+        lst = self._lists[block]
+        offset = bisect_left(lst, key)
+        if offset == len(lst) or lst[offset] != key:
+            raise KeyError(key)
+        del lst[offset]
+        self._len -= 1
+        if lst:
+            self._maxes[block] = lst[-1]
+            self._tree_add(block, -1)
+        else:
+            del self._lists[block]
+            del self._maxes[block]
+            self._rebuild()
+
+    def position(self, key: int) -> int:
+        """Сколько ключей меньше key"""
+        block = bisect_left(self._maxes, key)
+        if block == len(self._maxes):
+            return self._len
+        return self._before(block) + bisect_left(self._lists[block], key)
+
+    def slice(self, start: int, count: int) -> List[int]:
+        if start >= self._len or count <= 0:
+            return []
+        block, offset = self._locate(max(start, 0))
+        result = []
+        while block < len(self._lists) and len(result) < count:
+            result.extend(self._lists[block][offset:offset + count - len(result)])
+            block += 1
+            offset = 0
+        return result
+
+
+class Leaderboard:
+    """Индексы всех метрик воркера. Обновления приходят из потоков БД — всё под одной блокировкой"""
+
+    def __init__(self):
+        self.loaded = False
+        self.corrections = 0
+        self._lock = threading.Lock()
+        self._load_lock = asyncio.Lock()
+        self._pending: Optional[list] = None
+        self._reset()
+
+    def _reset(self):
+        self._indexes: Dict[str, RankIndex] = {metric: RankIndex() for metric in METRICS}
+        # Очки по id игрока (id плотные — массив компактнее словаря); _MISSING — игрока нет
+        self._scores: Dict[str, array] = {metric: array("q") for metric in METRICS}
+        # Номер последнего изменения игрока — сверка не затирает более свежие значения
+        self._updated = array("q")
+        self._seq = 0
+
+    def _grow(self, player_id: int):
+        size = len(self._updated)
+        if player_id < size:
+            return
+        extra = max(player_id + 1, size + size // 2) - size
+        for scores in self._scores.values():
+            scores.extend(array("q", [_MISSING]) * extra)
+        self._updated.extend(array("q", [0]) * extra)
+
+    def _set(self, player_id: int, metric: str, value: int):
+        self._grow(player_id)
+        scores = self._scores[metric]
+        old = scores[player_id]
+        if old == value:
+            return
+        index = self._indexes[metric]
+        if old != _MISSING:
+            index.remove(_key(old, player_id))
+        index.add(_key(value, player_id))
+        scores[player_id] = value
+        self._seq += 1
+        self._updated[player_id] = self._seq
+
+    def update(self, player_id: int, metric: str, value: int):
+        with self._lock:
+            if self.loaded:
+                self._set(player_id, metric, value)
+            elif self._pending is not None:
+                # Индекс строится — применим после загрузки в порядке commit
+                self._pending.append((player_id, metric, value))
+
+    def _on_commit(self, events: list):
+        for _, player_id, kind, asset, _, balance, _ in events:
+            if kind == "currency" and asset in self._scores and balance is not None:
+                self.update(player_id, asset, balance)
+
+    # --- Загрузка и сверка ---
+
+    def _load(self, db: Session, ids: array, values: Dict[str, array]):
+        columns = [models.Player.id] + [getattr(models.Player, metric) for metric in METRICS]
+        self._append_rows(db.execute(select(*columns).execution_options(yield_per=LOAD_BATCH)), ids, values)
+        db.rollback()
+
+    @staticmethod
+    def _append_rows(rows: Iterable[tuple], ids: array, values: Dict[str, array]):
+        for row in rows:
+            ids.append(row[0])
+            for metric, value in zip(METRICS, row[1:]):
+                values[metric].append(value or 0)
+
+    def load_rows(self, rows: Iterable[tuple]):
+        """Построить индексы из строк (id, level, gold, crystals) и применить отложенные обновления"""
+        ids = array("q")
+        values = {metric: array("q") for metric in METRICS}
+        self._append_rows(rows, ids, values)
+        self._install(ids, values)
+
+    def _install(self, ids: array, values: Dict[str, array]):
+        size = (max(ids) + 1) if ids else 0
+        scores = {}
+        indexes = {}
+        for metric in METRICS:
+            column = array("q", [_MISSING]) * size
+            for player_id, value in zip(ids, values[metric]):
+                column[player_id] = value
+            scores[metric] = column
+            indexes[metric] = RankIndex(map(_key, values[metric], ids))
+
+        with self._lock:
+            self._indexes = indexes
+            self._scores = scores
+            self._updated = array("q", [0]) * size
+            self._seq = 0
+            self.loaded = True
+            pending, self._pending = self._pending or [], None
+            for player_id, metric, value in pending:
+                self._set(player_id, metric, value)
+
+    async def ensure_loaded(self, db: AsyncDB):
+        if self.loaded:
+            return
+        async with self._load_lock:
+            if self.loaded:
+                return
+            with self._lock:
+                self._pending = []
+            ids = array("q")
+            values = {metric: array("q") for metric in METRICS}
+            try:
+                if shard_router.sharded:
+                    # Игроки на всех шардах; id уникальны, общий индекс строится из всех
+                    for shard_db in shard_router.player_sessions():
+                        try:
+                            await shard_db.run(self._load, ids, values)
+                        finally:
+                            await shard_db.close()
+                else:
+                    await db.run(self._load, ids, values)
+                await asyncio.to_thread(self._install, ids, values)
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+
+    def _reconcile_chunk(self, db: Session, after_id: int) -> Optional[int]:
+        """Сверить игроков с id > after_id. Возвращает последний id порции или None в конце"""
+        with self._lock:
+            seq = self._seq
+        columns = [models.Player.id] + [getattr(models.Player, metric) for metric in METRICS]
+        rows = db.execute(
+            select(*columns).where(models.Player.id > after_id).order_by(models.Player.id).limit(RECONCILE_CHUNK)
+        ).all()
+        # Закрыть транзакцию чтения, чтобы следующая порция видела свежие данные
+        db.rollback()
+        if not rows:
+            return None
+
+        with self._lock:
+            for row in rows:
+                player_id = row[0]
+                if player_id < len(self._updated) and self._updated[player_id] > seq:
+                    continue
+                self._grow(player_id)
+                for metric, value in zip(METRICS, row[1:]):
+                    value = value or 0
+                    if self._scores[metric][player_id] != value:
+                        self._set(player_id, metric, value)
+                        self.corrections += 1
+        return rows[-1][0]
+
+    async def reconcile(self, db: AsyncDB) -> int:
+        before = self.corrections
+        last_id = 0
+        while last_id is not None:
+            last_id = await db.run(self._reconcile_chunk, last_id)
+        return self.corrections - before
+
+    # --- Запросы ---
+
+    def total(self, metric: str) -> int:
+        return len(self._indexes[metric])
+
+    def top(self, metric: str, offset: int, limit: int) -> List[Tuple[int, int, int]]:
+        """[(место, id игрока, очки)], места с 1"""
+        with self._lock:
+            keys = self._indexes[metric].slice(offset, limit)
+        return [(offset + i + 1, *_unkey(key)) for i, key in enumerate(keys)]
+
+    def rank(self, metric: str, player_id: int) -> Optional[Tuple[int, int]]:
+        """(место, очки) или None, если игрока нет в индексе"""
+        with self._lock:
+            scores = self._scores[metric]
+            if player_id >= len(scores) or scores[player_id] == _MISSING:
+                return None
+            score = scores[player_id]
+            return self._indexes[metric].position(_key(score, player_id)) + 1, score
+
+    def add_player(self, player: models.Player):
+        """Игрок, которого ещё нет в индексе (создан после загрузки)"""
+        with self._lock:
+            for metric in METRICS:
+                self._set(player.id, metric, getattr(player, metric) or 0)
+
+    def stats(self) -> dict:
+        return {"players": self.total("gold"), "corrections": self.corrections, "loaded": self.loaded}
+
+
+leaderboard = Leaderboard()
+ledger.on_commit(leaderboard._on_commit)
+
+
+async def reconcile_loop(interval: float = LEADERBOARD_RECONCILE_INTERVAL):
+    """Периодическая сверка с БД. Запускается из lifespan, останавливается отменой задачи"""
+    while True:
+        await asyncio.sleep(interval)
+        if not leaderboard.loaded:
+            continue
+        for db in shard_router.player_sessions():
+            try:
+                corrected = await leaderboard.reconcile(db)
+                if corrected:
+                    logger.info("Leaderboard reconciliation corrected %d scores", corrected)
+            except Exception:
+                logger.exception("Leaderboard reconciliation failed")
+            finally:
+                await db.close()
@@ -0,0 +1,206 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import engine
+
+logger = logging.getLogger(__name__)
+
+# === Журнал экономики ===
+#
+# Изменения валюты и предметов копятся в session.info и после commit уходят
+# компактными кортежами в очередь процесса. Фоновый поток пишет их в
+# ledger_entries пачками — по размеру пачки или по таймеру. Откат транзакции
+# выбрасывает накопленные события, так что в журнал попадает только то, что
+# реально записано в БД.
+#
+# Журнал — аудит: scripts/ledger_replay.py сверяет его с балансами, поэтому события
+# не выбрасываются. Переполненная очередь — backpressure: commit ждёт, пока поток
+# разгрузит её (не дольше LEDGER_EMIT_TIMEOUT), затем пишет события сам. Потеря
+# возможна, только если и эта запись не прошла: ERROR в лог и метрика ledger_dropped.
+
+LEDGER_FLUSH_SIZE = int(os.getenv("LEDGER_FLUSH_SIZE", "500"))
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "1.0"))
+LEDGER_MAX_PENDING = int(os.getenv("LEDGER_MAX_PENDING", "100000"))
+LEDGER_EMIT_TIMEOUT = float(os.getenv("LEDGER_EMIT_TIMEOUT", "1.0"))
+
+_SESSION_KEY = "ledger_events"
+
+_COLUMNS = ("created_at", "player_id", "kind", "asset", "delta", "balance", "reason")
+
+
+def record(
+    db: Session,
+    player_id: int,
+    kind: str,
+    asset: str,
+    delta: Optional[int],
+    balance: Optional[int] = None,
+    reason: str = "",
+):
+    """Запомнить изменение в текущей транзакции. kind: currency / item"""
+    if delta == 0:
+        return
+    db.info.setdefault(_SESSION_KEY, []).append(
+        (datetime.utcnow(), player_id, kind, asset, delta, balance, reason)
+    )
+
+
+class LedgerWriter:
+    """Очередь событий и фоновый поток, который сбрасывает её в БД пачками"""
+
+    def __init__(
+        self, bind, flush_size: int, flush_interval: float, max_pending: int, emit_timeout: float = LEDGER_EMIT_TIMEOUT
+    ):
+        self.bind = bind
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.emit_timeout = emit_timeout
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.flushes = 0
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._drained = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def emit(self, events: list):
+        # deque.append/extend потокобезопасны; лишних блокировок на горячем пути нет
+        if len(self._queue) + len(events) > self.max_pending and not self._wait_for_room(len(events)):
+            self._write_now(events)
+            return
+        self._queue.extend(events)
+        if self._thread is None:
+            self.start()
+        if len(self._queue) >= self.flush_size:
+            self._wakeup.set()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="ledger-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Остановить поток, дописав всё, что осталось в очереди"""
+        thread = self._thread
+        if thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _wait_for_room(self, count: int) -> bool:
+        """Backpressure: ждать, пока поток разгрузит очередь. False — не дождались за emit_timeout"""
+        if self._thread is None:
+            self.start()
+        deadline = time.monotonic() + self.emit_timeout
+        while len(self._queue) + count > self.max_pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._drained.clear()
+            self._wakeup.set()
+            self._drained.wait(remaining)
+        return True
+
+    def _write_now(self, events: list):
+        """Очередь так и не освободилась — пишем в потоке commit, мимо очереди"""
+        try:
+            with self.bind.begin() as conn:
+                conn.execute(insert(models.LedgerEntry), [dict(zip(_COLUMNS, event_)) for event_ in events])
+        except Exception:
+            self.dropped += len(events)
+            logger.exception("Ledger queue is full and direct write failed: %d events lost", len(events))
+            return
+        self.written += len(events)
+        self.spilled += len(events)
+
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def flush(self) -> int:
+        written = 0
+        while self._queue:
+            batch = []
+            while self._queue and len(batch) < self.flush_size:
+                batch.append(self._queue.popleft())
+            rows = [dict(zip(_COLUMNS, event_)) for event_ in batch]
+            try:
+                with self.bind.begin() as conn:
+                    conn.execute(insert(models.LedgerEntry), rows)
+            except Exception:
+                logger.exception("Ledger flush failed, %d events returned to queue", len(batch))
+                self._queue.extendleft(reversed(batch))
+                break
+            written += len(batch)
+            self.flushes += 1
+        self.written += written
+        self._drained.set()
+        return written
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            if self._queue and not self._stopping:
+                # БД недоступна — не крутимся в цикле
+                time.sleep(self.flush_interval)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._queue),
+            "written": self.written,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+        }
+
+
+ledger_writer = LedgerWriter(engine, LEDGER_FLUSH_SIZE, LEDGER_FLUSH_INTERVAL, LEDGER_MAX_PENDING)
+atexit.register(ledger_writer.stop)
+
+_commit_listeners = []
+
+
+def on_commit(listener):
+    """
+    Подписка на события закоммиченных транзакций: listener(events) с кортежами как в _COLUMNS.
+    Вызывается в потоке, который сделал commit, — должен быть быстрым и потокобезопасным
+    """
+    _commit_listeners.append(listener)
+
+
+@event.listens_for(Session, "after_commit")
+def _emit_after_commit(session):
+    events = session.info.pop(_SESSION_KEY, None)
+    if events:
+        ledger_writer.emit(events)
+        for listener in _commit_listeners:
+            try:
+                listener(events)
+            except Exception:
+                # Транзакция уже записана — ошибка подписчика не должна долетать до запроса
+                logger.exception("Ledger commit listener failed")
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_rollback(session):
+    session.info.pop(_SESSION_KEY, None)
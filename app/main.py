@@ -1,18 +1,90 @@
-
+import asyncio
+import json
 import os
-from fastapi import FastAPI, Depends, HTTPException, Header
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
+from fastapi import FastAPI, Depends, HTTPException, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
 from typing import List, Optional
 
-from . import models, schemas, crud
-from .database import engine, get_db
-from .vk_auth import verify_vk_signature, get_vk_user_id
+from . import models, schemas, crud, currency, inventory_sync, metrics, migrations, price_history, shard_market, shards
+from .admission import AdmissionController, AdmissionMiddleware, RateLimiter, retry_after_header
+from .database import engine, async_engine, IS_SQLITE, AsyncDB, get_async_db, pool_stats, db_concurrency
+from .vk_auth import parse_vk_params, verify_vk_signature, get_vk_user_id
+from .cache import Snapshot, SnapshotCache, TTLCache
+from .orderbook import matching_engine
+from .ledger import ledger_writer
+from .leaderboard import METRICS as LEADERBOARD_METRICS, leaderboard, reconcile_loop as leaderboard_reconcile_loop
+from .market_feed import FEED_HEARTBEAT, LISTING_EVENTS, market_hub
+from .replicas import WRITE_METHODS, get_read_db, health_loop as replica_health_loop, read_router
+from .shards import delivery_loop as shard_delivery_loop, shard_router
+
+# Счётчики SQL на engine; сами соединения открываются при первом запросе
+metrics.instrument_engine(engine)
+if async_engine is not None:
+    metrics.instrument_engine(async_engine.sync_engine)
+for replica in read_router.replicas:
+    metrics.instrument_engine(replica.engine)
+    if replica.async_engine is not None:
+        metrics.instrument_engine(replica.async_engine.sync_engine)
+for shard in shard_router.shards:
+    if not shard.shared:
+        metrics.instrument_engine(shard.engine)
+        if shard.async_engine is not None:
+            metrics.instrument_engine(shard.async_engine.sync_engine)
+
+# Схемой управляет python -m app.migrations (release-фаза деплоя).
+# Для локальной SQLite по умолчанию миграции применяются при старте
+AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true" if IS_SQLITE else "false").lower() == "true"
+
 
-# Создаём таблицы
-models.Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Старт воркера — только проверка версии схемы; стаканы биржи грузятся при первом обращении"""
+    for bind in [engine] + shard_router.engines():
+        if AUTO_MIGRATE:
+            migrations.upgrade(bind)
+        else:
+            migrations.check(bind)
+    background = [
+        asyncio.create_task(price_history.compaction_loop()),
+        asyncio.create_task(leaderboard_reconcile_loop()),
+        asyncio.create_task(inventory_sync.prune_loop(sessions=shard_router.player_sessions)),
+    ]
+    if read_router.replicas:
+        background.append(asyncio.create_task(replica_health_loop()))
+    if shard_router.sharded:
+        background.append(asyncio.create_task(shard_delivery_loop()))
+    await market_hub.start()
+    yield
+    for task in background:
+        task.cancel()
+    await market_hub.stop()
+    # Дописать журнал экономики и закрыть соединения перед остановкой воркера
+    ledger_writer.stop()
+    engine.dispose()
+    if async_engine is not None:
+        await async_engine.dispose()
+    await read_router.dispose()
+    await shard_router.dispose()
 
-app = FastAPI(title="MMORPG Game API")
+
+app = FastAPI(title="MMORPG Game API", lifespan=lifespan)
+
+# Запросов в работе не больше, чем воркер может обслужить, остальные — в короткой
+# очереди с приоритетами; переполнение очереди — быстрый 503. По умолчанию слотов
+# вдвое больше сессий БД: часть времени запрос проводит не в базе. 0 — без ограничения
+admission = AdmissionController(
+    max_inflight=int(os.getenv("ADMISSION_MAX_INFLIGHT", str(2 * db_concurrency()))),
+    max_queue=int(os.getenv("ADMISSION_QUEUE", "128")),
+    max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "2")),
+)
+# Внутри CORS — чтобы у 503 были CORS-заголовки и браузер увидел Retry-After
+app.add_middleware(AdmissionMiddleware, controller=admission)
 
 # CORS для фронтенда
 app.add_middleware(
@@ -21,30 +93,176 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[metrics.QUERY_COUNT_HEADER, metrics.DB_TIME_HEADER, "ETag", "Retry-After"],
 )
+# Снаружи CORS — чтобы мерить запрос целиком
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 # === Проверка авторизации ===
 
-async def verify_auth(x_vk_params: str = Header(None), db: Session = Depends(get_db)):
+# Сырые X-VK-Params -> AuthContext. Клиент шлёт один и тот же заголовок всю сессию
+auth_cache = TTLCache(
+    maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("AUTH_CACHE_TTL", "600")),
+)
+
+# Запросов в секунду на игрока (vk_id) в этом воркере; 0 — без ограничения
+rate_limiter = RateLimiter(
+    rate=float(os.getenv("RATE_LIMIT_RPS", "10")),
+    burst=float(os.getenv("RATE_LIMIT_BURST", "30")),
+)
+
+
+def _check_rate_limit(auth: schemas.AuthContext):
+    retry_after = rate_limiter.acquire(auth.vk_id)
+    if retry_after:
+        metrics.rate_limited.inc()
+        raise HTTPException(
+            status_code=429, detail="Too many requests",
+            headers={"Retry-After": retry_after_header(retry_after)}
+        )
+
+
+async def verify_auth(
+    request: Request,
+    x_vk_params: str = Header(None),
+    db: AsyncDB = Depends(get_async_db)
+):
     """
-    Проверяет подпись VK и возвращает игрока
+    Проверяет подпись VK и возвращает vk_id и id игрока.
+    Запрос, меняющий данные, переводит чтения игрока на основную БД (read-your-writes)
     """
-    is_debug = os.getenv("DEBUG", "true").lower() == "true"
-    
     params = x_vk_params or "?vk_user_id=12345"
     
-    if not is_debug and not verify_vk_signature(params):
+    auth = auth_cache.get(params)
+    if auth is not None:
+        _check_rate_limit(auth)
+        if request.method in WRITE_METHODS:
+            read_router.note_write(auth.player_id)
+        return auth
+    
+    is_debug = os.getenv("DEBUG", "true").lower() == "true"
+    parsed = parse_vk_params(params)
+    
+    if not is_debug and not verify_vk_signature(parsed):
         raise HTTPException(status_code=401, detail="Invalid VK signature")
     
-    vk_id = get_vk_user_id(params)
+    vk_id = get_vk_user_id(parsed)
     if not vk_id:
         vk_id = 12345
     
-    player = crud.get_player_by_vk_id(db, vk_id)
+    if shard_router.sharded:
+        player_id, shard = await _shard_player(db, vk_id)
+    else:
+        player = await db.run(crud.get_player_by_vk_id, vk_id)
+        if not player:
+            player = await db.run(crud.create_player, vk_id)
+            # Реплики ещё не видят нового игрока
+            read_router.note_write(player.id)
+        player_id, shard = player.id, 0
+    # Чтения берут свою сессию (get_player_read_db) — слот сессии отпускаем сразу,
+    # иначе запросы, держащие по одному слоту, ждут второй друг у друга.
+    # Эндпоинты на get_async_db откроют сессию заново при первом запросе
+    await db.close()
+
+    auth = schemas.AuthContext(vk_id=vk_id, player_id=player_id, shard=shard)
+    auth_cache.set(params, auth)
+    _check_rate_limit(auth)
+    if request.method in WRITE_METHODS:
+        read_router.note_write(auth.player_id)
+    return auth
+
+
+async def _shard_player(db: AsyncDB, vk_id: int):
+    """
+    (id игрока, шард) по справочнику; новый игрок регистрируется в справочнике
+    и создаётся на своём шарде. Сессии глобальной БД и шарда открываются по очереди
+    """
+    entry = await db.run(shards.find_player, vk_id)
+    if entry is None:
+        entry = await db.run(shards.register_player, vk_id, shard_router.place(vk_id))
+    await db.close()
+
+    shard_db = shard_router.session(entry.shard)
+    try:
+        player = await shard_db.run(crud.get_player, entry.id)
+    finally:
+        await shard_db.close()
+    if player is None:
+        # Игрока нет на шарде: новый или прямо сейчас переносится. Справочник перечитывается
+        # после чтения шарда — перенос ставит moving_to раньше, чем удаляет игрока с источника
+        current = await db.run(shards.find_player, vk_id)
+        await db.close()
+        if current.moving_to is not None or current.shard != entry.shard:
+            raise shards.PlayerMoved(entry.id)
+        shard_db = shard_router.session(entry.shard)
+        try:
+            await shard_db.run(crud.create_player, vk_id, entry.id)
+        finally:
+            await shard_db.close()
+    return entry.id, entry.shard
+
+
+async def get_player_db(auth: schemas.AuthContext = Depends(verify_auth)):
+    """
+    Сессия для изменения данных игрока. При шардировании — шард игрока; забор (shards.fence)
+    не даёт перенести игрока до конца транзакции, а если он уже перенесён — 503
+    """
+    db = shard_router.session(auth.shard)
+    try:
+        if shard_router.sharded:
+            await db.run(shards.fence, auth.player_id)
+        yield db
+    finally:
+        await db.close()
+
+
+async def get_player_read_db(auth: schemas.AuthContext = Depends(verify_auth)):
+    """
+    Сессия для чтения данных игрока: реплика, кроме окна read-your-writes после его изменений.
+    При шардировании — шард игрока, реплики только у глобальной БД
+    """
+    if shard_router.sharded:
+        db = shard_router.session(auth.shard)
+    else:
+        db = read_router.session(auth.player_id)
+    try:
+        if shard_router.sharded:
+            await db.run(shards.fence, auth.player_id)
+        yield db
+    finally:
+        await db.close()
+
+
+@app.exception_handler(shards.PlayerMoved)
+async def player_moved_handler(request: Request, exc: shards.PlayerMoved):
+    # Маршрут игрока в кэше авторизации устарел — повтор пойдёт через справочник
+    auth_cache.pop(request.headers.get("x-vk-params") or "?vk_user_id=12345")
+    return JSONResponse(
+        status_code=503, content={"detail": "Player is being moved, try again"}, headers={"Retry-After": "1"}
+    )
+
+
+async def _read_player(db: AsyncDB, load, player_id: int):
+    """Игрок для чтения; реплика, которая его ещё не видит (создан только что), — повтор на основной БД"""
+    player = await db.run(load, player_id)
+    if player is None and db.replica is not None:
+        await db.use_primary()
+        player = await db.run(load, player_id)
+    return player
+
+
+async def current_player(
+    auth: schemas.AuthContext = Depends(verify_auth),
+    x_vk_params: str = Header(None),
+    db: AsyncDB = Depends(get_player_read_db)
+) -> models.Player:
+    """Загружает игрока по первичному ключу — только там, где нужны изменяемые поля"""
+    player = await _read_player(db, crud.get_player, auth.player_id)
     if not player:
-        player = crud.create_player(db, vk_id)
-    
+        auth_cache.pop(x_vk_params or "?vk_user_id=12345")
+        raise HTTPException(status_code=401, detail="Player not found")
     return player
 
 
@@ -52,12 +270,15 @@ async def verify_auth(x_vk_params: str = Header(None), db: Session = Depends(get
 
 @app.get("/api/player", response_model=schemas.PlayerResponse)
 async def get_player(
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    player: models.Player = Depends(current_player),
+    db: AsyncDB = Depends(get_player_read_db)
 ):
     """Получить данные игрока"""
-    equipment = player.equipment
-    
+    equipment = await db.run(crud.get_equipment, player.id)
+    return _player_response(player, equipment)
+
+
+def _player_response(player: models.Player, equipment: Optional[models.Equipment]) -> schemas.PlayerResponse:
     return schemas.PlayerResponse(
         id=player.id,
         vk_id=player.vk_id,
@@ -80,106 +301,203 @@ async def get_player(
     )
 
 
+@app.get("/api/bootstrap", response_model=schemas.BootstrapResponse)
+async def bootstrap(
+    auth: schemas.AuthContext = Depends(verify_auth),
+    x_vk_params: str = Header(None),
+    db: AsyncDB = Depends(get_player_read_db)
+):
+    """
+    Первый экран клиента: игрок, снаряжение, инвентарь и скины одним запросом
+    вместо /api/player + /api/inventory + скинов — четыре запроса к БД.
+    inventory_version — с неё клиент потом запрашивает /api/inventory/changes
+    """
+    # Версия читается до инвентаря: более свежие стопки в ответе клиент просто получит ещё раз
+    inventory_version, _ = await db.run(inventory_sync.current_version, auth.player_id)
+    player = await _read_player(db, crud.get_player_bootstrap, auth.player_id)
+    if not player:
+        auth_cache.pop(x_vk_params or "?vk_user_id=12345")
+        raise HTTPException(status_code=401, detail="Player not found")
+    
+    return schemas.BootstrapResponse(
+        player=_player_response(player, player.equipment),
+        inventory=[schemas.InventoryItemResponse.model_validate(item) for item in player.inventory],
+        inventory_version=inventory_version,
+        owned_skins=[skin.skin_id for skin in player.owned_skins]
+    )
+
+
+def _amount(data: dict) -> int:
+    amount = data.get("amount", 0)
+    # bool — подкласс int: {"amount": true} не должен стать единицей
+    if type(amount) is not int or amount < 0:
+        raise HTTPException(status_code=400, detail="Invalid amount")
+    return amount
+
+
 @app.post("/api/player/spend-gold")
 async def spend_gold(
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Потратить золото"""
-    amount = data.get("amount", 0)
-    if player.gold < amount:
+    balances = await db.run(
+        currency.change_balance, auth.player_id, {"gold": -_amount(data)}, reason="spend_gold"
+    )
+    if balances is None:
         raise HTTPException(status_code=400, detail="Not enough gold")
     
-    player.gold -= amount
-    db.commit()
-    return {"success": True, "gold": player.gold}
+    return {"success": True, "gold": balances["gold"]}
 
 
 @app.post("/api/player/add-gold")
 async def add_gold(
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Добавить золото"""
-    amount = data.get("amount", 0)
-    player.gold += amount
-    db.commit()
-    return {"success": True, "gold": player.gold}
+    balances = await db.run(
+        currency.change_balance, auth.player_id, {"gold": _amount(data)}, reason="add_gold"
+    )
+    if balances is None:
+        raise HTTPException(status_code=404, detail="Player not found")
+    return {"success": True, "gold": balances["gold"]}
 
 
 @app.post("/api/player/spend-crystals")
 async def spend_crystals(
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Потратить кристаллы"""
-    amount = data.get("amount", 0)
-    if player.crystals < amount:
+    balances = await db.run(
+        currency.change_balance, auth.player_id, {"crystals": -_amount(data)}, reason="spend_crystals"
+    )
+    if balances is None:
         raise HTTPException(status_code=400, detail="Not enough crystals")
     
-    player.crystals -= amount
-    db.commit()
-    return {"success": True, "crystals": player.crystals}
+    return {"success": True, "crystals": balances["crystals"]}
 
 
 @app.post("/api/player/add-crystals")
 async def add_crystals(
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Добавить кристаллы"""
-    amount = data.get("amount", 0)
-    player.crystals += amount
+    balances = await db.run(
+        currency.change_balance, auth.player_id, {"crystals": _amount(data)}, reason="add_crystals"
+    )
+    if balances is None:
+        raise HTTPException(status_code=404, detail="Player not found")
+    return {"success": True, "crystals": balances["crystals"]}
+
+
+def _buy_skin(db: Session, player_id: int, skin_id: str, price: int) -> bool:
+    # Списание, смена текущего скина и запись во владение — одна транзакция
+    balances = currency.change_balance(
+        db, player_id, {"crystals": -price}, set_values={"current_skin": skin_id},
+        commit=False, reason="buy_skin"
+    )
+    if balances is None:
+        return False
+    db.add(models.OwnedSkin(player_id=player_id, skin_id=skin_id))
     db.commit()
-    return {"success": True, "crystals": player.crystals}
+    return True
 
 
 @app.post("/api/player/buy-skin")
 async def buy_skin(
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Купить скин"""
     skin_id = data.get("skin_id")
-    price = data.get("price", 0)
+    price = _amount({"amount": data.get("price", 0)})
     
-    if player.crystals < price:
+    if not await db.run(_buy_skin, auth.player_id, skin_id, price):
         raise HTTPException(status_code=400, detail="Not enough crystals")
     
-    player.crystals -= price
-    player.current_skin = skin_id
-    
-    owned = models.OwnedSkin(player_id=player.id, skin_id=skin_id)
-    db.add(owned)
-    db.commit()
-    
     return {"success": True, "skin_id": skin_id}
 
 
 # === Эндпоинты инвентаря ===
 
+def _etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if if_none_match is None:
+        return False
+    # Прокси могут ослабить ETag до W/"..." — сравниваем без префикса
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in tags or "*" in tags
+
+
+def _inventory_headers(player_id: int, version: int) -> dict:
+    # Ответ свой у каждого игрока — общим кэшам его хранить нельзя
+    return {"ETag": f'"inv-{player_id}-{version}"', "Cache-Control": "private, no-cache"}
+
+
 @app.get("/api/inventory", response_model=List[schemas.InventoryItemResponse])
 async def get_inventory(
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    response: Response,
+    auth: schemas.AuthContext = Depends(verify_auth),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncDB = Depends(get_player_read_db)
+):
+    """Получить инвентарь. ETag — версия инвентаря; с If-None-Match без изменений — 304 без чтения стопок"""
+    if if_none_match is not None:
+        version, _ = await db.run(inventory_sync.current_version, auth.player_id)
+        headers = _inventory_headers(auth.player_id, version)
+        if _etag_matches(headers["ETag"], if_none_match):
+            return Response(status_code=304, headers=headers)
+    
+    items, version = await db.run(inventory_sync.get_inventory, auth.player_id)
+    response.headers.update(_inventory_headers(auth.player_id, version))
+    return items
+
+
+@app.get("/api/inventory/changes", response_model=schemas.InventoryChanges)
+async def get_inventory_changes(
+    since_version: int,
+    response: Response,
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_read_db)
 ):
-    """Получить инвентарь"""
-    return crud.get_inventory(db, player.id)
+    """
+    Изменения инвентаря после версии клиента: изменённые стопки и id удалённых.
+    Версия не изменилась — 304. Слишком старая версия — весь инвентарь с full=true
+    """
+    version, pruned_version = await db.run(inventory_sync.current_version, auth.player_id)
+    if since_version > version and db.replica is not None:
+        # Клиент видел более новую версию (записи через другой воркер) — реплика отстаёт
+        await db.use_primary()
+        version, pruned_version = await db.run(inventory_sync.current_version, auth.player_id)
+    headers = _inventory_headers(auth.player_id, version)
+    if since_version == version:
+        return Response(status_code=304, headers=headers)
+    
+    response.headers.update(headers)
+    if since_version < pruned_version or since_version > version:
+        items, version = await db.run(inventory_sync.get_inventory, auth.player_id)
+        response.headers.update(_inventory_headers(auth.player_id, version))
+        return schemas.InventoryChanges(version=version, full=True, items=items, deleted=[])
+    
+    items, deleted = await db.run(inventory_sync.get_changes, auth.player_id, since_version)
+    return schemas.InventoryChanges(version=version, full=False, items=items, deleted=deleted)
 
 
 @app.post("/api/inventory/use/{item_id}")
 async def use_item(
     item_id: int,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Использовать предмет"""
-    success = crud.remove_inventory_item(db, player.id, item_id, 1)
+    success = await db.run(crud.remove_inventory_item, auth.player_id, item_id, 1, reason="use_item")
     if not success:
         raise HTTPException(status_code=404, detail="Item not found")
     return {"success": True}
@@ -188,8 +506,8 @@ async def use_item(
 @app.post("/api/inventory/add")
 async def add_item(
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Добавить предмет в инвентарь"""
     item = schemas.InventoryItemCreate(
@@ -199,7 +517,7 @@ async def add_item(
         item_type=data.get("type", "material"),
         rarity=data.get("rarity", "common")
     )
-    db_item = crud.add_inventory_item(db, player.id, item)
+    db_item = await db.run(crud.add_inventory_item, auth.player_id, item)
     return {"success": True, "item_id": db_item.id}
 
 
@@ -207,12 +525,12 @@ async def add_item(
 async def remove_item(
     item_id: int,
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
     """Удалить предмет из инвентаря"""
     quantity = data.get("quantity", 1)
-    success = crud.remove_inventory_item(db, player.id, item_id, quantity)
+    success = await db.run(crud.remove_inventory_item, auth.player_id, item_id, quantity)
     
     if not success:
         raise HTTPException(status_code=404, detail="Item not found")
@@ -220,23 +538,86 @@ async def remove_item(
     return {"success": True}
 
 
-# === Эндпоинты биржи ===
+INVENTORY_BATCH_MAX = 100
 
-@app.get("/api/market")
-async def get_market_listings(
-    skip: int = 0,
-    limit: int = 50,
-    db: Session = Depends(get_db)
+
+@app.post("/api/inventory/batch")
+async def inventory_batch(
+    data: dict,
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_player_db)
 ):
-    """Получить лоты на бирже"""
-    listings = crud.get_market_listings(db, skip, limit)
+    """Применить пакет операций add/use/remove одной транзакцией"""
+    raw_operations = data.get("operations") or []
+    if not isinstance(raw_operations, list) or not all(isinstance(op, dict) for op in raw_operations):
+        raise HTTPException(status_code=400, detail="operations must be a list of objects")
+    if len(raw_operations) > INVENTORY_BATCH_MAX:
+        raise HTTPException(status_code=400, detail="Too many operations")
+    
+    operations = []
+    for index, op in enumerate(raw_operations):
+        try:
+            operations.append(schemas.InventoryOperation(
+                op=op.get("op"),
+                item_id=op.get("item_id"),
+                name=op.get("name"),
+                icon=op.get("icon"),
+                quantity=op.get("quantity", 1),
+                item_type=op.get("type", "material"),
+                rarity=op.get("rarity", "common")
+            ))
+        except ValidationError:
+            # Тот же ответ, что у ошибок crud.InventoryBatchError
+            raise HTTPException(status_code=400, detail={"index": index, "error": "Invalid operation"})
+    
+    try:
+        items = await db.run(crud.apply_inventory_batch, auth.player_id, operations)
+    except crud.InventoryBatchError as e:
+        raise HTTPException(status_code=400, detail={"index": e.index, "error": e.detail})
+    
+    return {"success": True, "items": items}
+
+
+# === Эндпоинты биржи ===
+
+MARKET_PAGE_MAX = 100
+
+
+# Снимки страниц ленты в JSON-байтах. Запись в этом воркере сбрасывает кэш сразу,
+# записи других воркеров видны не позже чем через TTL
+MARKET_READ_KEY = "market"
+
+market_cache = SnapshotCache(
+    maxsize=int(os.getenv("MARKET_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("MARKET_CACHE_TTL", "2")),
+)
+
+
+def _invalidate_market():
+    market_cache.invalidate()
+    # Реплики могут ещё не видеть изменение — ближайшие снимки строятся с основной БД
+    read_router.note_write(MARKET_READ_KEY)
+
+
+def _on_remote_market_event(kind: str):
+    # Лоты изменились в другом воркере — не ждём TTL снимков
+    if kind in LISTING_EVENTS:
+        _invalidate_market()
+
+
+market_hub.on_remote = _on_remote_market_event
+
+
+def _market_page(db: Session, search: schemas.MarketSearch, after, limit: int) -> dict:
+    # Берём на один лот больше, чтобы понять, есть ли следующая страница
+    rows = crud.get_market_listings(db, search, after, limit + 1, directory=shard_router.sharded)
     
     result = []
-    for listing in listings:
+    for listing, seller_name in rows[:limit]:
         result.append({
             "id": listing.id,
             "seller_id": listing.seller_id,
-            "seller_name": listing.seller.name,
+            "seller_name": seller_name,
             "item_name": listing.item_name,
             "item_icon": listing.item_icon,
             "item_rarity": listing.item_rarity,
@@ -245,14 +626,103 @@ async def get_market_listings(
             "created_at": listing.created_at.isoformat()
         })
     
-    return result
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = crud.encode_market_cursor(rows[limit - 1][0], search.sort)
+    
+    return {"listings": result, "next_cursor": next_cursor}
+
+
+async def _load_market_page(search: schemas.MarketSearch, after, limit: int) -> bytes:
+    # Своя сессия: загрузку ждут и другие запросы, она не должна зависеть от запустившего
+    db = read_router.session(MARKET_READ_KEY)
+    try:
+        page = await db.run(_market_page, search, after, limit)
+    finally:
+        await db.close()
+    return json.dumps(page, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def _snapshot_response(
+    snapshot: Snapshot, if_none_match: Optional[str], if_modified_since: Optional[str]
+) -> Response:
+    headers = {
+        "ETag": snapshot.etag,
+        "Last-Modified": formatdate(snapshot.last_modified, usegmt=True),
+        # Кэшировать можно, но каждый раз сверяться с сервером
+        "Cache-Control": "no-cache",
+    }
+    if if_none_match is not None:
+        not_modified = _etag_matches(snapshot.etag, if_none_match)
+    elif if_modified_since is not None:
+        try:
+            not_modified = int(snapshot.last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            not_modified = False
+    else:
+        not_modified = False
+    
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+
+@app.get("/api/market")
+async def get_market_listings(
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    item: Optional[str] = None,
+    prefix: Optional[str] = None,
+    rarity: Optional[str] = None,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+    seller_id: Optional[int] = None,
+    sort: str = "newest",
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None)
+):
+    """
+    Лоты на бирже с фильтрами и курсорной пагинацией.
+    item — точное имя предмета, prefix — начало имени, sort: newest / price (цена за штуку).
+    Ответ из кэша снимков; с If-None-Match / If-Modified-Since — 304 без тела
+    """
+    if sort not in crud.MARKET_SORTS:
+        raise HTTPException(status_code=400, detail="Invalid sort")
+    limit = max(1, min(limit, MARKET_PAGE_MAX))
+    
+    search = schemas.MarketSearch(
+        item_name=item or None,
+        item_prefix=prefix or None,
+        rarity=rarity or None,
+        min_price=min_price,
+        max_price=max_price,
+        seller_id=seller_id,
+        sort=sort
+    )
+    
+    after = None
+    if cursor:
+        try:
+            after = crud.decode_market_cursor(cursor, sort)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    key = (tuple(search.dict().values()), cursor, limit)
+    snapshot = await market_cache.get_or_load(key, partial(_load_market_page, search, after, limit))
+    return _snapshot_response(snapshot, if_none_match, if_modified_since)
+
+
+@app.get("/api/market/summary")
+async def get_market_summary(db: AsyncDB = Depends(get_read_db)):
+    """Витрина биржи: самая низкая цена и число лотов по каждому предмету"""
+    return {"items": await db.run(crud.get_market_summary)}
 
 
 @app.post("/api/market/sell")
 async def create_listing(
     data: dict,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_async_db)
 ):
     """Выставить предмет на продажу"""
     listing = schemas.MarketListingCreate(
@@ -263,37 +733,388 @@ async def create_listing(
         quantity=data.get("quantity", 1)
     )
     
-    # Проверяем наличие предмета
-    inventory = crud.get_inventory(db, player.id)
-    item = next((i for i in inventory if i.name == listing.item_name and i.quantity >= listing.quantity), None)
+    if listing.price <= 0 or listing.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Invalid listing")
     
-    if not item:
+    if shard_router.sharded:
+        taken, listing_id = await shard_market.sell(auth.player_id, auth.shard, listing)
+    else:
+        # Снимаем предметы из инвентаря и создаём лот одной транзакцией
+        new_listing = await db.run(crud.list_inventory_item, auth.player_id, listing)
+        taken, listing_id = new_listing is not None, new_listing and new_listing.id
+    if not taken:
         raise HTTPException(status_code=400, detail="Not enough items")
+    _invalidate_market()
+    # listing_id None — лот дошлёт доставка сообщений (шардирование)
+    if listing_id is not None:
+        market_hub.publish(
+            "listing_created", listing.item_name, listing_id=listing_id, seller_id=auth.player_id,
+            item_icon=listing.item_icon, item_rarity=listing.item_rarity,
+            price=listing.price, quantity=listing.quantity
+        )
     
-    # Убираем из инвентаря
-    crud.remove_inventory_item(db, player.id, item.id, listing.quantity)
-    
-    # Создаём лот
-    new_listing = crud.create_market_listing(db, player.id, listing)
-    
-    return {"success": True, "listing_id": new_listing.id}
+    return {"success": True, "listing_id": listing_id}
 
 
 @app.post("/api/market/buy/{listing_id}")
 async def buy_listing(
     listing_id: int,
-    player: models.Player = Depends(verify_auth),
-    db: Session = Depends(get_db)
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_async_db)
 ):
     """Купить лот"""
-    success = crud.buy_market_listing(db, player.id, listing_id)
+    if shard_router.sharded:
+        result = (await shard_market.buy_listings(auth.player_id, auth.shard, [listing_id]))[0]
+        if result["status"] == "pending":
+            # Золото списано, лот или возврат придут начислением
+            return {"success": True, "pending": True}
+        sold = None
+        if result["status"] == "bought":
+            sold = {key: result[key] for key in ("listing_id", "item_name", "price", "quantity")}
+    else:
+        sold = await db.run(crud.buy_market_listing, auth.player_id, listing_id)
     
-    if not success:
+    if not sold:
         raise HTTPException(status_code=400, detail="Cannot buy this listing")
+    _invalidate_market()
+    market_hub.publish("listing_sold", **sold)
+    market_hub.publish("trade", sold["item_name"], price=sold["price"], quantity=sold["quantity"])
     
     return {"success": True}
 
 
+MARKET_CART_MAX = 50
+
+
+@app.post("/api/market/buy")
+async def buy_listings(
+    data: dict,
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_async_db)
+):
+    """
+    Купить несколько лотов одной транзакцией. Результат по каждому лоту: bought / unavailable / not_enough_gold;
+    при шардировании ещё pending — золото списано, лот придёт, когда сделку дошлёт доставка сообщений
+    """
+    listing_ids = data.get("listing_ids")
+    # bool — подкласс int: [true] не должен стать лотом 1
+    if not isinstance(listing_ids, list) or not all(type(i) is int for i in listing_ids):
+        raise HTTPException(status_code=400, detail="listing_ids must be a list of ids")
+    if not listing_ids:
+        raise HTTPException(status_code=400, detail="No listings")
+    if len(set(listing_ids)) != len(listing_ids):
+        raise HTTPException(status_code=400, detail="Duplicate listings")
+    if len(listing_ids) > MARKET_CART_MAX:
+        raise HTTPException(status_code=400, detail="Too many listings")
+    
+    if shard_router.sharded:
+        results = await shard_market.buy_listings(auth.player_id, auth.shard, listing_ids)
+    else:
+        results = await db.run(crud.buy_market_listings, auth.player_id, listing_ids)
+    
+    bought = [r for r in results if r["status"] == "bought"]
+    if bought:
+        _invalidate_market()
+    for sold in bought:
+        market_hub.publish(
+            "listing_sold", sold["item_name"], listing_id=sold["listing_id"], price=sold["price"], quantity=sold["quantity"]
+        )
+        market_hub.publish("trade", sold["item_name"], price=sold["price"], quantity=sold["quantity"])
+    
+    return {
+        "success": bool(bought),
+        "results": results,
+        "spent": sum(r["price"] * r["quantity"] for r in bought),
+    }
+
+
+# === Заявки биржи (стакан) ===
+
+@app.post("/api/market/orders")
+async def place_order(
+    data: dict,
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_async_db)
+):
+    """Поставить лимитную заявку на покупку или продажу"""
+    try:
+        order = schemas.MarketOrderCreate(
+            side=data.get("side"),
+            item_name=data.get("item_name"),
+            item_icon=data.get("item_icon"),
+            item_rarity=data.get("item_rarity", "common"),
+            price=data.get("price"),
+            quantity=data.get("quantity", 1)
+        )
+    except ValidationError:
+        raise HTTPException(status_code=400, detail="Invalid order")
+    
+    if order.side not in ("buy", "sell") or order.price <= 0 or order.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Invalid order")
+    
+    try:
+        if shard_router.sharded:
+            db_order, trades = await shard_market.place_order(db, auth.player_id, auth.shard, order)
+        else:
+            db_order, trades = await matching_engine.place(db, auth.player_id, order)
+    except crud.OrderRejected:
+        raise HTTPException(status_code=400, detail="Not enough gold" if order.side == "buy" else "Not enough items")
+    except crud.BookConflict:
+        raise HTTPException(status_code=409, detail="Order book changed, try again")
+    
+    for trade in trades:
+        market_hub.publish("trade", order.item_name, price=trade["price"], quantity=trade["quantity"])
+    
+    return {
+        "success": True,
+        "order_id": db_order.id,
+        "status": db_order.status,
+        "remaining": db_order.remaining,
+        "trades": trades
+    }
+
+
+@app.post("/api/market/orders/{order_id}/cancel")
+async def cancel_order(
+    order_id: int,
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_async_db)
+):
+    """Отменить свою открытую заявку"""
+    if shard_router.sharded:
+        order = await shard_market.cancel_order(db, auth.player_id, order_id)
+    else:
+        order = await matching_engine.cancel(db, auth.player_id, order_id)
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return {"success": True}
+
+
+@app.get("/api/market/book/{item_name}")
+async def get_order_book(item_name: str, depth: int = 5, db: AsyncDB = Depends(get_async_db)):
+    """Лучшие цены и глубина стакана по предмету"""
+    return await matching_engine.top_of_book(db, item_name, max(1, min(depth, 50)))
+
+
+@app.get("/api/market/history/{item_name}")
+async def get_price_history(
+    item_name: str,
+    resolution: str = "1h",
+    limit: int = 200,
+    before: Optional[int] = None,
+    db: AsyncDB = Depends(get_read_db)
+):
+    """
+    Свечи OHLC по предмету для графика. resolution: 1m / 1h / 1d,
+    before — unix time, для подгрузки более старых свечей
+    """
+    seconds = price_history.RESOLUTIONS.get(resolution)
+    if seconds is None:
+        raise HTTPException(status_code=400, detail="Invalid resolution")
+    limit = max(1, min(limit, price_history.SERIES_MAX))
+    
+    candles = await db.run(price_history.get_series, item_name, seconds, before, limit)
+    return {"item_name": item_name, "resolution": resolution, "candles": candles}
+
+
+# === Таблица лидеров ===
+
+LEADERBOARD_PAGE_MAX = 100
+LEADERBOARD_WINDOW_MAX = 25
+
+
+def _check_metric(metric: str):
+    if metric not in LEADERBOARD_METRICS:
+        raise HTTPException(status_code=404, detail="Unknown leaderboard")
+
+
+async def _leaderboard_entries(db: AsyncDB, rows) -> List[dict]:
+    # Игроки на разных шардах — имена из справочника в глобальной БД
+    get_names = shards.get_player_names if shard_router.sharded else crud.get_player_names
+    names = await db.run(get_names, [player_id for _, player_id, _ in rows])
+    return [
+        {"rank": rank, "player_id": player_id, "name": names.get(player_id), "score": score}
+        for rank, player_id, score in rows
+    ]
+
+
+@app.get("/api/leaderboard/{metric}")
+async def get_leaderboard(
+    metric: str,
+    offset: int = 0,
+    limit: int = 10,
+    db: AsyncDB = Depends(get_async_db)
+):
+    """Топ игроков по метрике: level / gold / crystals"""
+    _check_metric(metric)
+    await leaderboard.ensure_loaded(db)
+    rows = leaderboard.top(metric, max(0, offset), max(1, min(limit, LEADERBOARD_PAGE_MAX)))
+    return {"metric": metric, "total": leaderboard.total(metric), "entries": await _leaderboard_entries(db, rows)}
+
+
+@app.get("/api/leaderboard/{metric}/me")
+async def get_my_rank(
+    metric: str,
+    window: int = 5,
+    auth: schemas.AuthContext = Depends(verify_auth),
+    db: AsyncDB = Depends(get_async_db)
+):
+    """Место игрока и соседи: window игроков выше и ниже"""
+    _check_metric(metric)
+    await leaderboard.ensure_loaded(db)
+    
+    ranked = leaderboard.rank(metric, auth.player_id)
+    if ranked is None:
+        # Игрок создан после построения индекса. Сессию глобальной БД отпускаем до чтения
+        # шарда — два слота сессий на запрос не держим
+        await db.close()
+        player_db = shard_router.session(auth.shard)
+        try:
+            player = await player_db.run(crud.get_player, auth.player_id)
+        finally:
+            await player_db.close()
+        if not player:
+            if shard_router.sharded:
+                raise shards.PlayerMoved(auth.player_id)
+            raise HTTPException(status_code=404, detail="Player not found")
+        leaderboard.add_player(player)
+        ranked = leaderboard.rank(metric, auth.player_id)
+    rank, score = ranked
+    
+    window = max(0, min(window, LEADERBOARD_WINDOW_MAX))
+    start = max(0, rank - 1 - window)
+    rows = leaderboard.top(metric, start, rank - start + window)
+    return {
+        "metric": metric,
+        "total": leaderboard.total(metric),
+        "rank": rank,
+        "score": score,
+        "around": await _leaderboard_entries(db, rows)
+    }
+
+
+# === Лента биржи (push вместо опроса /api/market) ===
+
+def _feed_items(items: Optional[str]) -> Optional[List[str]]:
+    # ?items=Дерево,Камень — только эти предметы, без параметра — все
+    return [name.strip() for name in items.split(",") if name.strip()] if items else None
+
+
+@app.websocket("/ws/market")
+async def market_feed_ws(websocket: WebSocket, items: Optional[str] = None):
+    """
+    События биржи: listing_created, listing_sold, trade. Сообщение — JSON-объект с полем type.
+    Медленного клиента закрываем с кодом 1013 — ему нужно переподключиться и перечитать /api/market
+    """
+    await websocket.accept()
+    subscriber = market_hub.subscribe(_feed_items(items))
+    
+    async def send_events():
+        while not subscriber.dropped:
+            message = await subscriber.queue.get()
+            if subscriber.dropped:
+                break
+            await websocket.send_text(message)
+        await websocket.close(code=1013)
+    
+    async def wait_disconnect():
+        # Сообщения клиента не нужны — чтение только ловит закрытие соединения
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+    
+    tasks = [asyncio.create_task(send_events()), asyncio.create_task(wait_disconnect())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        market_hub.unsubscribe(subscriber)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@app.get("/api/market/stream")
+async def market_feed_sse(items: Optional[str] = None):
+    """Та же лента через Server-Sent Events — для клиентов без WebSocket"""
+    async def events():
+        subscriber = market_hub.subscribe(_feed_items(items))
+        try:
+            yield "retry: 3000\n\n"
+            while not subscriber.dropped:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), FEED_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    # Комментарий держит соединение живым через прокси
+                    yield ": ping\n\n"
+                    continue
+                if subscriber.dropped:
+                    break
+                yield f"data: {message}\n\n"
+        finally:
+            market_hub.unsubscribe(subscriber)
+    
+    return StreamingResponse(
+        events(), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# === Метрики ===
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Метрики воркера в текстовом формате Prometheus"""
+    gauges = []
+    for pool_name, stats in pool_stats().items():
+        labels = {"pool": pool_name}
+        gauges.append(("db_pool_checked_out", labels, stats["checked_out"]))
+        gauges.append(("db_pool_capacity", labels, stats["capacity"]))
+        gauges.append(("db_pool_timeouts", labels, stats["timeouts"]))
+    cache = auth_cache.stats()
+    gauges.append(("auth_cache_size", {}, cache["size"]))
+    gauges.append(("auth_cache_hits", {}, cache["hits"]))
+    gauges.append(("auth_cache_misses", {}, cache["misses"]))
+    snapshots = market_cache.stats()
+    gauges.append(("market_cache_hits", {}, snapshots["hits"]))
+    gauges.append(("market_cache_misses", {}, snapshots["misses"]))
+    gauges.append(("market_cache_coalesced", {}, snapshots["coalesced"]))
+    load = admission.stats()
+    gauges.append(("admission_inflight", {}, load["inflight"]))
+    gauges.append(("admission_queued", {}, load["queued"]))
+    gauges.append(("admission_max_inflight", {}, load["max_inflight"]))
+    board = leaderboard.stats()
+    gauges.append(("leaderboard_players", {}, board["players"]))
+    gauges.append(("leaderboard_corrections", {}, board["corrections"]))
+    feed = market_hub.stats()
+    gauges.append(("market_feed_subscribers", {}, feed["subscribers"]))
+    gauges.append(("market_feed_published", {}, feed["published"]))
+    gauges.append(("market_feed_dropped", {}, feed["dropped"]))
+    reads = read_router.stats()
+    gauges.append(("db_primary_reads", {}, reads["primary_reads"]))
+    for name, replica in reads["replicas"].items():
+        labels = {"replica": name}
+        gauges.append(("db_replica_healthy", labels, int(replica["healthy"])))
+        # -1 — отставание неизвестно (реплика не ответила или не видит ни одной метки)
+        lag = replica["lag"]
+        gauges.append(("db_replica_lag_seconds", labels, lag if lag is not None and lag != float("inf") else -1))
+        gauges.append(("db_replica_reads", labels, replica["reads"]))
+        gauges.append(("db_replica_inflight", labels, replica["inflight"]))
+        gauges.append(("db_replica_ejections", labels, replica["ejections"]))
+    if shard_router.sharded:
+        sharding = shard_router.stats()
+        gauges.append(("shards", {}, sharding["shards"]))
+        gauges.append(("shard_messages_delivered", {}, sharding["delivered"]))
+        gauges.append(("shard_messages_recovered", {}, sharding["recovered"]))
+    ledger = ledger_writer.stats()
+    gauges.append(("ledger_pending", {}, ledger["pending"]))
+    gauges.append(("ledger_spilled", {}, ledger["spilled"]))
+    # Потерянные события журнала: любое значение больше 0 — повод для алерта
+    gauges.append(("ledger_dropped", {}, ledger["dropped"]))
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+
 # === Запуск ===
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+import uuid
+from typing import Iterable, Optional
+
+from .database import DATABASE_URL, IS_SQLITE
+
+logger = logging.getLogger(__name__)
+
+# === Лента биржи в реальном времени ===
+#
+# Обработчики биржи после commit публикуют события (новый лот, продажа, сделка)
+# в хаб воркера. Хаб сериализует событие один раз и раскладывает строку по
+# очередям подписчиков WebSocket/SSE. Очередь ограничена: подписчик, который не
+# успевает читать, отключается — клиент переподключается и берёт снимок /api/market.
+#
+# Между воркерами события ходят через брокер:
+#   unix     — датаграммы по Unix-сокетам в общем каталоге (локально, несколько uvicorn)
+#   postgres — LISTEN/NOTIFY на отдельном соединении asyncpg
+#   memory   — только внутри процесса (один воркер)
+
+FEED_QUEUE_SIZE = int(os.getenv("MARKET_FEED_QUEUE", "256"))
+FEED_HEARTBEAT = float(os.getenv("MARKET_FEED_HEARTBEAT", "15"))
+FEED_BROKER = os.getenv("MARKET_FEED_BROKER", "unix" if IS_SQLITE else "postgres").lower()
+FEED_DIR = os.getenv("MARKET_FEED_DIR", os.path.join(tempfile.gettempdir(), "mmorpg-market-feed"))
+FEED_CHANNEL = "market_feed"
+
+if FEED_BROKER not in ("memory", "unix", "postgres"):
+    raise ValueError(f"Unknown MARKET_FEED_BROKER: {FEED_BROKER}")
+
+# События, после которых меняется лента лотов (для сброса кэша снимков)
+LISTING_EVENTS = frozenset(("listing_created", "listing_sold"))
+
+
+class Subscriber:
+    __slots__ = ("queue", "items", "dropped")
+
+    def __init__(self, items: Optional[frozenset], queue_size: int):
+        self.queue = asyncio.Queue(queue_size)
+        # None — все предметы
+        self.items = items
+        self.dropped = False
+
+
+class MarketHub:
+    """Раздача событий подписчикам воркера. Используется из event loop"""
+
+    def __init__(self, queue_size: int = FEED_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.broker = None
+        # Вызывается на события других воркеров: (тип события)
+        self.on_remote = None
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, items: Optional[Iterable[str]] = None) -> Subscriber:
+        subscriber = Subscriber(frozenset(items) if items else None, self.queue_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, kind: str, item_name: str, **fields):
+        """Событие после commit: подписчикам воркера и через брокер — остальным воркерам"""
+        message = json.dumps(
+            {"type": kind, "item_name": item_name, "time": time.time(), **fields},
+            ensure_ascii=False, separators=(",", ":"),
+        )
+        self.published += 1
+        self.deliver(kind, item_name, message)
+        if self.broker is not None:
+            self.broker.send(f"{kind}\n{item_name}\n{message}")
+
+    def receive(self, payload: str):
+        """Событие от брокера"""
+        kind, item_name, message = payload.split("\n", 2)
+        if self.on_remote is not None:
+            self.on_remote(kind)
+        self.deliver(kind, item_name, message)
+
+    def deliver(self, kind: str, item_name: str, message: str):
+        for subscriber in list(self.subscribers):
+            if subscriber.items is not None and item_name not in subscriber.items:
+                continue
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Медленный клиент: отключаем, а не копим события и не тормозим остальных
+                subscriber.dropped = True
+                self.subscribers.discard(subscriber)
+                self.dropped += 1
+
+    async def start(self):
+        if FEED_BROKER == "unix":
+            self.broker = UnixBroker(self, FEED_DIR)
+        elif FEED_BROKER == "postgres":
+            self.broker = PostgresBroker(self, DATABASE_URL)
+        if self.broker is not None:
+            await self.broker.start()
+
+    async def stop(self):
+        if self.broker is not None:
+            await self.broker.stop()
+            self.broker = None
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self.subscribers), "published": self.published, "dropped": self.dropped}
+
+
+class UnixBroker:
+    """
+    Локальная замена pub/sub: у каждого воркера датаграммный Unix-сокет в общем
+    каталоге, публикация — по датаграмме в каждый чужой сокет
+    """
+
+    def __init__(self, hub: MarketHub, directory: str):
+        self.hub = hub
+        self.directory = directory
+        self.path = os.path.join(directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        self.sock = None
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._readable)
+
+    def _readable(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            self.hub.receive(data.decode())
+
+    def send(self, payload: str):
+        data = payload.encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self.path:
+                continue
+            try:
+                self.sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Сокет остался от завершившегося воркера
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                # Буфер получателя полон — он не успевает, событие для него теряется
+                pass
+
+    async def stop(self):
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class PostgresBroker:
+    """LISTEN/NOTIFY на отдельном соединении. Свои уведомления отбрасываются по метке воркера"""
+
+    def __init__(self, hub: MarketHub, url: str):
+        self.hub = hub
+        # asyncpg принимает обычный postgresql://, без указания драйвера
+        self.dsn = url.replace("postgresql+psycopg2://", "postgresql://", 1)
+        self.origin = uuid.uuid4().hex[:12]
+        self.conn = None
+        self._tasks = set()
+
+    async def start(self):
+        import asyncpg
+
+        self.conn = await asyncpg.connect(self.dsn)
+        await self.conn.add_listener(FEED_CHANNEL, self._notified)
+
+    def _notified(self, conn, pid, channel, payload: str):
+        origin, payload = payload.split("\n", 1)
+        if origin != self.origin:
+            self.hub.receive(payload)
+
+    def send(self, payload: str):
+        task = asyncio.create_task(self._notify(f"{self.origin}\n{payload}"))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _notify(self, payload: str):
+        try:
+            if self.conn.is_closed():
+                await self.start()
+            await self.conn.execute("SELECT pg_notify($1, $2)", FEED_CHANNEL, payload)
+        except Exception:
+            logger.exception("Market feed notify failed")
+
+    async def stop(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.conn.close()
+
+
+market_hub = MarketHub()
@@ -0,0 +1,246 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+# === Метрики процесса в формате Prometheus ===
+#
+# Латентность HTTP по шаблону маршрута, SQL-запросы и время БД по функции crud,
+# ожидание соединения из пула. Наборы меток ограничены: шаблон маршрута (не сырой
+# путь), метод, класс статуса, имя функции crud, тип SQL-операции.
+#
+# Статистика запроса живёт в ContextVar: AsyncDB.run копирует контекст в поток
+# пула, поэтому события engine из потока попадают в счётчики своего запроса.
+# Метрики свои у каждого воркера.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+QUERY_COUNT_HEADER = "x-db-queries"
+DB_TIME_HEADER = "x-db-time-ms"
+
+HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+SQL_OPERATIONS = frozenset(("SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "ROLLBACK", "PRAGMA"))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...] = (), value: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [счётчики по корзинам..., +Inf, сумма]
+        self.values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self.values.get(labels)
+            if row is None:
+                row = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[index] += 1
+            row[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        bounds = [_number(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, row in sorted(self.values.items()):
+            cumulative = 0
+            for le, count in zip(bounds, row):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(row[-1])}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+http_latency = Histogram(
+    "http_request_duration_seconds", "Латентность HTTP-запросов по шаблону маршрута",
+    LATENCY_BUCKETS, ("method", "route", "status"),
+)
+http_queries = Histogram(
+    "http_request_db_queries", "SQL-запросов на HTTP-запрос",
+    QUERY_BUCKETS, ("method", "route"),
+)
+http_db_time = Counter(
+    "http_request_db_seconds_total", "Время в БД по маршрутам", ("method", "route"),
+)
+db_statements = Counter(
+    "db_statements_total", "SQL-запросы по функции crud и типу операции", ("source", "operation"),
+)
+db_time = Counter(
+    "db_statement_seconds_total", "Время выполнения SQL по функции crud", ("source",),
+)
+db_rows = Counter(
+    "db_rows_total", "Строки по rowcount драйвера (изменённые; в Postgres и прочитанные)", ("source",),
+)
+pool_wait = Histogram(
+    "db_pool_checkout_wait_seconds", "Ожидание соединения из пула", POOL_WAIT_BUCKETS, ("pool",),
+)
+
+admission_shed = Counter(
+    "admission_shed_total", "Запросы, сброшенные контролем допуска (503)", ("priority", "reason"),
+)
+admission_wait = Histogram(
+    "admission_queue_wait_seconds", "Ожидание слота в очереди допуска", POOL_WAIT_BUCKETS, ("priority",),
+)
+rate_limited = Counter(
+    "rate_limited_total", "Запросы сверх лимита игрока (429)",
+)
+
+REGISTRY = [
+    http_latency, http_queries, http_db_time, db_statements, db_time, db_rows, pool_wait,
+    admission_shed, admission_wait, rate_limited,
+]
+
+
+# === Статистика текущего запроса ===
+
+class RequestStats:
+    __slots__ = ("queries", "db_time", "rows", "pool_wait")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.pool_wait = 0.0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+# Имя функции crud, которую сейчас выполняет AsyncDB.run
+current_source: ContextVar[str] = ContextVar("current_source", default="other")
+
+
+def observe_pool_wait(pool_name: str, wait: float):
+    pool_wait.observe(wait, (pool_name,))
+    stats = current_request.get()
+    if stats is not None:
+        stats.pool_wait += wait
+
+
+def _operation(statement: str) -> str:
+    words = statement.lstrip()[:10].split(None, 1)
+    operation = words[0].upper() if words else ""
+    return operation if operation in SQL_OPERATIONS else "OTHER"
+
+
+def instrument_engine(sync_engine):
+    """Повесить счётчики SQL на engine (для async — на async_engine.sync_engine)"""
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["metrics_started"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        now = time.perf_counter()
+        elapsed = now - conn.info.pop("metrics_started", now)
+        rows = max(cursor.rowcount or 0, 0)
+        source = current_source.get()
+
+        db_statements.inc((source, _operation(statement)))
+        db_time.inc((source,), elapsed)
+        if rows:
+            db_rows.inc((source,), rows)
+
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+            stats.rows += rows
+
+
+# === ASGI middleware ===
+
+class MetricsMiddleware:
+    """
+    Латентность и стоимость в БД каждого HTTP-запроса.
+    Добавляет в ответ X-DB-Queries и X-DB-Time-Ms
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_headers(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((QUERY_COUNT_HEADER.encode(), str(stats.queries).encode()))
+                headers.append((DB_TIME_HEADER.encode(), f"{stats.db_time * 1000:.2f}".encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            current_request.reset(token)
+            # Шаблон маршрута FastAPI кладёт в scope; без совпадения — одна общая метка
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"] if scope["method"] in HTTP_METHODS else "OTHER"
+            http_latency.observe(time.perf_counter() - started, (method, route, f"{status // 100}xx"))
+            http_queries.observe(stats.queries, (method, route))
+            if stats.db_time:
+                http_db_time.inc((method, route), stats.db_time)
+
+
+def render(gauges: Sequence[Tuple[str, dict, float]] = ()) -> str:
+    """Все метрики в текстовом формате Prometheus. gauges — мгновенные значения [(имя, метки, значение)]"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    seen = set()
+    for name, labels, value in gauges:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {_number(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,319 @@
+"""
+Версионированные миграции схемы.
+
+Запускаются один раз на деплой (release-фаза в Procfile):
+
+    python -m app.migrations            # применить недостающие
+    python -m app.migrations --check    # только сравнить версии, код 1 если БД отстаёт
+
+Воркеры при старте делают одну дешёвую проверку версии (check) и не трогают схему.
+"""
+import argparse
+import logging
+import sys
+from typing import Callable, List, Tuple
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table,
+    delete, func, inspect, select, text, update,
+)
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Отдельная MetaData: create_all моделей не должен трогать служебную таблицу
+_meta = MetaData()
+schema_version = Table("schema_version", _meta, Column("version", Integer, nullable=False))
+
+# Ключ pg_advisory_xact_lock: параллельные деплои и воркеры не применяют миграции дважды
+_LOCK_KEY = 7_040_613
+
+
+class SchemaOutdated(RuntimeError):
+    """Версия схемы в БД ниже, чем ждёт код"""
+
+
+# === Миграция 1: базовая схема ===
+#
+# Схема на момент перехода на миграции, записанная явно: модели в app/models.py
+# описывают итог всех миграций и меняются дальше, а версия 1 — нет. Любое
+# изменение схемы — новая миграция в конце MIGRATIONS, которая создаёт только свои
+# таблицы и индексы.
+
+_baseline_meta = MetaData()
+
+Table(
+    "players", _baseline_meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("vk_id", Integer, unique=True, index=True, nullable=False),
+    Column("name", String(100)),
+    Column("level", Integer),
+    Column("player_class", String(50)),
+    Column("attack", Integer),
+    Column("defense", Integer),
+    Column("gold", Integer),
+    Column("crystals", Integer),
+    Column("is_premium", Boolean),
+    Column("premium_until", DateTime, nullable=True),
+    Column("current_skin", String(50)),
+    Column("created_at", DateTime, server_default=func.now()),
+    Column("updated_at", DateTime, server_default=func.now()),
+)
+
+_baseline_items = Table(
+    "inventory_items", _baseline_meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("player_id", Integer, ForeignKey("players.id"), nullable=False),
+    Column("name", String(100), nullable=False),
+    Column("icon", String(10), nullable=False),
+    Column("quantity", Integer),
+    Column("item_type", String(50)),
+    Column("rarity", String(20)),
+    Index("uq_inventory_items_player_name", "player_id", "name", unique=True),
+)
+
+Table(
+    "equipment", _baseline_meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("player_id", Integer, ForeignKey("players.id"), unique=True, nullable=False),
+    Column("weapon_name", String(100), nullable=True),
+    Column("weapon_icon", String(10), nullable=True),
+    Column("weapon_attack", Integer),
+    Column("armor_name", String(100), nullable=True),
+    Column("armor_icon", String(10), nullable=True),
+    Column("armor_defense", Integer),
+    Column("accessory_name", String(100), nullable=True),
+    Column("accessory_icon", String(10), nullable=True),
+)
+
+Table(
+    "owned_skins", _baseline_meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("player_id", Integer, ForeignKey("players.id"), nullable=False),
+    Column("skin_id", String(50), nullable=False),
+)
+
+Table(
+    "market_listings", _baseline_meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("seller_id", Integer, ForeignKey("players.id"), nullable=False),
+    Column("item_name", String(100), nullable=False),
+    Column("item_icon", String(10), nullable=False),
+    Column("item_rarity", String(20)),
+    Column("price", Integer, nullable=False),
+    Column("quantity", Integer),
+    Column("is_active", Boolean),
+    Column("created_at", DateTime, server_default=func.now()),
+    # Заменён частичными индексами в миграции 2
+    Index("ix_market_listings_active_created_id", "is_active", "created_at", "id"),
+)
+
+Table(
+    "market_orders", _baseline_meta,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("player_id", Integer, ForeignKey("players.id"), nullable=False),
+    Column("side", String(4), nullable=False),
+    Column("item_name", String(100), nullable=False),
+    Column("item_icon", String(10), nullable=False),
+    Column("item_rarity", String(20)),
+    Column("price", Integer, nullable=False),
+    Column("quantity", Integer, nullable=False),
+    Column("remaining", Integer, nullable=False),
+    Column("status", String(10)),
+    Column("created_at", DateTime, server_default=func.now()),
+    Index("ix_market_orders_status_item", "status", "item_name", "id"),
+)
+
+Table(
+    "ledger_entries", _baseline_meta,
+    Column("id", Integer, primary_key=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("player_id", Integer, nullable=False),
+    Column("kind", String(10), nullable=False),
+    Column("asset", String(100), nullable=False),
+    Column("delta", Integer, nullable=True),
+    Column("balance", Integer, nullable=True),
+    Column("reason", String(50)),
+    Index("ix_ledger_entries_player_asset", "player_id", "kind", "asset", "id"),
+)
+
+
+def _merge_duplicate_stacks(conn) -> int:
+    """Слить дубли (player_id, name), оставшиеся со времён до уникального индекса"""
+    item = _baseline_items.c
+    duplicates = conn.execute(
+        select(item.player_id, item.name, func.min(item.id), func.sum(item.quantity))
+        .group_by(item.player_id, item.name)
+        .having(func.count() > 1)
+    ).all()
+    for player_id, name, keep_id, total in duplicates:
+        conn.execute(update(_baseline_items).where(item.id == keep_id).values(quantity=total))
+        conn.execute(
+            delete(_baseline_items).where(item.player_id == player_id, item.name == name, item.id != keep_id)
+        )
+    return len(duplicates)
+
+
+def _baseline(conn):
+    # БД до миграций создавал каждый воркер при импорте app.main: таблицы могут уже
+    # быть, а индексов — не хватать. create_all индексы существующих таблиц не трогает
+    _baseline_meta.create_all(bind=conn)
+    _merge_duplicate_stacks(conn)
+    for table in _baseline_meta.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+
+# === Миграции 2 и дальше ===
+
+def _create_indexes(conn, model, *names):
+    """Индексы модели по именам: миграция создаёт только свои"""
+    indexes = {index.name: index for index in model.__table__.indexes}
+    for name in names:
+        indexes[name].create(bind=conn, checkfirst=True)
+
+
+def _market_search_indexes(conn):
+    # Полный индекс (is_active, created_at, id) заменён частичными — только активные лоты
+    conn.execute(text("DROP INDEX IF EXISTS ix_market_listings_active_created_id"))
+    _create_indexes(
+        conn, models.MarketListing,
+        "ix_market_listings_active_created", "ix_market_listings_active_item_price",
+        "ix_market_listings_active_price", "ix_market_listings_active_rarity_price",
+        "ix_market_listings_active_seller",
+    )
+
+
+def _price_history(conn):
+    models.MarketTrade.__table__.create(bind=conn, checkfirst=True)
+    models.PriceCandle.__table__.create(bind=conn, checkfirst=True)
+
+
+def _inventory_versions(conn):
+    columns = {column["name"] for column in inspect(conn).get_columns("inventory_items")}
+    if "version" not in columns:
+        conn.execute(text("ALTER TABLE inventory_items ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+    _create_indexes(conn, models.InventoryItem, "ix_inventory_items_player_version")
+    models.InventoryVersion.__table__.create(bind=conn, checkfirst=True)
+    models.InventoryTombstone.__table__.create(bind=conn, checkfirst=True)
+
+
+def _replication_heartbeat(conn):
+    models.ReplicationHeartbeat.__table__.create(bind=conn, checkfirst=True)
+
+
+def _sharding(conn):
+    # Справочник нужен только глобальной БД, outbox и inbox — каждой
+    for model in (models.PlayerDirectory, models.ShardMessage, models.ShardInbox):
+        model.__table__.create(bind=conn, checkfirst=True)
+
+
+def _owned_skins_index(conn):
+    _create_indexes(conn, models.OwnedSkin, "ix_owned_skins_player")
+
+
+def _drop_market_player_keys(conn):
+    # Биржа остаётся в глобальной БД, а игроки при шардировании переезжают на шарды —
+    # ключи на players снимаются всегда, чтобы схема не зависела от режима.
+    # SQLite снять ограничение без пересборки таблицы не умеет, а внешние ключи
+    # там не проверяются (PRAGMA foreign_keys выключена) — старые остаются в DDL
+    if conn.dialect.name == "sqlite":
+        return
+    for table in ("market_listings", "market_orders", "market_trades"):
+        for foreign_key in inspect(conn).get_foreign_keys(table):
+            if foreign_key["referred_table"] == "players":
+                conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{foreign_key["name"]}"'))
+
+
+def _market_book_versions(conn):
+    models.MarketBookVersion.__table__.create(bind=conn, checkfirst=True)
+
+
+# (версия, описание, функция). Только добавлять в конец
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "baseline schema and indexes", _baseline),
+    (2, "partial indexes for market search", _market_search_indexes),
+    (3, "market trades and price candles", _price_history),
+    (4, "inventory versions for incremental sync", _inventory_versions),
+    (5, "replication heartbeat for read replicas", _replication_heartbeat),
+    (6, "player directory and cross-shard messages", _sharding),
+    (7, "owned skins index by player", _owned_skins_index),
+    (8, "drop market foreign keys to players", _drop_market_player_keys),
+    (9, "order book versions", _market_book_versions),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    if not inspect(conn).has_table(schema_version.name):
+        return 0
+    return conn.execute(select(schema_version.c.version)).scalar() or 0
+
+
+def check(bind) -> int:
+    """Проверка при старте воркера: один-два лёгких запроса. SchemaOutdated — нужна миграция"""
+    with bind.connect() as conn:
+        version = current_version(conn)
+    if version < LATEST_VERSION:
+        raise SchemaOutdated(
+            f"Database schema version {version} < {LATEST_VERSION}, run: python -m app.migrations"
+        )
+    return version
+
+
+def upgrade(bind) -> int:
+    """Применить недостающие миграции одной транзакцией. Возвращает итоговую версию"""
+    with bind.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _LOCK_KEY})
+        elif conn.dialect.name == "sqlite":
+            # pysqlite не открывает транзакцию перед DDL — берём блокировку записи сами,
+            # остальные воркеры ждут её по busy_timeout
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        _meta.create_all(bind=conn)
+
+        version = current_version(conn)
+        for number, description, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info("Applying migration %d: %s", number, description)
+            migrate(conn)
+            version = number
+
+        conn.execute(schema_version.delete())
+        conn.execute(schema_version.insert().values(version=version))
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="только проверить версию")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    from .database import engine
+    from .shards import shard_router
+
+    # Схема у шардов та же, что у глобальной БД: лишние таблицы на них пустые
+    engines = [engine] + shard_router.engines()
+
+    def label(bind) -> str:
+        return f"{bind.url.render_as_string(hide_password=True)}: " if len(engines) > 1 else ""
+
+    if args.check:
+        try:
+            for bind in engines:
+                print(f"{label(bind)}schema version {check(bind)}")
+        except SchemaOutdated as e:
+            print(e)
+            sys.exit(1)
+        return
+
+    for bind in engines:
+        print(f"{label(bind)}schema version {upgrade(bind)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Float, ForeignKey, JSON, Index
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
 
+# В SQLite CURRENT_TIMESTAMP пишет время без микросекунд. Параметры сравнения
+# должны рендериться так же, иначе keyset-сравнение по строкам ломается
+SQLiteTimestamp = DateTime().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
+
 class Player(Base):
     __tablename__ = "players"
 
@@ -44,8 +53,42 @@ class InventoryItem(Base):
     quantity = Column(Integer, default=1)
     item_type = Column(String(50), default="material")
     rarity = Column(String(20), default="common")
+    # Версия инвентаря игрока, в которой стопка менялась последний раз (app.inventory_sync)
+    version = Column(Integer, nullable=False, default=0, server_default="0")
     
     player = relationship("Player", back_populates="inventory")
+    
+    __table_args__ = (
+        # Одна стопка на предмет: на нём держится upsert в crud.add_inventory_item
+        Index("uq_inventory_items_player_name", "player_id", "name", unique=True),
+        Index("ix_inventory_items_player_version", "player_id", "version"),
+    )
+
+
+class InventoryVersion(Base):
+    """Счётчик изменений инвентаря игрока. Строка появляется при первом изменении"""
+    __tablename__ = "inventory_versions"
+
+    player_id = Column(Integer, ForeignKey("players.id"), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    # Удаления до этой версии включительно уже вычищены — разница от более старой версии недоступна
+    pruned_version = Column(Integer, nullable=False, default=0)
+
+
+class InventoryTombstone(Base):
+    """Удалённая стопка: нужна, чтобы отдать клиенту её id в разнице инвентаря"""
+    __tablename__ = "inventory_tombstones"
+
+    id = Column(Integer, primary_key=True)
+    player_id = Column(Integer, nullable=False)
+    item_id = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_inventory_tombstones_player_version", "player_id", "version"),
+        Index("ix_inventory_tombstones_deleted_at", "deleted_at"),
+    )
 
 
 class Equipment(Base):
@@ -76,13 +119,19 @@ class OwnedSkin(Base):
     skin_id = Column(String(50), nullable=False)
     
     player = relationship("Player", back_populates="owned_skins")
+    
+    __table_args__ = (
+        # Скины игрока (bootstrap) и проход по игрокам в порядке id (scripts/player_dump.py)
+        Index("ix_owned_skins_player", "player_id"),
+    )
 
 
 class MarketListing(Base):
     __tablename__ = "market_listings"
 
     id = Column(Integer, primary_key=True, index=True)
-    seller_id = Column(Integer, ForeignKey("players.id"), nullable=False)
+    # Без внешнего ключа: при шардировании игроки на шардах, а биржа в глобальной БД
+    seller_id = Column(Integer, nullable=False)
     
     item_name = Column(String(100), nullable=False)
     item_icon = Column(String(10), nullable=False)
@@ -92,6 +141,198 @@ class MarketListing(Base):
     quantity = Column(Integer, default=1)
     
     is_active = Column(Boolean, default=True)
+    created_at = Column(SQLiteTimestamp, server_default=func.now())
+
+
+# Частичные индексы ленты биржи: в них только активные лоты, проданные их не раздувают.
+# Условие запроса is_active = true должно совпадать с условием индекса
+_active_listing = {
+    "sqlite_where": MarketListing.is_active == True,
+    "postgresql_where": MarketListing.is_active == True,
+}
+# Лента по умолчанию: ORDER BY created_at DESC, id DESC
+Index("ix_market_listings_active_created", MarketListing.created_at, MarketListing.id, **_active_listing)
+# Поиск по предмету (точно или по префиксу) с сортировкой и диапазоном по цене; сводка по предметам.
+# varchar_pattern_ops — чтобы Postgres использовал индекс для LIKE 'префикс%' при любой локали,
+# INCLUDE — чтобы сводка читалась только из индекса
+Index(
+    "ix_market_listings_active_item_price",
+    MarketListing.item_name, MarketListing.price, MarketListing.id,
+    postgresql_ops={"item_name": "varchar_pattern_ops"},
+    postgresql_include=["item_icon", "quantity"],
+    **_active_listing,
+)
+# Все предметы по цене и по редкости
+Index("ix_market_listings_active_price", MarketListing.price, MarketListing.id, **_active_listing)
+Index(
+    "ix_market_listings_active_rarity_price",
+    MarketListing.item_rarity, MarketListing.price, MarketListing.id,
+    **_active_listing,
+)
+# Лоты одного продавца
+Index(
+    "ix_market_listings_active_seller",
+    MarketListing.seller_id, MarketListing.created_at, MarketListing.id,
+    **_active_listing,
+)
+
+
+class MarketOrder(Base):
+    """Лимитная заявка биржи. Источник истины для стаканов в памяти (app/orderbook.py)"""
+    __tablename__ = "market_orders"
+
+    id = Column(Integer, primary_key=True, index=True)
+    player_id = Column(Integer, nullable=False)  # без внешнего ключа — как MarketListing.seller_id
+    
+    side = Column(String(4), nullable=False)  # buy / sell
+    item_name = Column(String(100), nullable=False)
+    item_icon = Column(String(10), nullable=False)
+    item_rarity = Column(String(20), default="common")
+    
+    price = Column(Integer, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    remaining = Column(Integer, nullable=False)
+    
+    status = Column(String(10), default="open")  # open / filled / cancelled
     created_at = Column(DateTime, server_default=func.now())
     
-    seller = relationship("Player")
\ No newline at end of file
+    __table_args__ = (
+        # Загрузка открытых заявок при старте и пересборка стакана одного предмета
+        Index("ix_market_orders_status_item", "status", "item_name", "id"),
+    )
+
+
+class MarketBookVersion(Base):
+    """Счётчик изменений стакана предмета: по нему воркеры узнают о чужих заявках, сделках и отменах"""
+    __tablename__ = "market_book_versions"
+
+    item_name = Column(String(100), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class MarketTrade(Base):
+    """Сделка биржи: покупка лота или исполнение заявки. Пишется в транзакции сделки"""
+    __tablename__ = "market_trades"
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    
+    item_name = Column(String(100), nullable=False)
+    price = Column(Integer, nullable=False)  # за штуку
+    quantity = Column(Integer, nullable=False)
+    
+    buyer_id = Column(Integer, nullable=False)
+    seller_id = Column(Integer, nullable=False)
+    # Источник сделки: лот или встречная заявка из стакана
+    listing_id = Column(Integer, nullable=True)
+    order_id = Column(Integer, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_market_trades_item_id", "item_name", "id"),
+        # Удаление по сроку хранения
+        Index("ix_market_trades_created", "created_at"),
+    )
+
+
+class PriceCandle(Base):
+    """Свеча OHLC по предмету. Обновляется на каждой сделке, не пересчитывается (app/price_history.py)"""
+    __tablename__ = "price_candles"
+
+    id = Column(Integer, primary_key=True)
+    item_name = Column(String(100), nullable=False)
+    resolution = Column(Integer, nullable=False)  # секунды: 60 / 3600 / 86400
+    bucket_start = Column(Integer, nullable=False)  # unix time начала интервала
+    
+    open = Column(Integer, nullable=False)
+    high = Column(Integer, nullable=False)
+    low = Column(Integer, nullable=False)
+    close = Column(Integer, nullable=False)
+    volume = Column(Integer, nullable=False)  # штук
+    trades = Column(Integer, nullable=False)
+    turnover = Column(Integer, nullable=False)  # сумма price * quantity, для средней цены
+    
+    __table_args__ = (
+        # Цель ON CONFLICT и чтение графика одним диапазоном
+        Index("uq_price_candles_item_res_start", "item_name", "resolution", "bucket_start", unique=True),
+        # Удаление старых мелких свечей по всем предметам сразу
+        Index("ix_price_candles_res_start", "resolution", "bucket_start"),
+    )
+
+
+class LedgerEntry(Base):
+    """Журнал изменений валюты и предметов. Пишется пачками фоновым потоком (app/ledger.py)"""
+    __tablename__ = "ledger_entries"
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    player_id = Column(Integer, nullable=False)
+    
+    kind = Column(String(10), nullable=False)  # currency / item
+    asset = Column(String(100), nullable=False)  # gold / crystals / имя предмета
+    # NULL — точное изменение неизвестно (обрезка до нуля), опорой служит balance
+    delta = Column(Integer, nullable=True)
+    balance = Column(Integer, nullable=True)
+    reason = Column(String(50), default="")
+    
+    __table_args__ = (
+        Index("ix_ledger_entries_player_asset", "player_id", "kind", "asset", "id"),
+    )
+
+
+class ReplicationHeartbeat(Base):
+    """
+    Метка времени, которую воркеры пишут на основную БД (app/replicas.py).
+    По тому, какую метку видит реплика, определяется её отставание
+    """
+    __tablename__ = "replication_heartbeat"
+
+    id = Column(Integer, primary_key=True)
+    beat_at = Column(Float, nullable=False)  # unix time воркера, записавшего метку
+
+
+class PlayerDirectory(Base):
+    """
+    Справочник игроков при шардировании (app/shards.py): на каком шарде данные игрока.
+    Живёт в глобальной БД и выдаёт id игроков — они уникальны на всех шардах
+    """
+    __tablename__ = "player_directory"
+
+    id = Column(Integer, primary_key=True)  # он же players.id на шарде
+    vk_id = Column(Integer, unique=True, nullable=False)
+    name = Column(String(100), nullable=False)
+    shard = Column(Integer, nullable=False)
+    # Идёт перенос на этот шард (scripts/rebalance_shards.py); NULL — игрок на месте
+    moving_to = Column(Integer, nullable=True)
+
+
+class ShardMessage(Base):
+    """
+    Исходящее сообщение другой БД (outbox): пишется в транзакции изменения,
+    удаляется после применения на получателе
+    """
+    __tablename__ = "shard_outbox"
+
+    id = Column(String(32), primary_key=True)  # uuid4, ключ идемпотентности у получателя
+    target = Column(Integer, nullable=False)  # номер шарда, -1 — глобальная БД
+    kind = Column(String(20), nullable=False)
+    payload = Column(JSON, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_shard_outbox_created", "created_at"),
+    )
+
+
+class ShardInbox(Base):
+    """Применённое сообщение: повторная доставка того же id ничего не меняет"""
+    __tablename__ = "shard_inbox"
+
+    id = Column(String(32), primary_key=True)
+    # Игрок, которому начислено: запись переносится на другой шард вместе с ним
+    player_id = Column(Integer, nullable=True)
+    applied_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_shard_inbox_player", "player_id"),
+        Index("ix_shard_inbox_applied", "applied_at"),
+    )
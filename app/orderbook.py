@@ -0,0 +1,261 @@
+import asyncio
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+from . import crud, models, schemas
+from .database import AsyncDB
+
+# === Стаканы заявок в памяти ===
+#
+# Источник истины — таблица market_orders. Стаканы строятся из неё при первом
+# обращении к бирже (не при старте воркера) и держат открытые заявки в кучах: лучшая цена за O(1), вставка и снятие за O(log n).
+# Приоритет — цена, затем время (id заявки растёт монотонно).
+#
+# Исполнение в БД условное (remaining >= qty AND status = 'open'), поэтому при
+# нескольких воркерах сделка не пройдёт дважды: если стакан устарел, он
+# перечитывается из БД и план сделок строится заново.
+#
+# Заявки, сделки и отмены других воркеров видны по версии стакана (market_book_versions):
+# каждая транзакция, меняющая заявки предмета, поднимает её. Перед исполнением и перед
+# выдачей стакан сверяет свою версию с БД — одно чтение строки по ключу; перечитывается
+# он только при расхождении. Своё изменение, следующее сразу за версией стакана,
+# применяется в памяти без перечитывания.
+
+MAX_MATCH_RETRIES = 3
+
+
+class BookOrder:
+    __slots__ = ("id", "player_id", "side", "price", "remaining")
+
+    def __init__(self, id: int, player_id: int, side: str, price: int, remaining: int):
+        self.id = id
+        self.player_id = player_id
+        self.side = side
+        self.price = price
+        self.remaining = remaining
+
+
+class OrderBook:
+    """Стакан одного предмета"""
+
+    def __init__(self, item_name: str):
+        self.item_name = item_name
+        self.lock = asyncio.Lock()
+        # Версия market_book_versions, которой соответствуют заявки в памяти
+        self.version = 0
+        self.orders: Dict[int, BookOrder] = {}
+        # Кучи с ленивым удалением: (ключ цены, id заявки)
+        self._bids: List[Tuple[int, int]] = []
+        self._asks: List[Tuple[int, int]] = []
+        # Остаток на каждом уровне цены — глубина без обхода заявок
+        self._levels: Dict[str, Dict[int, int]] = {"buy": {}, "sell": {}}
+
+    def clear(self):
+        self.orders.clear()
+        self._bids.clear()
+        self._asks.clear()
+        for levels in self._levels.values():
+            levels.clear()
+
+    def _change_level(self, order: BookOrder, quantity: int):
+        levels = self._levels[order.side]
+        total = levels.get(order.price, 0) + quantity
+        if total > 0:
+            levels[order.price] = total
+        else:
+            levels.pop(order.price, None)
+
+    def add(self, order: BookOrder):
+        self.orders[order.id] = order
+        self._change_level(order, order.remaining)
+        if order.side == "buy":
+            heapq.heappush(self._bids, (-order.price, order.id))
+        else:
+            heapq.heappush(self._asks, (order.price, order.id))
+
+    def remove(self, order_id: int):
+        # Запись в куче останется и будет выброшена при следующем обходе
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self._change_level(order, -order.remaining)
+
+    def fill(self, order_id: int, quantity: int):
+        order = self.orders.get(order_id)
+        if order is None:
+            return
+        taken = min(quantity, order.remaining)
+        order.remaining -= taken
+        self._change_level(order, -taken)
+        if order.remaining <= 0:
+            self.orders.pop(order_id)
+
+    def advance(self, version: int):
+        """
+        Своё изменение с версией version уже применено в памяти. Если перед ним были
+        чужие, версия не сдвигается — стакан перечитается при следующей сверке
+        """
+        if version == self.version + 1:
+            self.version = version
+
+    def _heap(self, side: str) -> List[Tuple[int, int]]:
+        return self._bids if side == "buy" else self._asks
+
+    def _prune(self, heap: List[Tuple[int, int]]):
+        while heap and heap[0][1] not in self.orders:
+            heapq.heappop(heap)
+
+    def best(self, side: str) -> Optional[BookOrder]:
+        heap = self._heap(side)
+        self._prune(heap)
+        return self.orders[heap[0][1]] if heap else None
+
+    def plan(self, side: str, price: int, quantity: int, player_id: int) -> List[Tuple[int, int, int]]:
+        """
+        План исполнения входящей заявки: [(id встречной, количество, цена)].
+        Стакан не меняется — изменения применяются только после commit в БД
+        """
+        heap = self._heap("sell" if side == "buy" else "buy")
+        fills = []
+        popped = []
+
+        while quantity > 0 and heap:
+            entry = heapq.heappop(heap)
+            resting = self.orders.get(entry[1])
+            if resting is None:
+                continue
+            popped.append(entry)
+
+            crosses = resting.price <= price if side == "buy" else resting.price >= price
+            if not crosses:
+                break
+            # Свои заявки пропускаем — сделки с самим собой не бывает
+            if resting.player_id == player_id:
+                continue
+
+            take = min(quantity, resting.remaining)
+            fills.append((resting.id, take, resting.price))
+            quantity -= take
+
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        return fills
+
+    def depth(self, side: str, levels: int) -> List[dict]:
+        """Агрегированные уровни цен, лучшие первыми"""
+        totals = self._levels[side]
+        pick = heapq.nlargest if side == "buy" else heapq.nsmallest
+        return [{"price": p, "quantity": totals[p]} for p in pick(levels, totals)]
+
+
+class MatchingEngine:
+    """Набор стаканов по предметам одного воркера"""
+
+    def __init__(self):
+        self.books: Dict[str, OrderBook] = {}
+        self.loaded = False
+        self._load_lock = asyncio.Lock()
+
+    def book(self, item_name: str) -> OrderBook:
+        book = self.books.get(item_name)
+        if book is None:
+            book = self.books[item_name] = OrderBook(item_name)
+        return book
+
+    @staticmethod
+    def _book_order(order: models.MarketOrder) -> BookOrder:
+        return BookOrder(order.id, order.player_id, order.side, order.price, order.remaining)
+
+    def _build(self, orders: List[models.MarketOrder], versions: Dict[str, int]):
+        self.books.clear()
+        for order in orders:
+            self.book(order.item_name).add(self._book_order(order))
+        for item_name, book in self.books.items():
+            book.version = versions.get(item_name, 0)
+        self.loaded = True
+
+    async def ensure_loaded(self, db: AsyncDB):
+        """Собрать стаканы при первом обращении; дальше — no-op"""
+        if self.loaded:
+            return
+        async with self._load_lock:
+            if not self.loaded:
+                self._build(*await db.run(crud.get_market_books))
+
+    async def _reload_book(self, db: AsyncDB, item_name: str):
+        # Читаем в пуле потоков, а стакан пересобираем уже в event loop
+        orders, version = await db.run(crud.get_market_book, item_name)
+        book = self.book(item_name)
+        book.clear()
+        for order in orders:
+            book.add(self._book_order(order))
+        book.version = version
+
+    async def _sync_book(self, db: AsyncDB, item_name: str):
+        # Вызывать под book.lock
+        version = await db.run(crud.get_market_book_version, item_name)
+        if version != self.book(item_name).version:
+            await self._reload_book(db, item_name)
+
+    async def place(self, db: AsyncDB, player_id: int, order: schemas.MarketOrderCreate, **options):
+        """
+        Поставить заявку и исполнить её по стакану. OrderRejected — не хватает ресурсов.
+        options — reserve и credit для crud.place_market_order (шардирование)
+        """
+        await self.ensure_loaded(db)
+        book = self.book(order.item_name)
+        async with book.lock:
+            await self._sync_book(db, order.item_name)
+            for attempt in range(MAX_MATCH_RETRIES):
+                fills = book.plan(order.side, order.price, order.quantity, player_id)
+                try:
+                    db_order, trades, version = await db.run(
+                        crud.place_market_order, player_id, order, fills, **options
+                    )
+                    break
+                except crud.BookConflict:
+                    if attempt == MAX_MATCH_RETRIES - 1:
+                        raise
+                    await self._reload_book(db, order.item_name)
+
+            for trade in trades:
+                book.fill(trade["order_id"], trade["quantity"])
+            if db_order.status == "open":
+                book.add(self._book_order(db_order))
+            book.advance(version)
+
+        return db_order, trades
+
+    async def cancel(self, db: AsyncDB, player_id: int, order_id: int, **options) -> Optional[models.MarketOrder]:
+        await self.ensure_loaded(db)
+        cancelled = await db.run(crud.cancel_market_order, player_id, order_id, **options)
+        if cancelled is None:
+            return None
+        order, version = cancelled
+        book = self.book(order.item_name)
+        book.remove(order.id)
+        book.advance(version)
+        return order
+
+    async def top_of_book(self, db: AsyncDB, item_name: str, levels: int = 5) -> dict:
+        """Лучшие цены и глубина стакана, сверенного с БД"""
+        await self.ensure_loaded(db)
+        book = self.books.get(item_name)
+        if book is None:
+            # Стаканы под произвольные имена из запроса не заводим
+            if not await db.run(crud.get_market_book_version, item_name):
+                return {"item_name": item_name, "best_bid": None, "best_ask": None, "bids": [], "asks": []}
+            book = self.book(item_name)
+        async with book.lock:
+            await self._sync_book(db, item_name)
+            best_bid = book.best("buy")
+            best_ask = book.best("sell")
+            return {
+                "item_name": item_name,
+                "best_bid": best_bid.price if best_bid else None,
+                "best_ask": best_ask.price if best_ask else None,
+                "bids": book.depth("buy", levels),
+                "asks": book.depth("sell", levels),
+            }
+
+
+matching_engine = MatchingEngine()
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import case, delete, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import AsyncDB
+
+logger = logging.getLogger(__name__)
+
+# === История цен биржи ===
+#
+# Каждая сделка (покупка лота, исполнение заявки) пишется в market_trades и в той же
+# транзакции обновляет свечи OHLC по предмету сразу во всех разрешениях одним
+# INSERT ... ON CONFLICT: high/low сравниваются с новой ценой, close заменяется,
+# объём и оборот прибавляются. Свечи никогда не пересчитываются из сделок.
+#
+# Мелкие свечи и сырые сделки старше срока хранения удаляет фоновая задача —
+# их данные уже учтены в более крупных свечах, поэтому объём таблиц ограничен.
+
+RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+
+# Срок хранения свечей по разрешению, секунды. None — бессрочно
+RETENTION = {
+    60: int(os.getenv("PRICE_1M_RETENTION_DAYS", "2")) * 86400,
+    3600: int(os.getenv("PRICE_1H_RETENTION_DAYS", "90")) * 86400,
+    86400: None,
+}
+TRADES_RETENTION_DAYS = int(os.getenv("PRICE_TRADES_RETENTION_DAYS", "30"))
+PRICE_COMPACT_INTERVAL = float(os.getenv("PRICE_COMPACT_INTERVAL", "600"))
+
+SERIES_MAX = 1000
+
+_candles = models.PriceCandle.__table__
+_CANDLE_KEY = ["item_name", "resolution", "bucket_start"]
+
+
+def _candle_upsert(db: Session):
+    stmt = (pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert)(_candles)
+    new = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=_CANDLE_KEY,
+        set_={
+            "high": case((new.high > _candles.c.high, new.high), else_=_candles.c.high),
+            "low": case((new.low < _candles.c.low, new.low), else_=_candles.c.low),
+            "close": new.close,
+            "volume": _candles.c.volume + new.volume,
+            "trades": _candles.c.trades + new.trades,
+            "turnover": _candles.c.turnover + new.turnover,
+        },
+    )
+
+
+def record_trades(db: Session, item_name: str, trades: List[dict], now: Optional[float] = None):
+    """
+    Записать сделки по предмету и обновить свечи. Без commit — в транзакции сделки.
+    trades: [{price, quantity, buyer_id, seller_id, listing_id?, order_id?}] в порядке исполнения
+    """
+    if not trades:
+        return
+    now = time.time() if now is None else now
+    created_at = datetime.utcfromtimestamp(now)
+
+    db.execute(insert(models.MarketTrade), [
+        {
+            "created_at": created_at, "item_name": item_name,
+            "price": t["price"], "quantity": t["quantity"],
+            "buyer_id": t["buyer_id"], "seller_id": t["seller_id"],
+            "listing_id": t.get("listing_id"), "order_id": t.get("order_id"),
+        }
+        for t in trades
+    ])
+
+    # Все сделки одного вызова попадают в одни и те же интервалы — сворачиваем их заранее
+    prices = [t["price"] for t in trades]
+    candle = {
+        "item_name": item_name,
+        "open": prices[0],
+        "high": max(prices),
+        "low": min(prices),
+        "close": prices[-1],
+        "volume": sum(t["quantity"] for t in trades),
+        "trades": len(trades),
+        "turnover": sum(t["price"] * t["quantity"] for t in trades),
+    }
+    db.execute(_candle_upsert(db).values([
+        {**candle, "resolution": seconds, "bucket_start": int(now) // seconds * seconds}
+        for seconds in RESOLUTIONS.values()
+    ]))
+
+
+def get_series(
+    db: Session, item_name: str, resolution: int, before: Optional[int] = None, limit: int = 200
+) -> List[dict]:
+    """
+    Последние limit свечей предмета (до before, unix time) по возрастанию времени.
+    Интервалы без сделок пропущены — клиент рисует их по close предыдущей свечи
+    """
+    query = select(
+        _candles.c.bucket_start, _candles.c.open, _candles.c.high, _candles.c.low,
+        _candles.c.close, _candles.c.volume, _candles.c.trades, _candles.c.turnover,
+    ).where(_candles.c.item_name == item_name, _candles.c.resolution == resolution)
+    if before is not None:
+        query = query.where(_candles.c.bucket_start < before)
+    # Один диапазон уникального индекса с конца
+    rows = db.execute(query.order_by(_candles.c.bucket_start.desc()).limit(limit)).all()
+
+    return [
+        {
+            "time": row.bucket_start, "open": row.open, "high": row.high, "low": row.low,
+            "close": row.close, "volume": row.volume, "trades": row.trades,
+            "avg_price": round(row.turnover / row.volume, 2) if row.volume else row.close,
+        }
+        for row in reversed(rows)
+    ]
+
+
+def compact(db: Session, now: Optional[float] = None) -> int:
+    """Удалить свечи и сделки старше срока хранения. Возвращает число удалённых строк"""
+    now = time.time() if now is None else now
+    deleted = 0
+    for resolution, retention in RETENTION.items():
+        if retention is None:
+            continue
+        deleted += db.execute(
+            delete(models.PriceCandle).where(
+                models.PriceCandle.resolution == resolution,
+                models.PriceCandle.bucket_start < int(now) - retention,
+            )
+        ).rowcount
+    deleted += db.execute(
+        delete(models.MarketTrade).where(
+            models.MarketTrade.created_at < datetime.utcfromtimestamp(now) - timedelta(days=TRADES_RETENTION_DAYS)
+        )
+    ).rowcount
+    db.commit()
+    return deleted
+
+
+async def compaction_loop(interval: float = PRICE_COMPACT_INTERVAL):
+    """Периодическая очистка истории. Запускается из lifespan, останавливается отменой задачи"""
+    while True:
+        db = AsyncDB()
+        try:
+            deleted = await db.run(compact)
+            if deleted:
+                logger.info("Price history compaction removed %d rows", deleted)
+        except Exception:
+            logger.exception("Price history compaction failed")
+        finally:
+            await db.close()
+        await asyncio.sleep(interval)
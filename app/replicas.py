@@ -0,0 +1,214 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from typing import List, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import sessionmaker
+
+from . import models
+from .cache import TTLCache
+from .database import (
+    DB_MODE, DB_PROFILE, AsyncDB, engine, make_async_engine, make_engine,
+)
+
+logger = logging.getLogger(__name__)
+
+# === Реплики для чтения ===
+#
+# Чтения, которым не нужна самая свежая запись (лента биржи, история цен,
+# инвентарь и профиль игрока), идут на реплики из DATABASE_REPLICA_URLS;
+# записи и всё остальное — на основную БД.
+#
+# Отставание реплики меряется меткой времени: воркер раз в DB_REPLICA_CHECK_INTERVAL
+# пишет её на основную БД и читает с каждой реплики. Реплика, которая не видит
+# записанную больше DB_REPLICA_MAX_LAG секунд назад метку или не отвечает,
+# выводится из ротации до следующей удачной проверки. Способ репликации не важен —
+# потоковая репликация Postgres или копии файлов SQLite при локальной проверке.
+#
+# Read-your-writes: после запроса игрока, меняющего данные, его чтения
+# DB_READ_YOUR_WRITES секунд идут на основную БД; так же — снимки ленты биржи после
+# изменения лотов. Окно держит память воркера — оно должно перекрывать допустимое
+# отставание плюс интервал проверки.
+
+REPLICA_URLS = [
+    url.strip().replace("postgres://", "postgresql://", 1)
+    for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+REPLICA_POLICY = os.getenv("DB_REPLICA_POLICY", "round_robin").lower()
+REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "2"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "1"))
+READ_YOUR_WRITES = float(os.getenv("DB_READ_YOUR_WRITES", "5"))
+
+if REPLICA_POLICY not in ("round_robin", "least_loaded"):
+    raise ValueError(f"Unknown DB_REPLICA_POLICY: {REPLICA_POLICY}")
+
+# Запросы, которые меняют данные игрока и открывают окно read-your-writes
+WRITE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
+_HEARTBEAT_ID = 1
+
+
+class Replica:
+    """Реплика: свои engine и фабрики сессий, состояние проверки и счётчики"""
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self.engine = make_engine(url, DB_PROFILE)
+        # Как у основной БД в потоковом режиме: объекты читаются после закрытия транзакции
+        self.sessions = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=self.engine)
+        self.async_engine = None
+        self.async_sessions = None
+        if DB_MODE == "async":
+            from sqlalchemy.ext.asyncio import async_sessionmaker
+
+            self.async_engine = make_async_engine(url, DB_PROFILE)
+            self.async_sessions = async_sessionmaker(self.async_engine, autoflush=False, expire_on_commit=False)
+
+        # До первой удачной проверки реплика не используется
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.inflight = 0
+        self.reads = 0
+        self.ejections = 0
+
+    def eject(self, reason: str):
+        if self.healthy:
+            self.ejections += 1
+            logger.warning("Replica %s ejected: %s", self.name, reason)
+        self.healthy = False
+
+    def admit(self):
+        if not self.healthy:
+            logger.info("Replica %s admitted, lag %.2f s", self.name, self.lag or 0.0)
+        self.healthy = True
+
+    async def dispose(self):
+        self.engine.dispose()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
+
+class ReadRouter:
+    """Выбор базы для чтения. Используется из event loop, проверка реплик — в потоке"""
+
+    def __init__(self, urls: List[str], policy: str = REPLICA_POLICY, max_lag: float = REPLICA_MAX_LAG,
+                 read_your_writes: float = READ_YOUR_WRITES):
+        self.replicas = [Replica(f"replica{i}", url) for i, url in enumerate(urls, 1)]
+        self.policy = policy
+        self.max_lag = max_lag
+        self.primary_reads = 0
+        self._turn = itertools.count()
+        self._recent_writes = TTLCache(maxsize=100000, ttl=read_your_writes)
+        # Метки, записанные этим воркером, по возрастанию
+        self._beats = deque(maxlen=1000)
+
+    def note_write(self, key):
+        """Данные изменились (key — id игрока или имя раздела) — их чтения какое-то время идут на основную БД"""
+        if self.replicas:
+            self._recent_writes.set(key, True)
+
+    def pick(self, key=None) -> Optional[Replica]:
+        """Реплика для чтения или None — читать с основной БД"""
+        replica = None
+        if self.replicas and (key is None or self._recent_writes.get(key) is None):
+            healthy = [r for r in self.replicas if r.healthy]
+            if healthy:
+                start = next(self._turn) % len(healthy)
+                if self.policy == "least_loaded":
+                    # При равной нагрузке — по кругу, чтобы не грузить всегда первую
+                    replica = min(healthy[start:] + healthy[:start], key=lambda r: r.inflight)
+                else:
+                    replica = healthy[start]
+        if replica is None:
+            self.primary_reads += 1
+        else:
+            replica.reads += 1
+        return replica
+
+    def session(self, key=None) -> AsyncDB:
+        return AsyncDB(replica=self.pick(key))
+
+    # --- Проверка отставания ---
+
+    def _write_heartbeat(self) -> float:
+        beat = time.time()
+        heartbeat = models.ReplicationHeartbeat.__table__
+        with engine.begin() as conn:
+            if conn.execute(update(heartbeat).where(heartbeat.c.id == _HEARTBEAT_ID).values(beat_at=beat)).rowcount == 0:
+                conn.execute(heartbeat.insert().values(id=_HEARTBEAT_ID, beat_at=beat))
+        self._beats.append(beat)
+        return beat
+
+    def _lag(self, seen: Optional[float], now: float) -> float:
+        """Сколько секунд назад записана самая старая метка, которой реплика ещё не видит"""
+        if seen is None:
+            return float("inf")
+        if not self._beats or seen < self._beats[0]:
+            # Реплика отстала дальше меток этого воркера — оценка сверху
+            return max(0.0, now - seen)
+        for beat in self._beats:
+            if beat > seen:
+                return now - beat
+        return 0.0
+
+    def check(self):
+        """Записать метку и проверить реплики. Блокирующий — вызывается в потоке"""
+        self._write_heartbeat()
+        heartbeat = models.ReplicationHeartbeat.__table__
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as conn:
+                    seen = conn.execute(select(heartbeat.c.beat_at).where(heartbeat.c.id == _HEARTBEAT_ID)).scalar()
+            except Exception as e:
+                replica.lag = None
+                replica.eject(f"check failed: {e.__class__.__name__}")
+                continue
+            replica.lag = self._lag(seen, time.time())
+            if replica.lag > self.max_lag:
+                replica.eject(f"lag {replica.lag:.2f} s")
+            else:
+                replica.admit()
+
+    def stats(self) -> dict:
+        return {
+            "primary_reads": self.primary_reads,
+            "replicas": {
+                r.name: {
+                    "healthy": r.healthy, "lag": r.lag, "inflight": r.inflight,
+                    "reads": r.reads, "ejections": r.ejections,
+                }
+                for r in self.replicas
+            },
+        }
+
+    async def dispose(self):
+        for replica in self.replicas:
+            await replica.dispose()
+
+
+read_router = ReadRouter(REPLICA_URLS)
+
+
+async def health_loop(interval: float = REPLICA_CHECK_INTERVAL):
+    """Периодическая проверка реплик. Запускается из lifespan, останавливается отменой задачи"""
+    while True:
+        try:
+            await asyncio.to_thread(read_router.check)
+        except Exception:
+            logger.exception("Replica health check failed")
+        await asyncio.sleep(interval)
+
+
+async def get_read_db():
+    """Сессия для чтения, не привязанного к игроку"""
+    db = read_router.session()
+    try:
+        yield db
+    finally:
+        await db.close()
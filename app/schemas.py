@@ -67,6 +67,32 @@ class InventoryItemResponse(InventoryItemBase):
         from_attributes = True
 
 
+class InventoryChanges(BaseModel):
+    """Изменения инвентаря после версии клиента. full — в items весь инвентарь, локальный заменить"""
+    version: int
+    full: bool
+    items: List[InventoryItemResponse]
+    deleted: List[int]
+
+
+class BootstrapResponse(BaseModel):
+    """Всё для первого экрана клиента одним ответом"""
+    player: PlayerResponse
+    inventory: List[InventoryItemResponse]
+    inventory_version: int
+    owned_skins: List[str]
+
+
+class InventoryOperation(BaseModel):
+    op: str  # add / use / remove
+    item_id: Optional[int] = None
+    name: Optional[str] = None
+    icon: Optional[str] = None
+    quantity: int = 1
+    item_type: str = "material"
+    rarity: str = "common"
+
+
 # === Биржа ===
 
 class MarketListingCreate(BaseModel):
@@ -91,8 +117,35 @@ class MarketListingResponse(BaseModel):
         from_attributes = True
 
 
+class MarketSearch(BaseModel):
+    """Фильтры ленты биржи. sort: newest — новые первыми, price — дешёвые первыми (цена за штуку)"""
+    item_name: Optional[str] = None
+    item_prefix: Optional[str] = None
+    rarity: Optional[str] = None
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    seller_id: Optional[int] = None
+    sort: str = "newest"
+
+
+class MarketOrderCreate(BaseModel):
+    side: str  # buy / sell
+    item_name: str
+    item_icon: str
+    item_rarity: str = "common"
+    price: int
+    quantity: int = 1
+
+
 # === VK Auth ===
 
+class AuthContext(BaseModel):
+    vk_id: int
+    player_id: int
+    # Шард с данными игрока (app/shards.py); без шардирования всегда 0
+    shard: int = 0
+
+
 class VKAuthParams(BaseModel):
     vk_user_id: int
     sign: str
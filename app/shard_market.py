@@ -0,0 +1,202 @@
+import logging
+from functools import partial
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from . import crud, currency, models, schemas, shards
+from .database import AsyncDB
+from .orderbook import matching_engine
+from .shards import GLOBAL, handler, shard_router
+
+logger = logging.getLogger(__name__)
+
+# === Биржа при шардировании ===
+#
+# Лоты, заявки и сделки — в глобальной БД, золото и предметы — на шардах игроков.
+# Поток каждой операции: списание на шарде того, кто действует, + сообщение в
+# глобальную БД (app/shards.py), затем обработчик в глобальной БД и начисления
+# участникам сообщениями на их шарды. Сессии открываются по одной — запрос не
+# держит два слота сессий сразу.
+
+
+# --- Обработчики в глобальной БД ---
+
+@handler("listing_create")
+def _create_listing(db: Session, payload: dict) -> int:
+    listing = models.MarketListing(**payload)
+    db.add(listing)
+    db.flush()
+    return listing.id
+
+
+@handler("market_buy")
+def _settle_buy(db: Session, payload: dict) -> Dict[int, str]:
+    # Ключи JSON — строки; сообщение, доставленное в том же запросе, ещё с целыми
+    paid = {int(listing_id): cost for listing_id, cost in payload["paid"].items()}
+    return crud.settle_listing_purchase(db, payload["buyer_id"], paid, credit=shards.credit_remote)
+
+
+@handler("order_place")
+def _refund_order(db: Session, payload: dict):
+    # Сюда сообщение доходит, только если заявка не встала (запрос упал или отклонён):
+    # иначе его id уже записал в inbox резерв заявки — возвращаем зарезервированное
+    if payload["side"] == "buy":
+        shards.credit_remote(db, payload["player_id"], gold=payload["price"] * payload["quantity"], reason="order_refund")
+    else:
+        item = {key: payload[key] for key in ("item_name", "item_icon", "item_rarity", "quantity")}
+        shards.credit_remote(db, payload["player_id"], items=[item], reason="order_refund")
+
+
+# --- Шаги на шарде игрока ---
+
+def _take_for_listing(db: Session, player_id: int, listing: schemas.MarketListingCreate) -> Optional[dict]:
+    shards.fence(db, player_id)
+    if not crud.take_inventory_item(db, player_id, listing.item_name, listing.quantity, "market_listing"):
+        db.rollback()
+        return None
+    message = shards.send(db, GLOBAL, "listing_create", {"seller_id": player_id, **listing.dict()})
+    db.commit()
+    return message
+
+
+def _pay_for_listings(
+    db: Session, buyer_id: int, listing_ids: List[int], costs: Dict[int, int]
+) -> Tuple[Dict[int, int], Optional[dict]]:
+    """Списать золото за лоты по порядку, пока хватает. Возвращает {id лота: списано} и сообщение"""
+    shards.fence(db, buyer_id)
+    gold = db.execute(select(models.Player.gold).where(models.Player.id == buyer_id)).scalar() or 0
+    paid = {}
+    for listing_id in listing_ids:
+        cost = costs.get(listing_id)
+        if cost is not None and cost <= gold:
+            gold -= cost
+            paid[listing_id] = cost
+    if not paid:
+        db.rollback()
+        return {}, None
+    if currency.change_balance(db, buyer_id, {"gold": -sum(paid.values())}, commit=False, reason="market_buy") is None:
+        # Параллельная трата того же покупателя — золота уже не хватает
+        db.rollback()
+        return {}, None
+    message = shards.send(db, GLOBAL, "market_buy", {"buyer_id": buyer_id, "paid": paid})
+    db.commit()
+    return paid, message
+
+
+def _reserve_order(db: Session, player_id: int, order: schemas.MarketOrderCreate) -> Optional[dict]:
+    shards.fence(db, player_id)
+    if not crud.reserve_for_order(db, player_id, order):
+        db.rollback()
+        return None
+    message = shards.send(db, GLOBAL, "order_place", {"player_id": player_id, **order.dict()})
+    db.commit()
+    return message
+
+
+def _active_listings(db: Session, listing_ids: List[int]) -> Dict[int, tuple]:
+    listing = models.MarketListing
+    rows = db.execute(
+        select(listing.id, listing.item_name, listing.price, listing.quantity)
+        .where(listing.id.in_(listing_ids), listing.is_active == True)
+    ).all()
+    db.rollback()
+    return {row.id: row for row in rows}
+
+
+# --- Операции для эндпоинтов ---
+
+async def _run(shard: int, fn, *args):
+    db = shard_router.session(shard)
+    try:
+        return await db.run(fn, *args)
+    finally:
+        await db.close()
+
+
+async def _deliver(source: int, message: dict):
+    """Доставка в запросе; не вышло — сообщение дошлёт delivery_loop, результат None"""
+    try:
+        return await shard_router.deliver(source, message)
+    except Exception:
+        logger.exception("Delivery of %s message %s failed", message["kind"], message["id"])
+        return None
+
+
+async def sell(player_id: int, shard: int, listing: schemas.MarketListingCreate) -> Tuple[bool, Optional[int]]:
+    """Выставить лот. (False, None) — предметов не хватает; id лота None — лот ещё создаётся"""
+    message = await _run(shard, _take_for_listing, player_id, listing)
+    if message is None:
+        return False, None
+    return True, await _deliver(shard, message)
+
+
+async def buy_listings(player_id: int, shard: int, listing_ids: List[int]) -> List[dict]:
+    """
+    Как crud.buy_market_listings, но золото списывается на шарде покупателя до снятия
+    лотов: лот, который тем временем купил другой, возвращается золотом (market_refund).
+    pending — покупка ещё не завершена, результат придёт начислением
+    """
+    listing_ids = list(dict.fromkeys(listing_ids))
+    listings = await _run(GLOBAL, _active_listings, listing_ids)
+    costs = {listing_id: row.price * row.quantity for listing_id, row in listings.items()}
+    paid, message = await _run(shard, _pay_for_listings, player_id, listing_ids, costs)
+    statuses = await _deliver(shard, message) if message is not None else {}
+
+    results = []
+    for listing_id in listing_ids:
+        if listing_id not in listings:
+            results.append({"listing_id": listing_id, "status": "unavailable"})
+        elif listing_id not in paid:
+            results.append({"listing_id": listing_id, "status": "not_enough_gold"})
+        elif statuses is None:
+            results.append({"listing_id": listing_id, "status": "pending"})
+        elif statuses[listing_id] == "bought":
+            row = listings[listing_id]
+            results.append({
+                "listing_id": listing_id, "status": "bought", "item_name": row.item_name,
+                "price": row.price, "quantity": row.quantity,
+            })
+        else:
+            results.append({"listing_id": listing_id, "status": statuses[listing_id]})
+    return results
+
+
+async def place_order(db: AsyncDB, player_id: int, shard: int, order: schemas.MarketOrderCreate):
+    """
+    Как matching_engine.place: резерв на шарде игрока, заявка и сделки в глобальной БД (db).
+    Резерв подтверждается записью id сообщения в inbox в транзакции заявки — если заявка
+    не встала, то же сообщение вернёт резерв (обработчик order_place)
+    """
+    message = await _run(shard, _reserve_order, player_id, order)
+    if message is None:
+        raise crud.OrderRejected()
+    try:
+        db_order, trades = await matching_engine.place(
+            db, player_id, order, reserve=partial(shards.accept, message=message), credit=shards.credit_remote
+        )
+        credits = await db.run(shards.committed_messages)
+        # Сессию закрываем до доставки — поля заявки читаем, пока она открыта
+        db_order = SimpleNamespace(id=db_order.id, status=db_order.status, remaining=db_order.remaining)
+    except Exception:
+        await db.close()
+        await _deliver(shard, message)
+        raise
+    await db.close()
+    try:
+        await shard_router.ack(shard, [message["id"]])
+    except Exception:
+        # Не страшно: delivery_loop найдёт сообщение уже применённым и удалит
+        logger.exception("Ack of order_place message %s failed", message["id"])
+    await shard_router.deliver_all(GLOBAL, credits)
+    return db_order, trades
+
+
+async def cancel_order(db: AsyncDB, player_id: int, order_id: int) -> Optional[models.MarketOrder]:
+    order = await matching_engine.cancel(db, player_id, order_id, credit=shards.credit_remote)
+    credits = await db.run(shards.committed_messages)
+    await db.close()
+    await shard_router.deliver_all(GLOBAL, credits)
+    return order
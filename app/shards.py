@@ -0,0 +1,638 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from sqlalchemy import delete, event, func, insert, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import crud, models
+from .database import (
+    DATABASE_URL, DB_MODE, DB_PROFILE, AsyncDB, AsyncSessionLocal, ThreadSessionLocal,
+    async_engine, engine, make_async_engine, make_engine,
+)
+
+logger = logging.getLogger(__name__)
+
+# === Шардирование данных игроков ===
+#
+# Данные игрока (players, equipment, inventory_items, owned_skins, версии инвентаря)
+# лежат на одном из шардов DATABASE_SHARD_URLS. Глобальная БД (DATABASE_URL) хранит
+# справочник игроков (player_directory), биржу, историю цен и журнал экономики.
+# Без DATABASE_SHARD_URLS всё в одной БД, как раньше. Шард может совпадать с
+# глобальной БД — так начинается переход с одной базы.
+#
+# Маршрут. Справочник выдаёт id игроков (уникальные на всех шардах) и хранит шард
+# игрока; новый игрок попадает на шард vk_id % N. Шард игрока лежит в AuthContext,
+# то есть в кэше авторизации, и запрос берёт сессию нужного шарда без обращения
+# к справочнику.
+#
+# Забор (fence). Кэш маршрутов в памяти воркера может устареть после переноса
+# игрока, поэтому сессия шарда начинается с проверки, что игрок на этом шарде:
+# SELECT ... FOR SHARE на Postgres держит строку игрока до конца транзакции, и
+# перенос ждёт её. На SQLite SELECT блокировку не держит — проверка повторяется перед
+# commit под блокировкой записи. Игрока нет — PlayerMoved: воркер забывает маршрут,
+# клиент получает 503 с Retry-After и при повторе идёт на новый шард.
+#
+# Операции между шардами (покупка у игрока с другого шарда, заявки биржи) — без
+# распределённых транзакций:
+#   1. Списание — всегда у того, кто действует, в транзакции его шарда. В той же
+#      транзакции пишется сообщение в outbox (shard_outbox) для глобальной БД.
+#   2. Глобальная БД применяет сообщение (снимает лоты, пишет сделки) в одной
+#      транзакции с записью id сообщения в inbox (shard_inbox) и пишет начисления
+#      участникам в свой outbox.
+#   3. Начисление на шарде получателя — тоже в транзакции с записью в inbox.
+# Начисление не может не пройти, поэтому откатывать списания не нужно: лот, который
+# успели купить другие, возвращается покупателю начислением. Повторная доставка того
+# же сообщения ничего не меняет (id уже в inbox), поэтому сообщения доставляются
+# «хотя бы раз»: сразу после commit в запросе, а то, что осталось после сбоя,
+# дошлёт delivery_loop через SHARD_OUTBOX_GRACE секунд.
+
+SHARD_URLS = [
+    url.strip().replace("postgres://", "postgresql://", 1)
+    for url in os.getenv("DATABASE_SHARD_URLS", "").split(",")
+    if url.strip()
+]
+SHARD_OUTBOX_GRACE = float(os.getenv("SHARD_OUTBOX_GRACE", "30"))
+SHARD_OUTBOX_INTERVAL = float(os.getenv("SHARD_OUTBOX_INTERVAL", "5"))
+SHARD_INBOX_RETENTION_HOURS = int(os.getenv("SHARD_INBOX_RETENTION_HOURS", "24"))
+OUTBOX_BATCH = 500
+
+# Получатель сообщения — глобальная БД
+GLOBAL = -1
+
+_FENCE_KEY = "shard_fence"
+_OUTBOX_KEY = "shard_outbox"
+_SENT_KEY = "shard_sent"
+
+
+class PlayerMoved(Exception):
+    """Игрока нет на этом шарде: перенесён или переносится"""
+
+    def __init__(self, player_id: int):
+        super().__init__(f"Player {player_id} is not on this shard")
+        self.player_id = player_id
+
+
+def _insert(db: Session, model):
+    if db.get_bind().dialect.name == "postgresql":
+        return pg_insert(model)
+    return sqlite_insert(model)
+
+
+class Shard:
+    """Шард: свои engine и фабрики сессий. Шард в глобальной БД использует её engine"""
+
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.name = f"shard{index}"
+        self.url = url
+        self.shared = url == DATABASE_URL
+        if self.shared:
+            self.engine = engine
+            self.sessions = ThreadSessionLocal
+            self.async_engine = async_engine
+            self.async_sessions = AsyncSessionLocal
+            return
+
+        self.engine = make_engine(url, DB_PROFILE)
+        self.sessions = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=self.engine)
+        self.async_engine = None
+        self.async_sessions = None
+        if DB_MODE == "async":
+            from sqlalchemy.ext.asyncio import async_sessionmaker
+
+            self.async_engine = make_async_engine(url, DB_PROFILE)
+            self.async_sessions = async_sessionmaker(self.async_engine, autoflush=False, expire_on_commit=False)
+
+    async def dispose(self):
+        if self.shared:
+            return
+        self.engine.dispose()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
+
+# --- Справочник игроков (глобальная БД) ---
+
+def find_player(db: Session, vk_id: int):
+    """Запись справочника (id, shard, moving_to) или None"""
+    directory = models.PlayerDirectory
+    return db.execute(
+        select(directory.id, directory.shard, directory.moving_to).where(directory.vk_id == vk_id)
+    ).first()
+
+
+def register_player(db: Session, vk_id: int, shard: int):
+    """Id и шард нового игрока. Параллельная регистрация того же vk_id получает ту же запись"""
+    db.execute(
+        _insert(db, models.PlayerDirectory)
+        .values(vk_id=vk_id, name=crud.player_name(vk_id), shard=shard)
+        .on_conflict_do_nothing()
+    )
+    db.commit()
+    return find_player(db, vk_id)
+
+
+def player_shards(db: Session, player_ids: List[int]) -> Dict[int, int]:
+    if not player_ids:
+        return {}
+    directory = models.PlayerDirectory
+    return dict(db.execute(select(directory.id, directory.shard).where(directory.id.in_(player_ids))).all())
+
+
+def get_player_names(db: Session, player_ids: List[int]) -> dict:
+    """Как crud.get_player_names, но из справочника — игроки на разных шардах"""
+    if not player_ids:
+        return {}
+    directory = models.PlayerDirectory
+    rows = db.execute(select(directory.id, directory.name).where(directory.id.in_(player_ids)))
+    return {row.id: row.name for row in rows}
+
+
+# --- Забор ---
+
+def fence(db: Session, player_id: int):
+    """
+    Проверить, что игрок на шарде этой сессии, и не дать перенести его до конца
+    транзакции. PlayerMoved — игрока здесь нет
+    """
+    query = select(models.Player.id).where(models.Player.id == player_id)
+    if db.get_bind().dialect.name == "postgresql":
+        query = query.with_for_update(read=True)
+    if db.execute(query).first() is None:
+        raise PlayerMoved(player_id)
+    db.info.setdefault(_FENCE_KEY, set()).add(player_id)
+
+
+@event.listens_for(Session, "before_commit")
+def _recheck_fence(session):
+    # SQLite: проверка в fence шла без блокировки — перенос мог пройти между ней и записью.
+    # Здесь транзакция уже держит блокировку записи и видит последнее состояние
+    players = session.info.get(_FENCE_KEY)
+    if not players or session.get_bind().dialect.name != "sqlite":
+        return
+    found = set(session.scalars(select(models.Player.id).where(models.Player.id.in_(players))))
+    for player_id in players - found:
+        raise PlayerMoved(player_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    session.info.pop(_FENCE_KEY, None)
+    sent = session.info.pop(_OUTBOX_KEY, None)
+    if sent:
+        session.info.setdefault(_SENT_KEY, []).extend(sent)
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop(_FENCE_KEY, None)
+    session.info.pop(_OUTBOX_KEY, None)
+
+
+# --- Сообщения между БД ---
+
+HANDLERS: Dict[str, Callable] = {}
+
+
+def handler(kind: str):
+    """Обработчик сообщения: fn(db, payload) в транзакции получателя, без commit"""
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def send(db: Session, target: int, kind: str, payload: dict) -> dict:
+    """Сообщение в outbox — уйдёт только вместе с текущей транзакцией. Без commit"""
+    message = {"id": uuid.uuid4().hex, "target": target, "kind": kind, "payload": payload}
+    db.execute(insert(models.ShardMessage).values(created_at=datetime.utcnow(), **message))
+    db.info.setdefault(_OUTBOX_KEY, []).append(message)
+    return message
+
+
+def committed_messages(db: Session) -> List[dict]:
+    """Сообщения, записанные в закоммиченных транзакциях сессии: их пора доставить"""
+    return db.info.pop(_SENT_KEY, [])
+
+
+def accept(db: Session, message: dict) -> bool:
+    """Записать id сообщения в inbox. False — уже применено. Без commit"""
+    # player_id — только у начислений: их записи переезжают вместе с игроком
+    player_id = message["payload"].get("player_id") if message["kind"] == "credit" else None
+    result = db.execute(
+        _insert(db, models.ShardInbox)
+        .values(id=message["id"], player_id=player_id, applied_at=datetime.utcnow())
+        .on_conflict_do_nothing()
+    )
+    return result.rowcount == 1
+
+
+def apply_message(db: Session, message: dict):
+    """Применить сообщение один раз. Возвращает результат обработчика; None — уже применено"""
+    if not accept(db, message):
+        db.rollback()
+        return None
+    result = HANDLERS[message["kind"]](db, message["payload"])
+    db.commit()
+    return result
+
+
+def _apply(db: Session, message: dict):
+    return apply_message(db, message), committed_messages(db)
+
+
+def credit_remote(db: Session, player_id: int, gold: int = 0, items: List[dict] = (), reason: str = "credit"):
+    """Начисление на шард игрока сообщением. Сигнатура как у crud.credit_player. Без commit"""
+    if not gold and not items:
+        return
+    shard = player_shards(db, [player_id]).get(player_id)
+    if shard is None:
+        raise LookupError(f"Player {player_id} is not in the directory")
+    send(db, shard, "credit", {"player_id": player_id, "gold": gold, "items": list(items), "reason": reason})
+
+
+@handler("credit")
+def _apply_credit(db: Session, payload: dict):
+    fence(db, payload["player_id"])
+    crud.credit_player(db, payload["player_id"], payload.get("gold", 0), payload.get("items", []), payload["reason"])
+
+
+def _ack(db: Session, message_ids: List[str]):
+    db.execute(delete(models.ShardMessage).where(models.ShardMessage.id.in_(message_ids)))
+    db.commit()
+
+
+def _pending_messages(db: Session, before: datetime, limit: int) -> List[dict]:
+    outbox = models.ShardMessage
+    rows = db.execute(
+        select(outbox.id, outbox.target, outbox.kind, outbox.payload)
+        .where(outbox.created_at < before)
+        .order_by(outbox.created_at)
+        .limit(limit)
+    ).all()
+    db.rollback()
+    return [dict(row._mapping) for row in rows]
+
+
+def prune_inbox(db: Session, before: datetime) -> int:
+    """
+    Забыть применённые сообщения старше срока: повторная доставка возможна, только
+    пока сообщение лежит в outbox отправителя, а delivery_loop досылает его за секунды
+    """
+    deleted = db.execute(delete(models.ShardInbox).where(models.ShardInbox.applied_at < before)).rowcount
+    db.commit()
+    return deleted
+
+
+class ShardRouter:
+    """Шарды воркера: сессии по номеру шарда и доставка сообщений между БД"""
+
+    def __init__(self, urls: List[str]):
+        self.shards = [Shard(index, url) for index, url in enumerate(urls)]
+        self.delivered = 0
+        self.recovered = 0
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.shards)
+
+    def place(self, vk_id: int) -> int:
+        """Шард нового игрока"""
+        return vk_id % len(self.shards)
+
+    def session(self, shard: int) -> AsyncDB:
+        """Сессия шарда; GLOBAL или работа без шардов — глобальная БД"""
+        if shard == GLOBAL or not self.shards:
+            return AsyncDB()
+        return AsyncDB(shard=self.shards[shard])
+
+    def player_sessions(self) -> List[AsyncDB]:
+        """По сессии на каждую БД с игроками — для обхода всех игроков"""
+        return [self.session(shard.index) for shard in self.shards] or [AsyncDB()]
+
+    def engines(self) -> list:
+        """Engine шардов, кроме глобальной БД"""
+        return [shard.engine for shard in self.shards if not shard.shared]
+
+    async def _resolve(self, player_id: int) -> int:
+        db = self.session(GLOBAL)
+        try:
+            shard = (await db.run(player_shards, [player_id])).get(player_id)
+        finally:
+            await db.close()
+        if shard is None:
+            raise LookupError(f"Player {player_id} is not in the directory")
+        return shard
+
+    async def ack(self, source: int, message_ids: List[str]):
+        """Удалить доставленные сообщения из outbox отправителя"""
+        db = self.session(source)
+        try:
+            await db.run(_ack, message_ids)
+        finally:
+            await db.close()
+
+    async def deliver(self, source: int, message: dict):
+        """
+        Применить сообщение у получателя и удалить его из outbox отправителя; затем
+        доставить сообщения, которые записал обработчик (начисления после сделки).
+        Возвращает результат обработчика; None — сообщение уже применено раньше
+        """
+        target = message["target"]
+        for attempt in range(2):
+            db = self.session(target)
+            try:
+                result, sent = await db.run(_apply, message)
+                break
+            except PlayerMoved as e:
+                # Получатель начисления переехал — шлём на его новый шард, id сообщения тот же
+                if attempt:
+                    raise
+                target = await self._resolve(e.player_id)
+            finally:
+                await db.close()
+
+        await self.ack(source, [message["id"]])
+        self.delivered += 1
+        if sent:
+            await self.deliver_all(target, sent)
+        return result
+
+    async def deliver_all(self, source: int, messages: List[dict]):
+        """
+        Доставить сообщения, не дожидаясь отказавших: их дошлёт delivery_loop.
+        Каждая доставка держит одну сессию за раз — параллельные доставки не ждут друг друга
+        """
+        results = await asyncio.gather(
+            *(self.deliver(source, message) for message in messages), return_exceptions=True
+        )
+        for message, result in zip(messages, results):
+            if isinstance(result, Exception):
+                logger.warning("Delivery of %s message %s failed: %r", message["kind"], message["id"], result)
+
+    async def deliver_pending(self, grace: float = SHARD_OUTBOX_GRACE) -> int:
+        """Дослать сообщения, которые не доставил запрос (сбой воркера или получателя)"""
+        before = datetime.utcnow() - timedelta(seconds=grace)
+        delivered = 0
+        # Шард в глобальной БД делит с ней outbox
+        for source in [GLOBAL] + [shard.index for shard in self.shards if not shard.shared]:
+            db = self.session(source)
+            try:
+                messages = await db.run(_pending_messages, before, OUTBOX_BATCH)
+            finally:
+                await db.close()
+            for message in messages:
+                try:
+                    await self.deliver(source, message)
+                    delivered += 1
+                except Exception:
+                    logger.exception("Delivery of %s message %s failed", message["kind"], message["id"])
+        self.recovered += delivered
+        return delivered
+
+    async def prune(self) -> int:
+        before = datetime.utcnow() - timedelta(hours=SHARD_INBOX_RETENTION_HOURS)
+        deleted = 0
+        for source in [GLOBAL] + [shard.index for shard in self.shards if not shard.shared]:
+            db = self.session(source)
+            try:
+                deleted += await db.run(prune_inbox, before)
+            finally:
+                await db.close()
+        return deleted
+
+    def stats(self) -> dict:
+        return {
+            "shards": len(self.shards),
+            "delivered": self.delivered,
+            "recovered": self.recovered,
+        }
+
+    async def dispose(self):
+        for shard in self.shards:
+            await shard.dispose()
+
+
+shard_router = ShardRouter(SHARD_URLS)
+
+
+async def delivery_loop(interval: float = SHARD_OUTBOX_INTERVAL):
+    """Досылка сообщений и очистка inbox. Запускается из lifespan, останавливается отменой задачи"""
+    rounds = 0
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            delivered = await shard_router.deliver_pending()
+            if delivered:
+                logger.info("Shard outbox: delivered %d pending messages", delivered)
+            rounds += 1
+            if rounds % 720 == 0:
+                await shard_router.prune()
+        except Exception:
+            logger.exception("Shard outbox delivery failed")
+
+
+# === Перенос игроков между шардами ===
+#
+# Онлайн, по одному игроку (scripts/rebalance_shards.py):
+#   1. Справочник: moving_to = целевой шард. Пока он стоит, отсутствие игрока на
+#      шарде значит «переносится», а не «новый игрок» — воркер не создаст его заново.
+#   2. Источник: UPDATE строки игрока — блокировка; записи игрока (fence) ждут её.
+#      Снимок всех строк игрока.
+#   3. Цель: копия строк, commit. Id стопок на цели новые, поэтому версия инвентаря
+#      поднимается, а pruned_version равна ей — клиенты перечитают инвентарь целиком.
+#   4. Источник: удаление строк игрока, commit — это и есть момент переноса. Ждавшие
+#      записи получают PlayerMoved.
+#   5. Справочник: shard = цель, moving_to = NULL.
+# Сбой между 3 и 4 — игрок остаётся на источнике, копия на цели лишняя; между 4 и 5 —
+# игрок уже на цели. Оба случая по moving_to разбирает repair; до него игрок в первом
+# случае работает как обычно, во втором получает 503. Потерянных записей нет.
+
+_PLAYER_TABLES = (
+    models.InventoryItem, models.Equipment, models.OwnedSkin,
+    models.InventoryVersion, models.InventoryTombstone,
+)
+
+
+def _rows(db: Session, model, *conditions) -> List[dict]:
+    return [dict(row._mapping) for row in db.execute(select(model.__table__).where(*conditions))]
+
+
+def _snapshot(db: Session, player_id: int) -> dict:
+    return {
+        "player": _rows(db, models.Player, models.Player.id == player_id),
+        "tables": {
+            model.__tablename__: _rows(db, model, model.player_id == player_id) for model in _PLAYER_TABLES
+        },
+        "inbox": _rows(db, models.ShardInbox, models.ShardInbox.player_id == player_id),
+    }
+
+
+def _remove_player(db: Session, player_id: int):
+    for model in _PLAYER_TABLES + (models.ShardInbox,):
+        db.execute(delete(model).where(model.player_id == player_id))
+    db.execute(delete(models.Player).where(models.Player.id == player_id))
+
+
+def _copy_player(db: Session, snapshot: dict):
+    db.execute(insert(models.Player), snapshot["player"])
+    tables = snapshot["tables"]
+    version = max([row["version"] for row in tables["inventory_versions"]], default=0) + 1
+    for model in (models.Equipment, models.OwnedSkin, models.InventoryItem):
+        rows = [{k: v for k, v in row.items() if k != "id"} for row in tables[model.__tablename__]]
+        if rows:
+            db.execute(insert(model), rows)
+    # Удаления до переноса клиенту не отдать (id стопок другие) — только весь инвентарь
+    db.execute(insert(models.InventoryVersion).values(
+        player_id=snapshot["player"][0]["id"], version=version, pruned_version=version
+    ))
+    if snapshot["inbox"]:
+        db.execute(insert(models.ShardInbox), snapshot["inbox"])
+
+
+def move_player(router: ShardRouter, player_id: int, target: int) -> bool:
+    """Перенести игрока на шард target. False — он уже там. Блокирующий — для скриптов"""
+    directory = models.PlayerDirectory
+    with Session(engine) as g:
+        entry = g.get(directory, player_id)
+        if entry is None:
+            raise LookupError(f"Player {player_id} is not in the directory")
+        if entry.moving_to is not None:
+            raise RuntimeError(f"Player {player_id} is already moving, run repair")
+        if entry.shard == target:
+            return False
+        source = entry.shard
+        entry.moving_to = target
+        g.commit()
+
+    src = router.shards[source].sessions()
+    dst = router.shards[target].sessions()
+    try:
+        locked = src.execute(
+            update(models.Player).where(models.Player.id == player_id).values(vk_id=models.Player.vk_id)
+        ).rowcount
+        if locked != 1:
+            raise RuntimeError(f"Player {player_id} is not on shard {source}, run repair")
+        snapshot = _snapshot(src, player_id)
+        # Остатки прерванного переноса
+        _remove_player(dst, player_id)
+        _copy_player(dst, snapshot)
+        dst.commit()
+        _remove_player(src, player_id)
+        src.commit()
+    except Exception:
+        src.rollback()
+        dst.rollback()
+        with Session(engine) as g:
+            g.execute(update(directory).where(directory.id == player_id).values(moving_to=None))
+            g.commit()
+        raise
+    finally:
+        src.close()
+        dst.close()
+
+    with Session(engine) as g:
+        g.execute(update(directory).where(directory.id == player_id).values(shard=target, moving_to=None))
+        g.commit()
+    return True
+
+
+def _has_player(router: ShardRouter, shard: int, player_id: int) -> bool:
+    with router.shards[shard].sessions() as db:
+        return db.get(models.Player, player_id) is not None
+
+
+def repair(router: ShardRouter) -> Dict[str, int]:
+    """Довести или откатить прерванные переносы (moving_to не пуст)"""
+    directory = models.PlayerDirectory
+    result = {"finished": 0, "rolled_back": 0, "lost": 0}
+    with Session(engine) as g:
+        entries = g.execute(
+            select(directory.id, directory.shard, directory.moving_to).where(directory.moving_to.isnot(None))
+        ).all()
+    for player_id, source, target in entries:
+        if _has_player(router, source, player_id):
+            # Источник не успел удалить — он главный, копия на цели лишняя
+            with router.shards[target].sessions() as db:
+                _remove_player(db, player_id)
+                db.commit()
+            values, outcome = {"moving_to": None}, "rolled_back"
+        elif _has_player(router, target, player_id):
+            values, outcome = {"shard": target, "moving_to": None}, "finished"
+        else:
+            logger.error("Player %d is on neither shard %d nor %d", player_id, source, target)
+            result["lost"] += 1
+            continue
+        with Session(engine) as g:
+            g.execute(update(directory).where(directory.id == player_id).values(**values))
+            g.commit()
+        result[outcome] += 1
+    return result
+
+
+def init_directory(router: ShardRouter) -> int:
+    """
+    Заполнить справочник игроками, которые уже лежат на шардах (переход с одной БД:
+    первый шард — прежняя база). Возвращает число добавленных записей
+    """
+    added = 0
+    with Session(engine) as g:
+        for shard in router.shards:
+            with shard.sessions() as db:
+                players = db.execute(select(models.Player.id, models.Player.vk_id, models.Player.name)).all()
+            for start in range(0, len(players), 1000):
+                rows = [
+                    {"id": row.id, "vk_id": row.vk_id, "name": row.name or crud.player_name(row.vk_id), "shard": shard.index}
+                    for row in players[start:start + 1000]
+                ]
+                added += g.execute(_insert(g, models.PlayerDirectory).values(rows).on_conflict_do_nothing()).rowcount
+        if g.get_bind().dialect.name == "postgresql":
+            # Id вставлены явно — последовательность справочника должна начинаться после них
+            g.execute(text(
+                "SELECT setval(pg_get_serial_sequence('player_directory', 'id'), "
+                "GREATEST((SELECT max(id) FROM player_directory), 1))"
+            ))
+        g.commit()
+    return added
+
+
+def shard_counts(db: Session) -> Dict[int, int]:
+    """Игроков на каждом шарде по справочнику"""
+    directory = models.PlayerDirectory
+    return dict(db.execute(select(directory.shard, func.count()).group_by(directory.shard)).all())
+
+
+def plan_rebalance(router: ShardRouter, limit: int) -> List[tuple]:
+    """
+    Переносы (id игрока, откуда, куда), выравнивающие число игроков на шардах:
+    с самого загруженного на самый свободный, сначала самые новые игроки
+    """
+    directory = models.PlayerDirectory
+    with Session(engine) as g:
+        counts = shard_counts(g)
+        counts = {shard.index: counts.get(shard.index, 0) for shard in router.shards}
+        moves = []
+        taken = {}
+        while len(moves) < limit:
+            source = max(counts, key=counts.get)
+            target = min(counts, key=counts.get)
+            if counts[source] - counts[target] <= 1:
+                break
+            offset = taken.get(source, 0)
+            player_id = g.scalar(
+                select(directory.id).where(directory.shard == source, directory.moving_to.is_(None))
+                .order_by(directory.id.desc()).offset(offset).limit(1)
+            )
+            if player_id is None:
+                break
+            taken[source] = offset + 1
+            counts[source] -= 1
+            counts[target] += 1
+            moves.append((player_id, source, target))
+    return moves
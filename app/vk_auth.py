@@ -6,7 +6,21 @@ import os
 
 VK_APP_SECRET = os.getenv("VK_APP_SECRET", "test_secret")
 
-def verify_vk_signature(query_string: str) -> bool:
+# Состояние HMAC с ключом считается один раз при импорте, на запрос — только copy()
+_SIGN_KEY = hmac.new(VK_APP_SECRET.encode(), digestmod=hashlib.sha256)
+
+
+def parse_vk_params(query_string: str) -> dict:
+    """
+    Разбирает строку параметров запуска VK (первое значение каждого ключа)
+    """
+    try:
+        return {k: v[0] for k, v in parse_qs(query_string.lstrip('?')).items()}
+    except Exception:
+        return {}
+
+
+def verify_vk_signature(params: dict) -> bool:
     """
     Проверяет подпись VK
     В тестовом режиме пропускаем проверку
@@ -16,40 +30,33 @@ def verify_vk_signature(query_string: str) -> bool:
         return True
     
     try:
-        parsed = parse_qs(query_string.lstrip('?'))
-        received_sign = parsed.get('sign', [None])[0]
+        received_sign = params.get('sign')
         
         if not received_sign:
             return False
         
-        vk_params = {k: v[0] for k, v in parsed.items() if k.startswith('vk_')}
-        sorted_params = sorted(vk_params.items())
-        params_string = urlencode(sorted_params)
+        vk_params = sorted((k, v) for k, v in params.items() if k.startswith('vk_'))
+        params_string = urlencode(vk_params)
         
-        sign = base64.b64encode(
-            hmac.new(
-                VK_APP_SECRET.encode(),
-                params_string.encode(),
-                hashlib.sha256
-            ).digest()
-        ).decode()
+        mac = _SIGN_KEY.copy()
+        mac.update(params_string.encode())
+        sign = base64.b64encode(mac.digest()).decode()
         
         sign = sign.replace('+', '-').replace('/', '_').rstrip('=')
         
-        return sign == received_sign
+        return hmac.compare_digest(sign, received_sign)
         
     except Exception as e:
         print(f"VK signature error: {e}")
         return False
 
 
-def get_vk_user_id(query_string: str):
+def get_vk_user_id(params: dict):
     """
     Получает VK ID из параметров
     """
     try:
-        parsed = parse_qs(query_string.lstrip('?'))
-        vk_user_id = parsed.get('vk_user_id', [None])[0]
+        vk_user_id = params.get('vk_user_id')
         return int(vk_user_id) if vk_user_id else None
     except:
-        return None
\ No newline at end of file
+        return None
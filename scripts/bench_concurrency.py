@@ -0,0 +1,107 @@
+"""
+Бенчмарк конкурентных запросов: старый блокирующий путь (DB_MODE=inline)
+против неблокирующего (threads / async).
+
+Каждый режим запускается в отдельном процессе на временной SQLite-базе.
+Задержка сети до БД эмулируется через --latency-ms (sleep перед каждым запросом к БД).
+Для DB_MODE=async эмуляция блокирует event loop, поэтому async-режим
+имеет смысл мерить только на реальном Postgres (DATABASE_URL + --latency-ms 0).
+
+    python -m scripts.bench_concurrency --requests 400 --concurrency 50 --latency-ms 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def run_child(args):
+    import httpx
+    from sqlalchemy import event
+
+    from app import database, migrations
+    from app.main import app
+
+    migrations.upgrade(database.engine)
+
+    if args.latency_ms:
+        delay = args.latency_ms / 1000
+
+        def simulate_rtt(*_):
+            time.sleep(delay)
+
+        target = database.async_engine.sync_engine if database.async_engine else database.engine
+        event.listen(target, "before_cursor_execute", simulate_rtt)
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            # Прогрев: создаём игроков заранее
+            for vk_id in range(1, args.players + 1):
+                await client.get("/api/player", headers={"X-VK-Params": f"?vk_user_id={vk_id}"})
+
+            sem = asyncio.Semaphore(args.concurrency)
+            latencies = []
+
+            async def one(i):
+                headers = {"X-VK-Params": f"?vk_user_id={i % args.players + 1}"}
+                async with sem:
+                    started = time.perf_counter()
+                    resp = await client.get("/api/player", headers=headers)
+                    latencies.append(time.perf_counter() - started)
+                    assert resp.status_code == 200, resp.text
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(args.requests)))
+            elapsed = time.perf_counter() - started
+
+        if database.async_engine is not None:
+            await database.async_engine.dispose()
+        latencies.sort()
+        return {
+            "mode": database.DB_MODE,
+            "rps": round(args.requests / elapsed, 1),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2),
+            "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        }
+
+    print(json.dumps(asyncio.run(main())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--modes", default="inline,threads")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    results = []
+    for mode in args.modes.split(","):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Мерим режимы БД, а не защиту от перегрузки — допуск и лимиты выключены
+            env = dict(os.environ, DB_MODE=mode, DEBUG="true", ADMISSION_MAX_INFLIGHT="0", RATE_LIMIT_RPS="0")
+            env.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+            out = subprocess.run(
+                [sys.executable, "-m", "scripts.bench_concurrency", "--child", *sys.argv[1:]],
+                env=env, capture_output=True, text=True, check=True,
+            )
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print(f"{'mode':<8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['rps']:>8} {r['p50_ms']:>8} {r['p99_ms']:>8}")
+
+
+if __name__ == "__main__":
+    main()
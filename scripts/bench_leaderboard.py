@@ -0,0 +1,104 @@
+"""
+Бенчмарк таблицы лидеров на синтетических игроках.
+
+Строит индексы app.leaderboard в памяти (без БД) и меряет построение, память,
+обновления очков, место игрока, топ-N и окно «вокруг меня». С --sql для сравнения
+считает место игрока запросом COUNT(*) по таблице players во временной SQLite.
+
+    python -m scripts.bench_leaderboard --players 1000000
+    python -m scripts.bench_leaderboard --players 1000000 --sql
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+
+def timed(label: str, ops: int, fn):
+    started = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {ops / elapsed:>12,.0f} ops/s  {elapsed / ops * 1e6:>8.1f} µs/op")
+
+
+def bench_index(players: int, ops: int, rng: random.Random):
+    from app.leaderboard import METRICS, Leaderboard
+
+    rows = [
+        (player_id, rng.randint(1, 100), int(rng.paretovariate(1.2) * 100), rng.randint(0, 5000))
+        for player_id in range(1, players + 1)
+    ]
+
+    started = time.perf_counter()
+    board = Leaderboard()
+    board.load_rows(rows)
+    build = time.perf_counter() - started
+
+    # Память — отдельной сборкой: tracemalloc в разы замедляет построение
+    tracemalloc.start()
+    traced = Leaderboard()
+    traced.load_rows(rows)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced, rows
+    print(f"build {players:,} players x {len(METRICS)} metrics: {build:.2f} s, "
+          f"memory {current / 2**20:.0f} MiB (peak {peak / 2**20:.0f} MiB)")
+
+    player_ids = [rng.randint(1, players) for _ in range(ops)]
+    gold = [rng.randint(0, 100000) for _ in range(ops)]
+    timed("update gold", ops, lambda i: board.update(player_ids[i], "gold", gold[i]))
+    timed("rank of player", ops, lambda i: board.rank("gold", player_ids[i]))
+    timed("top 100", ops // 10, lambda i: board.top("gold", 0, 100))
+    timed("page at offset 500k", ops // 10, lambda i: board.top("gold", min(500_000, players - 20), 20))
+
+    def around(i):
+        rank, _ = board.rank("gold", player_ids[i])
+        board.top("gold", max(0, rank - 6), 11)
+
+    timed("around me (±5)", ops, around)
+    return board
+
+
+def bench_sql(players: int, queries: int, rng: random.Random):
+    from sqlalchemy import create_engine, text
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'leaderboard.db')}")
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE players (id INTEGER PRIMARY KEY, gold INTEGER NOT NULL)"))
+            conn.execute(text("CREATE INDEX ix_players_gold ON players (gold)"))
+            conn.execute(
+                text("INSERT INTO players (id, gold) VALUES (:id, :gold)"),
+                [{"id": i, "gold": int(rng.paretovariate(1.2) * 100)} for i in range(1, players + 1)],
+            )
+
+        rank = text(
+            "SELECT COUNT(*) + 1 FROM players p, players me WHERE me.id = :id "
+            "AND (p.gold > me.gold OR (p.gold = me.gold AND p.id < me.id))"
+        )
+        with engine.connect() as conn:
+            ids = [rng.randint(1, players) for _ in range(queries)]
+            timed("SQL COUNT(*) rank (indexed)", queries, lambda i: conn.execute(rank, {"id": ids[i]}).scalar())
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=1_000_000)
+    parser.add_argument("--ops", type=int, default=100_000)
+    parser.add_argument("--sql", action="store_true", help="сравнить с COUNT(*) в SQLite")
+    parser.add_argument("--sql-queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bench_index(args.players, args.ops, rng)
+    if args.sql:
+        bench_sql(args.players, args.sql_queries, rng)
+
+
+if __name__ == "__main__":
+    main()
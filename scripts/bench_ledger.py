@@ -0,0 +1,61 @@
+"""
+Накладные расходы журнала экономики на запрос.
+
+Меряет ledger.record + передачу событий в очередь после commit на пустой
+транзакции (без записи в БД), пока фоновый поток не пишет, и отдельно —
+скорость сброса очереди в ledger_entries пачками.
+
+    python -m scripts.bench_ledger --events 200000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--per-request", type=int, default=2, help="событий на одну транзакцию")
+    parser.add_argument("--batch", type=int, default=500, help="размер пачки при сбросе")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'ledger.db')}"
+    os.environ.setdefault("LEDGER_MAX_PENDING", str(args.events * 2))
+    # Горячий путь меряем без конкурирующего сброса
+    os.environ["LEDGER_FLUSH_INTERVAL"] = "3600"
+    os.environ["LEDGER_FLUSH_SIZE"] = str(args.events * 2)
+
+    from app import ledger, migrations
+    from app.database import SessionLocal, engine
+
+    migrations.upgrade(engine)
+    writer = ledger.ledger_writer
+    db = SessionLocal()
+    requests = args.events // args.per_request
+
+    # Ровно то, что журнал добавляет к запросу: record() и хук after_commit
+    started = time.perf_counter()
+    for i in range(requests):
+        for _ in range(args.per_request):
+            ledger.record(db, i, "currency", "gold", -1, 100, "bench")
+        ledger._emit_after_commit(db)
+    elapsed = time.perf_counter() - started
+    db.close()
+
+    overhead_us = elapsed / requests * 1e6
+    print(f"per request ({args.per_request} events): {overhead_us:.2f} µs overhead")
+    print(f"per event: {overhead_us / args.per_request:.2f} µs")
+
+    writer.flush_size = args.batch
+    started = time.perf_counter()
+    writer.stop()
+    flush_time = time.perf_counter() - started
+    stats = writer.stats()
+    print(f"flushed {stats['written']} rows in {stats['flushes']} batches of {args.batch}: "
+          f"{stats['written'] / flush_time:.0f} rows/s, dropped {stats['dropped']}")
+
+
+if __name__ == "__main__":
+    main()
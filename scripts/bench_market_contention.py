@@ -0,0 +1,160 @@
+"""
+Бенчмарк покупок на бирже под конкуренцией: много покупателей одновременно
+пытаются купить одни и те же «горячие» лоты.
+
+Режимы:
+    single — каждый покупатель покупает свои лоты по одному (POST /api/market/buy/{id})
+    cart   — все лоты покупателя одним запросом (POST /api/market/buy)
+
+После каждого режима проверяется, что ни один лот не продан дважды (по market_trades)
+и что золото сошлось: списано с покупателей ровно столько, сколько стоят купленные лоты.
+
+    python -m scripts.bench_market_contention --buyers 200 --hot 50 --per-buyer 5 --rounds 5
+
+Без DATABASE_URL используется временная SQLite-база.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+async def run(args):
+    import httpx
+    from sqlalchemy import func, insert, select, update
+
+    from app import database, migrations, models
+    from app.main import app
+    from scripts.loadtest import vk_params
+    from scripts.seed import seed
+
+    migrations.upgrade(database.engine)
+    rng = random.Random(args.seed)
+    seeded = seed(database.engine, args.buyers + 10, 0, rng=rng)
+    buyers = list(zip(seeded["player_ids"][:args.buyers], seeded["vk_ids"][:args.buyers]))
+    sellers = seeded["player_ids"][args.buyers:]
+    with database.engine.begin() as conn:
+        conn.execute(update(models.Player).values(gold=10**9))
+
+    def create_hot_listings():
+        with database.engine.begin() as conn:
+            first = conn.execute(select(func.coalesce(func.max(models.MarketListing.id), 0))).scalar() + 1
+            conn.execute(insert(models.MarketListing), [
+                {"seller_id": rng.choice(sellers), "item_name": "Кристалл", "item_icon": "💎",
+                 "item_rarity": "epic", "price": rng.randint(10, 100), "quantity": 1, "is_active": True}
+                for _ in range(args.hot)
+            ])
+        return list(range(first, first + args.hot))
+
+    def gold_of(player_ids):
+        with database.engine.connect() as conn:
+            return conn.execute(
+                select(func.sum(models.Player.gold)).where(models.Player.id.in_(player_ids))
+            ).scalar()
+
+    buyer_ids = [pid for pid, _ in buyers]
+    headers = {pid: {"X-VK-Params": vk_params(vk_id)} for pid, vk_id in buyers}
+    results = {}
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60) as client:
+            for pid in buyer_ids:
+                await client.get("/api/inventory", headers=headers[pid])
+
+            for mode in args.modes.split(","):
+                bought = errors = requests = 0
+                elapsed = 0.0
+                listing_ids = []
+                gold_before = gold_of(buyer_ids)
+
+                for _ in range(args.rounds):
+                    hot = create_hot_listings()
+                    listing_ids.extend(hot)
+                    wanted = {pid: rng.sample(hot, args.per_buyer) for pid in buyer_ids}
+
+                    async def single(pid):
+                        nonlocal bought, errors, requests
+                        for listing_id in wanted[pid]:
+                            resp = await client.post(f"/api/market/buy/{listing_id}", headers=headers[pid])
+                            requests += 1
+                            if resp.status_code == 200:
+                                bought += 1
+                            elif resp.status_code >= 500:
+                                errors += 1
+
+                    async def cart(pid):
+                        nonlocal bought, errors, requests
+                        resp = await client.post("/api/market/buy", headers=headers[pid],
+                                                 json={"listing_ids": wanted[pid]})
+                        requests += 1
+                        if resp.status_code == 200:
+                            bought += sum(1 for r in resp.json()["results"] if r["status"] == "bought")
+                        elif resp.status_code >= 500:
+                            errors += 1
+
+                    buy = single if mode == "single" else cart
+                    started = time.perf_counter()
+                    await asyncio.gather(*(buy(pid) for pid in buyer_ids))
+                    elapsed += time.perf_counter() - started
+
+                with database.engine.connect() as conn:
+                    sold = conn.execute(
+                        select(models.MarketTrade.listing_id, func.count())
+                        .where(models.MarketTrade.listing_id.in_(listing_ids))
+                        .group_by(models.MarketTrade.listing_id)
+                    ).all()
+                    inactive = conn.execute(
+                        select(func.count()).where(
+                            models.MarketListing.id.in_(listing_ids), models.MarketListing.is_active == False
+                        )
+                    ).scalar()
+                    sold_value = conn.execute(
+                        select(func.coalesce(func.sum(models.MarketListing.price * models.MarketListing.quantity), 0))
+                        .where(models.MarketListing.id.in_(listing_ids), models.MarketListing.is_active == False)
+                    ).scalar()
+
+                results[mode] = {
+                    "trades_per_s": round(bought / elapsed, 1),
+                    "bought": bought,
+                    "listings_sold": inactive,
+                    "double_sells": sum(1 for _, count in sold if count > 1),
+                    "gold_mismatch": (gold_before - gold_of(buyer_ids)) - sold_value,
+                    "requests": requests,
+                    "errors": errors,
+                    "elapsed_s": round(elapsed, 2),
+                }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buyers", type=int, default=200)
+    parser.add_argument("--hot", type=int, default=50, help="лотов в одном раунде")
+    parser.add_argument("--per-buyer", type=int, default=5, help="лотов, которые хочет каждый покупатель")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--modes", default="single,cart")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if not os.getenv("DATABASE_URL"):
+        tmp = tempfile.TemporaryDirectory()
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp.name, 'contention.db')}"
+    # Мерим саму покупку — лимиты игрока и контроль допуска выключены
+    os.environ.setdefault("RATE_LIMIT_RPS", "0")
+    os.environ.setdefault("ADMISSION_MAX_INFLIGHT", "0")
+
+    results = asyncio.run(run(args))
+    columns = ["trades_per_s", "bought", "listings_sold", "double_sells", "gold_mismatch", "requests", "errors",
+               "elapsed_s"]
+    print(f"{'mode':<8}" + "".join(f"{name:>15}" for name in columns))
+    for mode, r in results.items():
+        print(f"{mode:<8}" + "".join(f"{r[name]:>15}" for name in columns))
+    if any(r["double_sells"] or r["gold_mismatch"] for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
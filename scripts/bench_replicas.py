@@ -0,0 +1,217 @@
+"""
+Проверка маршрутизации чтений на реплики на локальных файлах SQLite.
+
+Основная БД и реплики — отдельные файлы во временном каталоге. Поток-«репликатор»
+копирует основную БД в реплики через sqlite3 backup раз в --replication-delay секунд,
+так что реплики отстают, как настоящие. Проверяется:
+
+    распределение чтений   — сколько чтений ушло на каждую реплику и на основную БД
+    read-your-writes       — игрок добавляет предмет и сразу читает инвентарь: предмет
+                             должен быть виден; для сравнения — то же чтение прямо с реплики
+    вывод из ротации       — репликация на одну реплику останавливается: реплика должна
+                             выйти из ротации, а после возобновления вернуться
+
+    python -m scripts.bench_replicas --policy round_robin
+    python -m scripts.bench_replicas --policy least_loaded --replicas 3
+
+Код выхода 1 — нарушен read-your-writes или отстающая реплика не выведена из ротации.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+
+class Replicator(threading.Thread):
+    """Копирует основную БД в реплики по таймеру; paused — реплики, которые не обновляются"""
+
+    def __init__(self, primary: str, replicas: list, delay: float):
+        super().__init__(daemon=True)
+        self.primary = primary
+        self.replicas = replicas
+        self.delay = delay
+        self.paused = set()
+        self.copies = 0
+        self._stop_event = threading.Event()
+
+    def copy(self, replica: str):
+        source = sqlite3.connect(self.primary)
+        target = sqlite3.connect(replica)
+        try:
+            target.execute("PRAGMA busy_timeout=5000")
+            source.backup(target)
+            self.copies += 1
+        finally:
+            target.close()
+            source.close()
+
+    def run(self):
+        while not self._stop_event.wait(self.delay):
+            for replica in self.replicas:
+                if replica not in self.paused:
+                    self.copy(replica)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+async def wait_for(condition, timeout: float) -> float:
+    """Ждать condition(); возвращает затраченное время или -1 по таймауту"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if condition():
+            return time.perf_counter() - started
+        await asyncio.sleep(0.05)
+    return -1.0
+
+
+async def run(args, replicator: Replicator, vk_ids: list) -> dict:
+    import httpx
+
+    from app import crud
+    from app.main import app
+    from app.replicas import read_router
+    from scripts.loadtest import vk_params
+
+    headers = {vk_id: {"X-VK-Params": vk_params(vk_id)} for vk_id in vk_ids}
+    rng = random.Random(args.seed)
+    results = {}
+
+    def reads():
+        stats = read_router.stats()
+        return {"primary": stats["primary_reads"], **{name: r["reads"] for name, r in stats["replicas"].items()}}
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            healthy = await wait_for(lambda: all(r.healthy for r in read_router.replicas), 10)
+            if healthy < 0:
+                raise RuntimeError("replicas did not become healthy")
+            player_ids = {}
+            for vk_id in vk_ids:
+                player_ids[vk_id] = (await client.get("/api/player", headers=headers[vk_id])).json()["id"]
+            # Окно read-your-writes после регистрации должно закрыться
+            await asyncio.sleep(args.read_your_writes + 0.5)
+
+            # --- Распределение чтений ---
+            before = reads()
+            sem = asyncio.Semaphore(args.concurrency)
+
+            async def read_one():
+                async with sem:
+                    if rng.random() < 0.5:
+                        await client.get("/api/inventory", headers=headers[rng.choice(vk_ids)])
+                    else:
+                        await client.get("/api/market/summary")
+
+            started = time.perf_counter()
+            await asyncio.gather(*(read_one() for _ in range(args.reads)))
+            elapsed = time.perf_counter() - started
+            after = reads()
+            results["distribution"] = {name: after[name] - before[name] for name in after}
+            results["distribution"]["reads_per_s"] = round(args.reads / elapsed, 1)
+
+            # --- Read-your-writes ---
+            violations = stale_on_replica = 0
+            for i in range(args.writes):
+                vk_id = rng.choice(vk_ids)
+                name = f"Руна {i}"
+                await client.post("/api/inventory/add", headers=headers[vk_id],
+                                  json={"name": name, "icon": "ᚱ", "quantity": 1})
+                inventory = (await client.get("/api/inventory", headers=headers[vk_id])).json()
+                if not any(item["name"] == name for item in inventory):
+                    violations += 1
+                # То же чтение без окна read-your-writes — прямо с реплики
+                db = read_router.session()
+                try:
+                    items = await db.run(crud.get_inventory, player_ids[vk_id])
+                finally:
+                    await db.close()
+                if not any(item.name == name for item in items):
+                    stale_on_replica += 1
+            results["read_your_writes"] = {
+                "writes": args.writes, "violations": violations, "stale_if_read_from_replica": stale_on_replica,
+            }
+
+            # --- Вывод отстающей реплики из ротации ---
+            lagging = read_router.replicas[-1]
+            replicator.paused.add(replicator.replicas[-1])
+            ejected_after = await wait_for(lambda: not lagging.healthy, args.max_lag * 5)
+            reads_before = lagging.reads
+            await asyncio.gather(*(client.get("/api/market/summary") for _ in range(50)))
+            reads_while_ejected = lagging.reads - reads_before
+            replicator.paused.clear()
+            admitted_after = await wait_for(lambda: lagging.healthy, args.max_lag * 5)
+            results["ejection"] = {
+                "ejected_after_s": round(ejected_after, 2),
+                "reads_while_ejected": reads_while_ejected,
+                "readmitted_after_s": round(admitted_after, 2),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--policy", choices=["round_robin", "least_loaded"], default="round_robin")
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--listings", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--writes", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--replication-delay", type=float, default=0.3, help="период копирования в реплики, с")
+    parser.add_argument("--max-lag", type=float, default=1.0)
+    parser.add_argument("--read-your-writes", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    primary = os.path.join(tmp.name, "primary.db")
+    replicas = [os.path.join(tmp.name, f"replica{i}.db") for i in range(1, args.replicas + 1)]
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{primary}",
+        "DATABASE_REPLICA_URLS": ",".join(f"sqlite:///{path}" for path in replicas),
+        "DB_REPLICA_POLICY": args.policy,
+        "DB_REPLICA_MAX_LAG": str(args.max_lag),
+        "DB_REPLICA_CHECK_INTERVAL": "0.2",
+        "DB_READ_YOUR_WRITES": str(args.read_your_writes),
+        # Мерим маршрутизацию — лимиты игрока и контроль допуска выключены
+        "RATE_LIMIT_RPS": "0",
+        "ADMISSION_MAX_INFLIGHT": "0",
+    })
+
+    from app import database, migrations
+    from scripts.seed import seed
+
+    migrations.upgrade(database.engine)
+    seeded = seed(database.engine, args.players, args.listings, rng=random.Random(args.seed))
+
+    replicator = Replicator(primary, replicas, args.replication_delay)
+    for replica in replicas:
+        replicator.copy(replica)
+    replicator.start()
+    try:
+        results = asyncio.run(run(args, replicator, seeded["vk_ids"]))
+    finally:
+        replicator.stop()
+
+    for section, values in results.items():
+        print(f"{section:<17} " + "  ".join(f"{name}={value}" for name, value in values.items()))
+
+    failed = (
+        results["read_your_writes"]["violations"]
+        or results["ejection"]["ejected_after_s"] < 0
+        or results["ejection"]["reads_while_ejected"]
+        or results["ejection"]["readmitted_after_s"] < 0
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+"""
+Проверка шардирования на локальных файлах SQLite.
+
+Глобальная БД и шарды — отдельные файлы во временном каталоге. Игроки регистрируются
+через API и торгуют друг с другом через биржу (лоты и заявки), пока поток-«ребалансер»
+переносит случайных игроков между шардами. Клиенты повторяют запросы на 503.
+После нагрузки проверяется:
+
+    размещение     — новый игрок на шарде vk_id % N; в конце каждый игрок ровно на
+                     одном шарде, том, что в справочнике
+    золото         — сумма на шардах и в резервах заявок = начальная + начисленное − комиссии
+    предметы       — сумма в инвентарях, лотах и заявках на продажу не изменилась
+    двойные продажи — каждый лот продан не больше одного раза
+    outbox         — все сообщения между БД доставлены
+
+    python -m scripts.bench_shards --shards 3 --players 60 --operations 1500
+
+Код выхода 1 — нарушен инвариант.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ITEM = {"item_name": "Дерево", "item_icon": "🪵", "item_rarity": "common"}
+
+
+class Mover(threading.Thread):
+    """Переносит случайных игроков на случайные шарды, пока не остановят"""
+
+    def __init__(self, pause: float, seed: int):
+        super().__init__(daemon=True)
+        self.pause = pause
+        self.rng = random.Random(seed)
+        self.moves = 0
+        self.failures = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        from sqlalchemy import select
+        from sqlalchemy.orm import Session
+
+        from app import models, shards
+        from app.database import engine
+        from app.shards import shard_router
+
+        with Session(engine) as g:
+            player_ids = list(g.scalars(select(models.PlayerDirectory.id)))
+        while not self._stop_event.wait(self.pause):
+            player_id = self.rng.choice(player_ids)
+            target = self.rng.randrange(len(shard_router.shards))
+            try:
+                if shards.move_player(shard_router, player_id, target):
+                    self.moves += 1
+            except Exception as e:
+                self.failures += 1
+                print(f"move {player_id} -> {target} failed: {e!r}")
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def totals() -> dict:
+    """Золото, предметы и их размещение по всем БД"""
+    from sqlalchemy import func, select
+    from sqlalchemy.orm import Session
+
+    from app import models
+    from app.database import engine
+    from app.shards import shard_router
+
+    result = {"gold": 0, "items": 0, "placement": Counter(), "outbox": 0}
+    for shard in shard_router.shards:
+        with shard.sessions() as db:
+            result["gold"] += db.scalar(select(func.coalesce(func.sum(models.Player.gold), 0)))
+            result["items"] += db.scalar(
+                select(func.coalesce(func.sum(models.InventoryItem.quantity), 0))
+                .where(models.InventoryItem.name == ITEM["item_name"])
+            )
+            for player_id in db.scalars(select(models.Player.id)):
+                result["placement"][player_id] += 1
+                result.setdefault("found", {})[player_id] = shard.index
+            if not shard.shared:
+                result["outbox"] += db.scalar(select(func.count()).select_from(models.ShardMessage))
+
+    listing, order, trade = models.MarketListing, models.MarketOrder, models.MarketTrade
+    with Session(engine) as g:
+        result["outbox"] += g.scalar(select(func.count()).select_from(models.ShardMessage))
+        result["items"] += g.scalar(
+            select(func.coalesce(func.sum(listing.quantity), 0)).where(listing.is_active == True)
+        )
+        result["items"] += g.scalar(
+            select(func.coalesce(func.sum(order.remaining), 0)).where(order.status == "open", order.side == "sell")
+        )
+        result["gold"] += g.scalar(
+            select(func.coalesce(func.sum(order.price * order.remaining), 0))
+            .where(order.status == "open", order.side == "buy")
+        )
+        trades = g.execute(select(trade.price, trade.quantity, trade.listing_id)).all()
+        result["fees"] = sum(p * q - int(p * q * 0.95) for p, q, _ in trades)
+        result["trades"] = len(trades)
+        result["double_sold"] = sum(
+            1 for count in Counter(t.listing_id for t in trades if t.listing_id is not None).values() if count > 1
+        )
+        result["directory"] = dict(g.execute(select(models.PlayerDirectory.id, models.PlayerDirectory.shard)).all())
+        result["vk_ids"] = dict(g.execute(select(models.PlayerDirectory.id, models.PlayerDirectory.vk_id)).all())
+        result["moving"] = g.scalar(
+            select(func.count()).select_from(models.PlayerDirectory).where(models.PlayerDirectory.moving_to.isnot(None))
+        )
+    return result
+
+
+async def run(args) -> dict:
+    import httpx
+
+    from app.main import app
+    from app.shards import shard_router
+    from scripts.loadtest import vk_params
+
+    rng = random.Random(args.seed)
+    vk_ids = [30_000_000 + i for i in range(args.players)]
+    headers = {vk_id: {"X-VK-Params": vk_params(vk_id)} for vk_id in vk_ids}
+    stats = Counter()
+    added_gold = 0
+    orders = {vk_id: [] for vk_id in vk_ids}
+    results = {}
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+
+            async def call(method: str, url: str, vk_id: int, **kwargs):
+                for _ in range(100):
+                    response = await client.request(method, url, headers=headers[vk_id], **kwargs)
+                    if response.status_code != 503:
+                        stats[f"{response.status_code}"] += 1
+                        return response
+                    stats["retried_503"] += 1
+                    await asyncio.sleep(0.02)
+                raise RuntimeError(f"{method} {url}: still 503")
+
+            for vk_id in vk_ids:
+                await call("GET", "/api/player", vk_id)
+                await call("POST", "/api/player/add-gold", vk_id, json={"amount": 1000})
+            before = await asyncio.to_thread(totals)
+
+            mover = Mover(args.move_pause, args.seed)
+            mover.start()
+            sem = asyncio.Semaphore(args.concurrency)
+
+            async def operation():
+                nonlocal added_gold
+                vk_id = rng.choice(vk_ids)
+                kind = rng.choices(
+                    ["sell", "buy", "order", "cancel", "add_gold", "inventory"], weights=[3, 3, 3, 1, 1, 1]
+                )[0]
+                async with sem:
+                    if kind == "sell":
+                        await call("POST", "/api/market/sell", vk_id, json={
+                            **ITEM, "price": rng.randint(1, 20), "quantity": rng.randint(1, 3),
+                        })
+                    elif kind == "buy":
+                        page = (await client.get("/api/market", params={"item": ITEM["item_name"], "limit": 20})).json()
+                        ids = [listing["id"] for listing in page["listings"]]
+                        if ids:
+                            response = await call("POST", "/api/market/buy", vk_id, json={
+                                "listing_ids": rng.sample(ids, min(len(ids), rng.randint(1, 3))),
+                            })
+                            for result in response.json().get("results", []):
+                                stats[f"buy_{result['status']}"] += 1
+                    elif kind == "order":
+                        response = await call("POST", "/api/market/orders", vk_id, json={
+                            **ITEM, "side": rng.choice(["buy", "sell"]),
+                            "price": rng.randint(5, 15), "quantity": rng.randint(1, 3),
+                        })
+                        if response.status_code == 200 and response.json()["status"] == "open":
+                            orders[vk_id].append(response.json()["order_id"])
+                    elif kind == "cancel" and orders[vk_id]:
+                        order_id = orders[vk_id].pop(rng.randrange(len(orders[vk_id])))
+                        await call("POST", f"/api/market/orders/{order_id}/cancel", vk_id)
+                    elif kind == "add_gold":
+                        response = await call("POST", "/api/player/add-gold", vk_id, json={"amount": 10})
+                        added_gold += 0 if response.status_code != 200 else 10
+                    else:
+                        await call("GET", "/api/inventory", vk_id)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(operation() for _ in range(args.operations)))
+            elapsed = time.perf_counter() - started
+            mover.stop()
+
+            # Досылка того, что не доставили запросы
+            while await shard_router.deliver_pending(grace=0):
+                pass
+            after = await asyncio.to_thread(totals)
+
+    results["workload"] = {
+        "operations": args.operations, "ops_per_s": round(args.operations / elapsed, 1),
+        "moves": mover.moves, "move_failures": mover.failures, **dict(sorted(stats.items())),
+    }
+    shards = len(shard_router.shards)
+    misplaced_new = sum(
+        1 for player_id, shard in before["directory"].items() if shard != before["vk_ids"][player_id] % shards
+    )
+    placement = after["placement"]
+    results["placement"] = {
+        "initially_not_on_vk_id_mod_n": misplaced_new,
+        "players": len(after["directory"]),
+        "not_on_exactly_one_shard": sum(1 for player_id in after["directory"] if placement[player_id] != 1),
+        "not_where_directory_says": sum(
+            1 for player_id, shard in after["directory"].items() if after.get("found", {}).get(player_id) != shard
+        ),
+        "still_moving": after["moving"],
+    }
+    expected_gold = before["gold"] + added_gold - (after["fees"] - before["fees"])
+    results["conservation"] = {
+        "gold_expected": expected_gold, "gold_actual": after["gold"],
+        "items_expected": before["items"], "items_actual": after["items"],
+        "trades": after["trades"], "double_sold": after["double_sold"], "outbox_left": after["outbox"],
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=3)
+    parser.add_argument("--players", type=int, default=60)
+    parser.add_argument("--operations", type=int, default=1500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--move-pause", type=float, default=0.01, help="пауза между переносами, с")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(tmp.name, 'global.db')}",
+        "DATABASE_SHARD_URLS": ",".join(
+            f"sqlite:///{os.path.join(tmp.name, f'shard{i}.db')}" for i in range(args.shards)
+        ),
+        "SHARD_OUTBOX_GRACE": "1",
+        "SHARD_OUTBOX_INTERVAL": "0.5",
+        # Меряем шардирование — лимиты игрока и контроль допуска выключены
+        "RATE_LIMIT_RPS": "0",
+        "ADMISSION_MAX_INFLIGHT": "0",
+    })
+
+    results = asyncio.run(run(args))
+    for section, values in results.items():
+        print(f"{section:<13} " + "  ".join(f"{name}={value}" for name, value in values.items()))
+
+    placement, conservation = results["placement"], results["conservation"]
+    failed = (
+        placement["initially_not_on_vk_id_mod_n"]
+        or placement["not_on_exactly_one_shard"]
+        or placement["not_where_directory_says"]
+        or placement["still_moving"]
+        or conservation["gold_expected"] != conservation["gold_actual"]
+        or conservation["items_expected"] != conservation["items_actual"]
+        or conservation["double_sold"]
+        or conservation["outbox_left"]
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
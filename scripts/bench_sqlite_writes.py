@@ -0,0 +1,100 @@
+"""
+Нагрузочный тест конкурентной записи в SQLite: профиль sqlite-legacy
+(rollback journal) против sqlite (WAL + synchronous=NORMAL).
+
+Работает на копии mmorpg_game.db, сам файл не трогает.
+
+    python -m scripts.bench_sqlite_writes --writers 8 --readers 4 --seconds 5
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, migrations, schemas
+from app.database import make_engine
+
+SOURCE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mmorpg_game.db")
+
+
+def run_profile(profile: str, args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "load.db")
+        shutil.copy(SOURCE_DB, path)
+        engine = make_engine(f"sqlite:///{path}", profile)
+        migrations.upgrade(engine)
+        Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        with Session() as db:
+            player_ids = [crud.create_player(db, 900000 + i).id for i in range(args.writers)]
+
+        stop = time.perf_counter() + args.seconds
+        counts = {"writes": 0, "reads": 0, "errors": 0}
+        lock = threading.Lock()
+
+        def writer(player_id):
+            done = 0
+            errors = 0
+            item = schemas.InventoryItemCreate(name="Дерево", icon="🪵", quantity=1)
+            while time.perf_counter() < stop:
+                db = Session()
+                try:
+                    crud.add_inventory_item(db, player_id, item)
+                    crud.update_player_gold(db, player_id, 1)
+                    done += 1
+                except Exception:
+                    db.rollback()
+                    errors += 1
+                finally:
+                    db.close()
+            with lock:
+                counts["writes"] += done
+                counts["errors"] += errors
+
+        def reader():
+            done = 0
+            while time.perf_counter() < stop:
+                with Session() as db:
+                    crud.get_inventory(db, player_ids[done % len(player_ids)])
+                done += 1
+            with lock:
+                counts["reads"] += done
+
+        threads = [threading.Thread(target=writer, args=(pid,)) for pid in player_ids]
+        threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stats = engine.pool.stats
+        engine.dispose()
+        return {
+            "profile": profile,
+            "writes_per_s": round(counts["writes"] / args.seconds, 1),
+            "reads_per_s": round(counts["reads"] / args.seconds, 1),
+            "errors": counts["errors"],
+            "wait_max_ms": round(stats.wait_max * 1000, 2),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--profiles", default="sqlite-legacy,sqlite")
+    args = parser.parse_args()
+
+    print(f"{'profile':<14} {'writes/s':>9} {'reads/s':>9} {'errors':>7} {'max wait ms':>12}")
+    for profile in args.profiles.split(","):
+        r = run_profile(profile, args)
+        print(f"{r['profile']:<14} {r['writes_per_s']:>9} {r['reads_per_s']:>9} {r['errors']:>7} {r['wait_max_ms']:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Время холодного старта воркера: импорт app.main и запуск uvicorn до первого ответа.
+
+Поднимает --workers процессов uvicorn одновременно (как при деплое) на одной БД
+и для каждого меряет время от запуска процесса до первого 200 от /api/market —
+запроса, которому нужна БД.
+
+    python -m scripts.bench_startup --workers 4 --runs 3
+    python -m scripts.bench_startup --auto-migrate   # воркеры сами применяют миграции
+
+Без DATABASE_URL используется временная SQLite-база, мигрированная заранее.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_import(env: dict) -> float:
+    out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], env=env, cwd=ROOT,
+                         check=True, capture_output=True, text=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def wait_ready(port: int, started: float, timeout: float) -> float:
+    url = f"http://127.0.0.1:{port}/api/market?limit=1"
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as resp:
+                if resp.status == 200:
+                    return time.perf_counter() - started
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"worker on port {port} did not answer in {timeout} s")
+
+
+def boot_workers(count: int, env: dict, timeout: float) -> list:
+    procs = []
+    for _ in range(count):
+        port = free_port()
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning"],
+            env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        procs.append((proc, port, time.perf_counter()))
+
+    try:
+        return [wait_ready(port, started, timeout) for _, port, started in procs]
+    finally:
+        for proc, _, _ in procs:
+            proc.terminate()
+        for proc, _, _ in procs:
+            proc.wait(10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--auto-migrate", action="store_true", help="DB_AUTO_MIGRATE=true в воркерах")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT
+    env["DB_AUTO_MIGRATE"] = "true" if args.auto_migrate else "false"
+    tmp = None
+    if not env.get("DATABASE_URL"):
+        tmp = tempfile.TemporaryDirectory()
+        env["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp.name, 'startup.db')}"
+
+    if not args.auto_migrate:
+        subprocess.run([sys.executable, "-m", "app.migrations"], env=env, cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    imports = [measure_import(env) for _ in range(args.runs)]
+    print(f"import app.main: median {statistics.median(imports) * 1000:.0f} ms "
+          f"(min {min(imports) * 1000:.0f}, max {max(imports) * 1000:.0f})")
+
+    for run in range(args.runs):
+        ready = boot_workers(args.workers, env, args.timeout)
+        per_worker = " ".join(f"{t * 1000:.0f}" for t in ready)
+        print(f"run {run + 1}: spawn -> first response per worker, ms: {per_worker} "
+              f"(max {max(ready) * 1000:.0f})")
+
+
+if __name__ == "__main__":
+    main()
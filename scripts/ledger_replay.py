@@ -0,0 +1,91 @@
+"""
+Сверка журнала экономики с текущими балансами.
+
+Пересобирает золото, кристаллы и количество предметов каждого игрока из
+ledger_entries и сравнивает с players / inventory_items. Записи с delta = NULL
+(обрезка баланса до нуля) служат опорными точками: накопленная сумма
+заменяется их balance.
+
+Игроки, созданные до появления журнала, будут расходиться — их можно
+отсечь через --min-player-id.
+
+    python -m scripts.ledger_replay --min-player-id 1000
+"""
+import argparse
+from collections import defaultdict
+
+from sqlalchemy import func, select
+
+from app import models
+from app.database import SessionLocal
+from app.ledger import ledger_writer
+
+
+def replay(db, min_player_id: int = 0, batch: int = 10000) -> dict:
+    """(player_id, kind, asset) -> баланс по журналу"""
+    totals = defaultdict(int)
+    query = (
+        select(
+            models.LedgerEntry.player_id,
+            models.LedgerEntry.kind,
+            models.LedgerEntry.asset,
+            models.LedgerEntry.delta,
+            models.LedgerEntry.balance,
+        )
+        .where(models.LedgerEntry.player_id >= min_player_id)
+        .order_by(models.LedgerEntry.id)
+        .execution_options(yield_per=batch)
+    )
+    for player_id, kind, asset, delta, balance in db.execute(query):
+        key = (player_id, kind, asset)
+        totals[key] = balance if delta is None else totals[key] + delta
+    return totals
+
+
+def actual_balances(db, min_player_id: int = 0) -> dict:
+    actual = {}
+    players = db.execute(
+        select(models.Player.id, models.Player.gold, models.Player.crystals)
+        .where(models.Player.id >= min_player_id)
+    )
+    for player_id, gold, crystals in players:
+        actual[(player_id, "currency", "gold")] = gold
+        actual[(player_id, "currency", "crystals")] = crystals
+
+    items = db.execute(
+        select(models.InventoryItem.player_id, models.InventoryItem.name, func.sum(models.InventoryItem.quantity))
+        .where(models.InventoryItem.player_id >= min_player_id)
+        .group_by(models.InventoryItem.player_id, models.InventoryItem.name)
+    )
+    for player_id, name, quantity in items:
+        actual[(player_id, "item", name)] = quantity
+    return actual
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--min-player-id", type=int, default=0)
+    parser.add_argument("--limit", type=int, default=50, help="сколько расхождений напечатать")
+    args = parser.parse_args()
+
+    # Сначала дописываем то, что могло остаться в очереди этого процесса
+    ledger_writer.stop()
+
+    with SessionLocal() as db:
+        expected = replay(db, args.min_player_id)
+        actual = actual_balances(db, args.min_player_id)
+
+    mismatches = []
+    for key in sorted(set(expected) | set(actual)):
+        if expected.get(key, 0) != actual.get(key, 0):
+            mismatches.append((key, expected.get(key, 0), actual.get(key, 0)))
+
+    print(f"checked {len(set(expected) | set(actual))} balances, {len(mismatches)} mismatches")
+    for (player_id, kind, asset), want, got in mismatches[:args.limit]:
+        print(f"  player {player_id} {kind}:{asset} ledger={want} actual={got}")
+
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Нагрузочный тест API: сценарии поверх app.main.app на засеянной базе.
+
+Клиент — httpx через ASGI в том же процессе (--server asgi) или настоящий
+uvicorn на локальном порту (--server uvicorn). По каждому сценарию печатает
+req/s, p50/p95/p99 и число SQL-запросов на HTTP-запрос.
+
+Сравнение с базовой линией завершается с кодом 1 при регрессии:
+
+    python -m scripts.loadtest --save-baseline scripts/loadtest_baseline.json
+    python -m scripts.loadtest --compare scripts/loadtest_baseline.json
+
+Без DATABASE_URL используется временная SQLite-база.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+SCENARIOS = ["signup", "auth_cached", "bootstrap", "inventory_poll", "market_browse", "market_search", "market_sell",
+             "market_buy", "inventory_churn", "currency", "mixed"]
+
+MIXED_WEIGHTS = {
+    "auth_cached": 30,
+    "market_browse": 30,
+    "inventory_churn": 15,
+    "currency": 10,
+    "market_sell": 6,
+    "market_buy": 6,
+    "signup": 3,
+}
+
+
+def vk_params(vk_id: int) -> str:
+    """Параметры запуска VK; при DEBUG=false — с настоящей подписью"""
+    params = {"vk_user_id": str(vk_id), "vk_app_id": os.getenv("VK_APP_ID", "1")}
+    query = urlencode(sorted(params.items()))
+    secret = os.getenv("VK_APP_SECRET", "test_secret").encode()
+    sign = base64.b64encode(hmac.new(secret, query.encode(), hashlib.sha256).digest()).decode()
+    sign = sign.replace("+", "-").replace("/", "_").rstrip("=")
+    return f"?{query}&sign={sign}"
+
+
+class SqlCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *_):
+        self.count += 1
+
+
+class Context:
+    """Общие данные сценариев: игроки, лоты, счётчики"""
+
+    def __init__(self, vk_ids, listing_ids, rng):
+        self.vk_ids = vk_ids
+        self.listing_ids = listing_ids
+        self.rng = rng
+        self.signup_ids = itertools.count(90_000_000)
+        self.headers = {vk_id: {"X-VK-Params": vk_params(vk_id)} for vk_id in vk_ids}
+        self.cursor = None
+        # ETag последнего ответа /api/inventory по игроку — как у клиента, который опрашивает инвентарь
+        self.inventory_etags = {}
+
+    def actor(self):
+        return self.headers[self.rng.choice(self.vk_ids)]
+
+
+async def run_scenario(name, client, ctx):
+    """Один HTTP-запрос сценария. Возвращает статус ответа"""
+    if name == "mixed":
+        name = ctx.rng.choices(list(MIXED_WEIGHTS), weights=list(MIXED_WEIGHTS.values()))[0]
+
+    if name == "signup":
+        vk_id = next(ctx.signup_ids)
+        resp = await client.get("/api/player", headers={"X-VK-Params": vk_params(vk_id)})
+    elif name == "auth_cached":
+        resp = await client.get("/api/inventory", headers=ctx.actor())
+    elif name == "bootstrap":
+        resp = await client.get("/api/bootstrap", headers=ctx.actor())
+    elif name == "inventory_poll":
+        vk_id = ctx.rng.choice(ctx.vk_ids)
+        headers = dict(ctx.headers[vk_id])
+        if vk_id in ctx.inventory_etags:
+            headers["If-None-Match"] = ctx.inventory_etags[vk_id]
+        resp = await client.get("/api/inventory", headers=headers)
+        if "etag" in resp.headers:
+            ctx.inventory_etags[vk_id] = resp.headers["etag"]
+    elif name == "market_browse":
+        params = {"limit": 50}
+        if ctx.cursor and ctx.rng.random() < 0.5:
+            params["cursor"] = ctx.cursor
+        resp = await client.get("/api/market", params=params)
+        if resp.status_code == 200:
+            ctx.cursor = resp.json().get("next_cursor")
+    elif name == "market_search":
+        if ctx.rng.random() < 0.2:
+            resp = await client.get("/api/market/summary")
+        else:
+            name_filter = ctx.rng.choice([{"item": "Зелье HP"}, {"prefix": "Зел"}, {"rarity": "rare"}])
+            resp = await client.get("/api/market", params={
+                **name_filter, "max_price": ctx.rng.randint(50, 500), "sort": "price", "limit": 50,
+            })
+    elif name == "market_sell":
+        resp = await client.post("/api/market/sell", headers=ctx.actor(), json={
+            "item_name": "Дерево", "item_icon": "🪵", "price": ctx.rng.randint(1, 100), "quantity": 1,
+        })
+    elif name == "market_buy":
+        listing_id = ctx.listing_ids.pop() if ctx.listing_ids else 0
+        resp = await client.post(f"/api/market/buy/{listing_id}", headers=ctx.actor())
+    elif name == "inventory_churn":
+        resp = await client.post("/api/inventory/batch", headers=ctx.actor(), json={"operations": [
+            {"op": "add", "name": "Камень", "icon": "🪨", "quantity": 2},
+            {"op": "add", "name": "Еда", "icon": "🍖", "quantity": 1},
+        ]})
+    elif name == "currency":
+        path = "/api/player/spend-gold" if ctx.rng.random() < 0.5 else "/api/player/add-gold"
+        resp = await client.post(path, headers=ctx.actor(), json={"amount": 1})
+    else:
+        raise ValueError(f"Unknown scenario: {name}")
+    return resp.status_code
+
+
+async def measure(name, client, ctx, counter, requests, concurrency):
+    latencies = []
+    errors = 0
+    rejected = 0
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal errors, rejected
+        async with sem:
+            started = time.perf_counter()
+            status = await run_scenario(name, client, ctx)
+            latencies.append(time.perf_counter() - started)
+            if status >= 500:
+                errors += 1
+            elif status >= 400:
+                rejected += 1
+
+    sql_before = counter.count
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+
+    return {
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "sql_per_request": round((counter.count - sql_before) / requests, 2),
+        "errors": errors,
+        "rejected": rejected,
+    }
+
+
+def start_uvicorn(app):
+    import uvicorn
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if current is None:
+            continue
+        if current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {current['rps']} < {base['rps']}")
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']} ms > {base['p95_ms']} ms")
+        # Число запросов к БД не зависит от машины — допускаем только шум от mixed
+        if current["sql_per_request"] > base["sql_per_request"] + 0.5:
+            regressions.append(f"{name}: sql/request {current['sql_per_request']} > {base['sql_per_request']}")
+        if current["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: {current['errors']} server errors")
+    return regressions
+
+
+async def run(args):
+    import httpx
+    from sqlalchemy import delete, event, insert, update
+
+    from app import database, migrations, models
+    from app.main import app
+    from scripts.seed import seed
+
+    migrations.upgrade(database.engine)
+
+    seeded = seed(database.engine, args.players, args.listings, rng=random.Random(args.seed))
+    with database.engine.begin() as conn:
+        # Покупателям хватает золота, продавцам — предметов
+        conn.execute(update(models.Player).where(models.Player.id.in_(seeded["player_ids"])).values(gold=10**9))
+        conn.execute(
+            delete(models.InventoryItem)
+            .where(models.InventoryItem.player_id.in_(seeded["player_ids"]), models.InventoryItem.name == "Дерево")
+        )
+        conn.execute(insert(models.InventoryItem), [
+            {"player_id": pid, "name": "Дерево", "icon": "🪵", "item_type": "material", "quantity": 10**6}
+            for pid in seeded["player_ids"]
+        ])
+        listing_ids = [row[0] for row in conn.execute(
+            models.MarketListing.__table__.select().with_only_columns(models.MarketListing.id)
+        )]
+
+    counter = SqlCounter()
+    for eng in filter(None, [database.engine, database.async_engine and database.async_engine.sync_engine]):
+        event.listen(eng, "before_cursor_execute", counter)
+
+    rng = random.Random(args.seed)
+    rng.shuffle(listing_ids)
+    ctx = Context(seeded["vk_ids"], listing_ids, rng)
+
+    server = None
+    if args.server == "uvicorn":
+        server, thread, base_url = start_uvicorn(app)
+        client = httpx.AsyncClient(base_url=base_url, timeout=30)
+    else:
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=30)
+
+    results = {}
+    async with client:
+        # Прогрев: кэш авторизации и стаканы
+        for vk_id in ctx.vk_ids[:args.concurrency]:
+            await client.get("/api/inventory", headers=ctx.headers[vk_id])
+
+        for name in args.scenarios.split(","):
+            results[name] = await measure(name, client, ctx, counter, args.requests, args.concurrency)
+            print_row(name, results[name])
+
+    if server is not None:
+        server.should_exit = True
+        thread.join(10)
+    else:
+        await lifespan.__aexit__(None, None, None)
+    return results
+
+
+def print_row(name, r):
+    print(f"{name:<16} {r['rps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+          f"{r['sql_per_request']:>8} {r['errors']:>6} {r['rejected']:>6}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--players", type=int, default=2000)
+    parser.add_argument("--listings", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.4, help="допустимое ухудшение rps/p95 (доля)")
+    args = parser.parse_args()
+
+    tmp = None
+    if not os.getenv("DATABASE_URL"):
+        tmp = tempfile.TemporaryDirectory()
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp.name, 'loadtest.db')}"
+
+    print(f"{'scenario':<16} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8} {'5xx':>6} {'4xx':>6}")
+    results = asyncio.run(run(args))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,443 @@
+"""
+Потоковая выгрузка и загрузка игроков: профиль, снаряжение, инвентарь, скины, версия инвентаря.
+
+Форматы файла:
+
+    ndjson    — строка на игрока: поля players и вложенные equipment, inventory, skins,
+                inventory_version
+    columnar  — строка на блок пачки игроков: {"table": ..., "rows": n, "columns": {поле: [...]}};
+                имена полей не повторяются в каждой строке — файл меньше и читается быстрее
+
+Выгрузка — один проход по каждой таблице в порядке player_id серверными курсорами
+(yield_per) со слиянием по игроку: память не растёт с размером БД. Загрузка — пачками
+через executemany, на Postgres через COPY; id сохраняются, ledger не пишется.
+
+После каждой пачки пишется контрольная точка <файл>.checkpoint (выгрузка) или
+<файл>.import-checkpoint (загрузка); с --resume команда продолжает с неё.
+
+    python -m scripts.player_dump export players.ndjson --from-id 1 --to-id 1000000
+    python -m scripts.player_dump export players.col --format columnar --resume
+    DATABASE_URL=postgresql://... python -m scripts.player_dump import players.ndjson --skip-existing
+
+При шардировании команды запускаются на каждый шард (DATABASE_URL=<url шарда>);
+после загрузки на шарды — python -m scripts.rebalance_shards init.
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import DateTime, insert, select, text
+
+from app import migrations, models
+
+# Таблица в файле -> таблица БД. Порядок — порядок загрузки (players первой)
+TABLES = {
+    "players": models.Player.__table__,
+    "equipment": models.Equipment.__table__,
+    "inventory": models.InventoryItem.__table__,
+    "skins": models.OwnedSkin.__table__,
+    "inventory_versions": models.InventoryVersion.__table__,
+}
+CHILDREN = [name for name in TABLES if name != "players"]
+
+# Вложенные поля документа ndjson: (поле, таблица, список ли)
+NESTED = [
+    ("equipment", "equipment", False),
+    ("inventory", "inventory", True),
+    ("skins", "skins", True),
+    ("inventory_version", "inventory_versions", False),
+]
+
+# Таблицы с автоинкрементным id — на Postgres после загрузки сдвигаем последовательности
+SEQUENCES = ["players", "equipment", "inventory_items", "owned_skins"]
+
+# Строк за одну выборку из курсора; память выгрузки — пачка игроков плюс эти буферы
+FETCH_ROWS = 2000
+
+
+def _key(name: str):
+    return TABLES[name].c.id if name == "players" else TABLES[name].c.player_id
+
+
+def _datetime_columns(name: str) -> List[str]:
+    return [column.name for column in TABLES[name].columns if isinstance(column.type, DateTime)]
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss в КБ на Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _save_checkpoint(path: str, state: dict):
+    """Атомарно: прерванная запись не портит предыдущую точку"""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _load_checkpoint(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# === Выгрузка ===
+
+def _stream(conn, name: str, from_id: int, to_id: Optional[int]) -> Iterator[tuple]:
+    """Строки таблицы в порядке player_id серверным курсором"""
+    key = _key(name)
+    query = select(TABLES[name]).where(key >= from_id).order_by(key)
+    if to_id is not None:
+        query = query.where(key <= to_id)
+    result = conn.execute(query.execution_options(yield_per=FETCH_ROWS))
+    datetimes = [index for index, column in enumerate(result.keys()) if column in _datetime_columns(name)]
+    for row in result:
+        if datetimes:
+            row = list(row)
+            for index in datetimes:
+                if row[index] is not None:
+                    row[index] = row[index].isoformat()
+        yield tuple(row)
+
+
+def _merge(conn, from_id: int, to_id: Optional[int]) -> Iterator[tuple]:
+    """(строка игрока, {таблица: [строки игрока]}) — слияние упорядоченных потоков по player_id"""
+    groups = {}
+    for name in CHILDREN:
+        position = list(TABLES[name].columns.keys()).index("player_id")
+        groups[name] = groupby(_stream(conn, name, from_id, to_id), key=itemgetter(position))
+    heads = {name: next(groups[name], None) for name in CHILDREN}
+
+    for player in _stream(conn, "players", from_id, to_id):
+        player_id = player[0]
+        children = {}
+        for name in CHILDREN:
+            # Строки без игрока (осиротевшие) пропускаем
+            while heads[name] is not None and heads[name][0] < player_id:
+                heads[name] = next(groups[name], None)
+            if heads[name] is not None and heads[name][0] == player_id:
+                children[name] = list(heads[name][1])
+                heads[name] = next(groups[name], None)
+            else:
+                children[name] = []
+        yield player, children
+
+
+def _ndjson_writer(out):
+    columns = {name: list(TABLES[name].columns.keys()) for name in TABLES}
+    # player_id во вложенных строках не повторяем
+    child_columns = {name: [column for column in columns[name] if column != "player_id"] for name in CHILDREN}
+    child_positions = {
+        name: [columns[name].index(column) for column in child_columns[name]] for name in CHILDREN
+    }
+
+    def write(pending: List[tuple]):
+        # Построчно в буфер файла — без копии всей пачки строками
+        for player, children in pending:
+            doc = dict(zip(columns["players"], player))
+            for field, name, many in NESTED:
+                rows = [
+                    dict(zip(child_columns[name], (row[i] for i in child_positions[name])))
+                    for row in children[name]
+                ]
+                doc[field] = rows if many else (rows[0] if rows else None)
+            out.write(json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode())
+            out.write(b"\n")
+
+    return write
+
+
+def _columnar_writer(out):
+    columns = {name: list(TABLES[name].columns.keys()) for name in TABLES}
+
+    def write(pending: List[tuple]):
+        blocks = {"players": [player for player, _ in pending]}
+        for name in CHILDREN:
+            blocks[name] = [row for _, children in pending for row in children[name]]
+        for name, rows in blocks.items():
+            block = {"table": name, "rows": len(rows), "columns": dict(zip(columns[name], map(list, zip(*rows))))}
+            if not rows:
+                block["columns"] = {column: [] for column in columns[name]}
+            out.write((json.dumps(block, ensure_ascii=False, separators=(",", ":")) + "\n").encode())
+
+    return write
+
+
+def export(engine, path: str, fmt: str = "ndjson", from_id: int = 1, to_id: Optional[int] = None,
+           batch: int = 10000, resume: bool = False) -> dict:
+    """Выгрузить игроков с id в [from_id, to_id]. Возвращает счётчики строк"""
+    checkpoint_path = path + ".checkpoint"
+    state = _load_checkpoint(checkpoint_path) if resume else None
+    if state is not None:
+        if (state["format"], state["from_id"], state["to_id"]) != (fmt, from_id, to_id):
+            raise SystemExit(
+                f"checkpoint is for --format {state['format']} --from-id {state['from_id']} "
+                f"--to-id {state['to_id']}"
+            )
+        if state.get("complete"):
+            return state
+        out = open(path, "r+b")
+        # Всё после контрольной точки — недописанная пачка
+        out.truncate(state["offset"])
+        out.seek(state["offset"])
+        start_id = state["last_id"] + 1
+    else:
+        state = {
+            "format": fmt, "from_id": from_id, "to_id": to_id, "last_id": from_id - 1,
+            "offset": 0, "rows": {name: 0 for name in TABLES}, "complete": False,
+        }
+        out = open(path, "wb")
+        start_id = from_id
+
+    write = (_columnar_writer if fmt == "columnar" else _ndjson_writer)(out)
+
+    def flush(pending):
+        write(pending)
+        out.flush()
+        os.fsync(out.fileno())
+        state["last_id"] = pending[-1][0][0]
+        state["offset"] = out.tell()
+        state["rows"]["players"] += len(pending)
+        for _, children in pending:
+            for name in CHILDREN:
+                state["rows"][name] += len(children[name])
+        _save_checkpoint(checkpoint_path, state)
+
+    try:
+        with engine.connect() as conn:
+            # Один снимок БД на все потоки — игрок и его строки согласованы
+            if conn.dialect.name == "postgresql":
+                conn.execution_options(isolation_level="REPEATABLE READ")
+            elif conn.dialect.name == "sqlite":
+                conn.exec_driver_sql("BEGIN")
+            pending = []
+            for player, children in _merge(conn, start_id, to_id):
+                pending.append((player, children))
+                if len(pending) >= batch:
+                    flush(pending)
+                    pending = []
+            if pending:
+                flush(pending)
+            conn.rollback()
+    finally:
+        out.close()
+
+    state["complete"] = True
+    _save_checkpoint(checkpoint_path, state)
+    return state
+
+
+# === Загрузка ===
+
+def _read(f, offset: int) -> Iterator[tuple]:
+    """(смещение после строки, разобранная строка)"""
+    f.seek(offset)
+    for line in f:
+        offset += len(line)
+        if line.strip():
+            yield offset, json.loads(line)
+
+
+def _ndjson_batches(f, offset: int, batch: int) -> Iterator[tuple]:
+    """(смещение после пачки, {таблица: [строки]}) по batch игроков"""
+    tables = {name: [] for name in TABLES}
+    count = 0
+    for offset, doc in _read(f, offset):
+        player_id = doc["id"]
+        for field, name, many in NESTED:
+            value = doc.pop(field, None)
+            for row in (value if many else [value] if value else []):
+                row["player_id"] = player_id
+                tables[name].append(row)
+        tables["players"].append(doc)
+        count += 1
+        if count >= batch:
+            yield offset, tables
+            tables = {name: [] for name in TABLES}
+            count = 0
+    if count:
+        yield offset, tables
+
+
+def _columnar_batches(f, offset: int) -> Iterator[tuple]:
+    """Пачка — блоки от players до следующего players, как их записал export"""
+    tables = {name: [] for name in TABLES}
+    start = offset
+    for end, block in _read(f, offset):
+        if block["table"] == "players" and tables["players"]:
+            yield start, tables
+            tables = {name: [] for name in TABLES}
+        names = list(block["columns"])
+        tables[block["table"]].extend(dict(zip(names, values)) for values in zip(*block["columns"].values()))
+        start = end
+    if tables["players"]:
+        yield start, tables
+
+
+def _filter(tables: Dict[str, List[dict]], keep) -> Dict[str, List[dict]]:
+    return {
+        name: [row for row in rows if keep(row["id"] if name == "players" else row["player_id"])]
+        for name, rows in tables.items()
+    }
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if value is True or value is False:
+        return "t" if value else "f"
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    return str(value)
+
+
+def _copy(conn, name: str, rows: List[dict]):
+    """COPY FROM STDIN в текстовом формате — быстрее executemany в разы"""
+    table = TABLES[name]
+    columns = [column for column in table.columns.keys() if column in rows[0]]
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(row.get(column)) for column in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN", buffer)
+    finally:
+        cursor.close()
+
+
+def _insert_batch(engine, tables: Dict[str, List[dict]], skip_existing: bool) -> Dict[str, int]:
+    """Пачка одной транзакцией. Возвращает вставлено строк по таблицам"""
+    with engine.begin() as conn:
+        if skip_existing and tables["players"]:
+            ids = [row["id"] for row in tables["players"]]
+            existing = set(conn.execute(select(models.Player.id).where(models.Player.id.in_(ids))).scalars())
+            if existing:
+                tables = _filter(tables, lambda player_id: player_id not in existing)
+
+        use_copy = conn.dialect.name == "postgresql"
+        for name, rows in tables.items():
+            if not rows:
+                continue
+            if use_copy:
+                _copy(conn, name, rows)
+                continue
+            for column in _datetime_columns(name):
+                for row in rows:
+                    if row.get(column) is not None:
+                        row[column] = datetime.fromisoformat(row[column])
+            conn.execute(insert(TABLES[name]), rows)
+    return {name: len(rows) for name, rows in tables.items()}
+
+
+def _sync_sequences(engine):
+    """Id загружены явно — сдвигаем последовательности Postgres за максимальный id"""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for table in SEQUENCES:
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"GREATEST((SELECT max(id) FROM {table}), 1))"
+            ))
+
+
+def import_players(engine, path: str, from_id: int = 1, to_id: Optional[int] = None, batch: int = 10000,
+                   skip_existing: bool = False, resume: bool = False) -> dict:
+    """Загрузить игроков из файла export. Возвращает счётчики строк"""
+    checkpoint_path = path + ".import-checkpoint"
+    state = _load_checkpoint(checkpoint_path) if resume else None
+    # Пачка могла закоммититься, а точка — не записаться: первую пачку после
+    # возобновления грузим без уже загруженных игроков
+    recheck = state is not None
+    if state is None:
+        state = {"offset": 0, "rows": {name: 0 for name in TABLES}, "complete": False}
+    elif state.get("complete"):
+        return state
+
+    with open(path, "rb") as f:
+        columnar = b'"table"' in f.readline()[:32]
+        batches = _columnar_batches(f, state["offset"]) if columnar else _ndjson_batches(f, state["offset"], batch)
+        for offset, tables in batches:
+            if from_id > 1 or to_id is not None:
+                tables = _filter(
+                    tables, lambda player_id: player_id >= from_id and (to_id is None or player_id <= to_id)
+                )
+            inserted = _insert_batch(engine, tables, skip_existing or recheck)
+            recheck = False
+            for name, count in inserted.items():
+                state["rows"][name] += count
+            state["offset"] = offset
+            _save_checkpoint(checkpoint_path, state)
+
+    _sync_sequences(engine)
+    state["complete"] = True
+    _save_checkpoint(checkpoint_path, state)
+    return state
+
+
+def _report(action: str, state: dict, before: Optional[dict], elapsed: float):
+    rows = state["rows"]
+    # Скорость — по строкам этого запуска, без выгруженных до контрольной точки
+    done = sum(rows.values()) - (sum(before["rows"].values()) if before else 0)
+    print(
+        f"{action} " + " ".join(f"{name}={count}" for name, count in rows.items())
+        + f" in {elapsed:.1f} s ({done / max(elapsed, 1e-9):,.0f} rows/s), max RSS {_max_rss_mb():.0f} MB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("export", "import"):
+        sub = commands.add_parser(command)
+        sub.add_argument("path")
+        sub.add_argument("--from-id", type=int, default=1, help="первый id игрока")
+        sub.add_argument("--to-id", type=int, default=None, help="последний id игрока")
+        sub.add_argument("--batch", type=int, default=10000, help="игроков в пачке и между контрольными точками")
+        sub.add_argument("--resume", action="store_true", help="продолжить с контрольной точки")
+    commands.choices["export"].add_argument("--format", choices=["ndjson", "columnar"], default="ndjson")
+    commands.choices["import"].add_argument(
+        "--skip-existing", action="store_true", help="пропускать игроков, чьи id уже есть в БД"
+    )
+    args = parser.parse_args()
+
+    from app.database import engine
+
+    suffix = ".checkpoint" if args.command == "export" else ".import-checkpoint"
+    before = _load_checkpoint(args.path + suffix) if args.resume else None
+    if before is not None and before.get("complete"):
+        print(f"{args.command} of {args.path} is already complete")
+        return
+
+    started = time.perf_counter()
+    if args.command == "export":
+        migrations.check(engine)
+        state = export(engine, args.path, args.format, args.from_id, args.to_id, args.batch, args.resume)
+        _report("exported", state, before, time.perf_counter() - started)
+    else:
+        if not os.path.exists(args.path):
+            print(f"no such file: {args.path}")
+            sys.exit(1)
+        migrations.upgrade(engine)
+        state = import_players(
+            engine, args.path, args.from_id, args.to_id, args.batch, args.skip_existing, args.resume
+        )
+        _report("imported", state, before, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Справочник игроков и перенос игроков между шардами (DATABASE_SHARD_URLS).
+
+    python -m scripts.rebalance_shards init                    # справочник из игроков на шардах
+    python -m scripts.rebalance_shards status                  # игроков на шардах, незавершённые переносы
+    python -m scripts.rebalance_shards move --player 42 --to 1
+    python -m scripts.rebalance_shards rebalance --limit 1000 --pause 0.05
+    python -m scripts.rebalance_shards repair                  # разобрать прерванные переносы
+
+Переход с одной БД: DATABASE_SHARD_URLS=<прежний DATABASE_URL>,<новые шарды>,
+python -m app.migrations, затем init и rebalance. Перенос онлайн: запросы игрока
+в момент переноса получают 503 с Retry-After и повторяются уже на новом шарде.
+"""
+import argparse
+import logging
+import sys
+import time
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app import models, shards
+from app.database import engine
+from app.shards import shard_router
+
+
+def status():
+    with Session(engine) as g:
+        counts = shards.shard_counts(g)
+        moving = g.scalar(
+            select(func.count()).select_from(models.PlayerDirectory).where(models.PlayerDirectory.moving_to.isnot(None))
+        )
+        pending = g.scalar(select(func.count()).select_from(models.ShardMessage))
+    for shard in shard_router.shards:
+        print(f"{shard.name:<8} players={counts.get(shard.index, 0)}")
+    print(f"moving={moving} global_outbox={pending}")
+
+
+def rebalance(limit: int, pause: float) -> int:
+    moved = 0
+    for player_id, source, target in shards.plan_rebalance(shard_router, limit):
+        try:
+            shards.move_player(shard_router, player_id, target)
+            moved += 1
+        except Exception as e:
+            print(f"player {player_id}: {source} -> {target} failed: {e}")
+        # Пауза ограничивает нагрузку переноса на шарды
+        time.sleep(pause)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init")
+    commands.add_parser("status")
+    move = commands.add_parser("move")
+    move.add_argument("--player", type=int, required=True)
+    move.add_argument("--to", type=int, required=True)
+    balance = commands.add_parser("rebalance")
+    balance.add_argument("--limit", type=int, default=1000, help="не больше переносов за запуск")
+    balance.add_argument("--pause", type=float, default=0.05, help="пауза между переносами, с")
+    commands.add_parser("repair")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if not shard_router.sharded:
+        print("DATABASE_SHARD_URLS is not set")
+        sys.exit(1)
+
+    if args.command == "init":
+        print(f"added {shards.init_directory(shard_router)} players to the directory")
+    elif args.command == "status":
+        status()
+    elif args.command == "move":
+        if not 0 <= args.to < len(shard_router.shards):
+            print(f"no shard {args.to}")
+            sys.exit(1)
+        moved = shards.move_player(shard_router, args.player, args.to)
+        print("moved" if moved else "already there")
+    elif args.command == "rebalance":
+        print(f"moved {rebalance(args.limit, args.pause)} players")
+        status()
+    elif args.command == "repair":
+        print(" ".join(f"{key}={value}" for key, value in shards.repair(shard_router).items()))
+
+
+if __name__ == "__main__":
+    main()
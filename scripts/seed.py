@@ -0,0 +1,109 @@
+"""
+Наполнение базы тестовыми данными: игроки со стартовым набором, инвентарь и лоты биржи.
+
+Пишет пачками через executemany, без ORM-объектов.
+
+    DATABASE_URL=sqlite:///./load.db python -m scripts.seed --players 10000 --listings 20000
+"""
+import argparse
+import random
+import time
+
+from sqlalchemy import func, insert, select
+
+from app import crud, migrations, models
+
+ITEMS = [
+    ("Дерево", "🪵", "material", "common"),
+    ("Камень", "🪨", "material", "common"),
+    ("Железо", "⛓️", "material", "rare"),
+    ("Зелье HP", "❤️", "potion", "common"),
+    ("Зелье MP", "💙", "potion", "rare"),
+    ("Еда", "🍖", "food", "common"),
+    ("Кристалл", "💎", "material", "epic"),
+]
+
+# vk_id засеянных игроков начинаются отсюда, чтобы не пересекаться с настоящими
+SEED_VK_ID_START = 10_000_000
+
+
+def _batches(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def seed(engine, players: int, listings: int, items_per_player: int = 5, batch: int = 5000, rng=None) -> dict:
+    """Создаёт игроков, их инвентарь и активные лоты. Возвращает id созданных игроков"""
+    rng = rng or random.Random(42)
+
+    with engine.begin() as conn:
+        first_vk_id = max(
+            conn.execute(select(func.max(models.Player.vk_id))).scalar() or 0,
+            SEED_VK_ID_START - 1,
+        ) + 1
+        vk_ids = list(range(first_vk_id, first_vk_id + players))
+        for chunk in _batches(vk_ids, batch):
+            conn.execute(insert(models.Player), [
+                {"vk_id": vk_id, "name": f"Игрок {vk_id}", "gold": rng.randint(100, 10000)}
+                for vk_id in chunk
+            ])
+
+        player_ids = [
+            row.id for row in conn.execute(
+                select(models.Player.id).where(models.Player.vk_id >= first_vk_id).order_by(models.Player.id)
+            )
+        ]
+
+        equipment = [{"player_id": pid, **crud.STARTER_EQUIPMENT} for pid in player_ids]
+        skins = [{"player_id": pid, **crud.STARTER_SKIN} for pid in player_ids]
+        inventory = []
+        for pid in player_ids:
+            for name, icon, item_type, rarity in rng.sample(ITEMS, min(items_per_player, len(ITEMS))):
+                inventory.append({
+                    "player_id": pid, "name": name, "icon": icon, "item_type": item_type,
+                    "rarity": rarity, "quantity": rng.randint(1, 200),
+                })
+
+        market = []
+        for _ in range(listings):
+            name, icon, _, rarity = rng.choice(ITEMS)
+            market.append({
+                "seller_id": rng.choice(player_ids), "item_name": name, "item_icon": icon,
+                "item_rarity": rarity, "price": rng.randint(1, 500), "quantity": rng.randint(1, 20),
+                "is_active": True,
+            })
+
+        for model, rows in (
+            (models.Equipment, equipment),
+            (models.OwnedSkin, skins),
+            (models.InventoryItem, inventory),
+            (models.MarketListing, market),
+        ):
+            for chunk in _batches(rows, batch):
+                conn.execute(insert(model), chunk)
+
+    return {"player_ids": player_ids, "vk_ids": vk_ids, "inventory": len(inventory), "listings": len(market)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--listings", type=int, default=2000)
+    parser.add_argument("--items-per-player", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    from app.database import engine
+
+    migrations.upgrade(engine)
+
+    started = time.perf_counter()
+    result = seed(engine, args.players, args.listings, args.items_per_player, rng=random.Random(args.seed))
+    print(
+        f"seeded {len(result['player_ids'])} players, {result['inventory']} inventory rows, "
+        f"{result['listings']} listings in {time.perf_counter() - started:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
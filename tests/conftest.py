@@ -0,0 +1,58 @@
+"""
+Тесты идут на временных файлах SQLite. Конфигурация app читается из окружения при
+импорте, поэтому окружение задаётся здесь, до импорта модулей app.
+
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+"""
+import itertools
+import os
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix="mmorpg-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'app.db')}"
+os.environ.pop("DATABASE_SHARD_URLS", None)
+os.environ.pop("DATABASE_REPLICA_URLS", None)
+os.environ.update({
+    "DEBUG": "true",
+    "DB_MODE": "threads",
+    # Лимиты игрока и контроль допуска мешают проверять поведение — выключены
+    "RATE_LIMIT_RPS": "0",
+    "ADMISSION_MAX_INFLIGHT": "0",
+})
+
+_vk_ids = itertools.count(50_000_000)
+
+
+@pytest.fixture(scope="session")
+def engine():
+    from app import migrations
+    from app.database import engine
+
+    migrations.upgrade(engine)
+    return engine
+
+
+@pytest.fixture
+def db(engine):
+    # Та же фабрика, что у AsyncDB в режиме threads
+    from app.database import ThreadSessionLocal
+
+    session = ThreadSessionLocal()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def vk_id() -> int:
+    return next(_vk_ids)
+
+
+@pytest.fixture
+def player(db, vk_id):
+    """Новый игрок со стартовым набором"""
+    from app import crud
+
+    return crud.create_player(db, vk_id)
@@ -0,0 +1,112 @@
+import asyncio
+
+import httpx
+
+from app.main import app
+from scripts.loadtest import vk_params
+
+
+def _request(vk_id: int, calls):
+    """Выполнить calls(client) от имени игрока vk_id через ASGI, без сети"""
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            client.headers["X-VK-Params"] = vk_params(vk_id)
+            return await calls(client)
+    return asyncio.run(main())
+
+
+def _version(etag: str) -> int:
+    # ETag вида "inv-<id игрока>-<версия>"
+    return int(etag.strip('"').rsplit("-", 1)[1])
+
+
+def test_inventory_etag_and_changes(engine, vk_id):
+    async def calls(client):
+        response = await client.get("/api/inventory")
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        stacks = {item["name"]: item for item in response.json()}
+
+        # Без изменений — 304, в том числе для ослабленного прокси ETag
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}'):
+            response = await client.get("/api/inventory", headers={"If-None-Match": if_none_match})
+            assert (response.status_code, response.headers["etag"]) == (304, etag)
+            assert response.content == b""
+        since = _version(etag)
+        response = await client.get("/api/inventory/changes", params={"since_version": since})
+        assert response.status_code == 304
+
+        # Одна стопка изменена, другая удалена целиком
+        potion, food = stacks["Зелье HP"], stacks["Еда"]
+        assert (await client.post(f"/api/inventory/use/{potion['id']}")).status_code == 200
+        response = await client.post(f"/api/inventory/remove/{food['id']}", json={"quantity": food["quantity"]})
+        assert response.status_code == 200
+
+        response = await client.get("/api/inventory", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert _version(response.headers["etag"]) == since + 2
+
+        response = await client.get("/api/inventory/changes", params={"since_version": since})
+        assert response.status_code == 200
+        changes = response.json()
+        assert (changes["version"], changes["full"]) == (since + 2, False)
+        assert [(item["id"], item["quantity"]) for item in changes["items"]] == [(potion["id"], potion["quantity"] - 1)]
+        assert changes["deleted"] == [food["id"]]
+
+        # Только последнее изменение
+        response = await client.get("/api/inventory/changes", params={"since_version": since + 1})
+        assert (response.json()["items"], response.json()["deleted"]) == ([], [food["id"]])
+
+        # Версия из будущего — клиенту отдаётся весь инвентарь
+        response = await client.get("/api/inventory/changes", params={"since_version": since + 100})
+        changes = response.json()
+        assert changes["full"] is True
+        assert {item["name"] for item in changes["items"]} == set(stacks) - {"Еда"}
+
+    _request(vk_id, calls)
+
+
+def test_inventory_batch_rejects_malformed_operations(engine, vk_id):
+    async def calls(client):
+        for payload, detail in (
+            ({"operations": "abc"}, "operations must be a list of objects"),
+            ({"operations": [1]}, "operations must be a list of objects"),
+            ({"operations": [{"op": "add", "name": "Камень", "icon": "🪨"}, {"op": "use", "quantity": "abc"}]},
+             {"index": 1, "error": "Invalid operation"}),
+            ({"operations": [{"item_id": 1}]}, {"index": 0, "error": "Invalid operation"}),
+        ):
+            response = await client.post("/api/inventory/batch", json=payload)
+            assert (response.status_code, response.json()["detail"]) == (400, detail)
+
+        response = await client.get("/api/inventory")
+        assert "Камень" not in {item["name"] for item in response.json()}
+
+    _request(vk_id, calls)
+
+
+def test_place_order_rejects_malformed_payload(engine, vk_id):
+    async def calls(client):
+        valid = {"side": "buy", "item_name": "Руда", "item_icon": "🪨", "price": 5, "quantity": 1}
+        for changes in ({"item_icon": None}, {"price": None}, {"price": "abc"}, {"quantity": [1]}, {"side": "hold"}):
+            response = await client.post("/api/market/orders", json={**valid, **changes})
+            assert (response.status_code, response.json()["detail"]) == (400, "Invalid order")
+
+    _request(vk_id, calls)
+
+
+def test_buy_listings_rejects_malformed_ids(engine, vk_id):
+    async def calls(client):
+        for listing_ids, detail in (
+            ([True], "listing_ids must be a list of ids"),
+            ([1, "2"], "listing_ids must be a list of ids"),
+            ("1", "listing_ids must be a list of ids"),
+            (None, "listing_ids must be a list of ids"),
+            ([], "No listings"),
+            ([1, 1], "Duplicate listings"),
+        ):
+            response = await client.post("/api/market/buy", json={"listing_ids": listing_ids})
+            assert (response.status_code, response.json()["detail"]) == (400, detail)
+
+    _request(vk_id, calls)
@@ -0,0 +1,143 @@
+import threading
+
+import pytest
+from sqlalchemy import select
+
+from app import crud, inventory_sync, models
+from app.database import ThreadSessionLocal
+from app.schemas import InventoryOperation
+
+
+def _stacks(db, player_id: int) -> dict:
+    db.rollback()
+    return {item.name: item for item in crud.get_inventory(db, player_id)}
+
+
+def _add(name: str, quantity: int = 1) -> InventoryOperation:
+    return InventoryOperation(op="add", name=name, icon="🪨", quantity=quantity)
+
+
+def test_batch_applies_all_operations_with_one_version(db, player):
+    stacks = _stacks(db, player.id)
+    version_before = inventory_sync.current_version(db, player.id)[0]
+
+    result = crud.apply_inventory_batch(db, player.id, [
+        _add("Камень", 3),
+        InventoryOperation(op="use", item_id=stacks["Зелье HP"].id),
+        InventoryOperation(op="remove", item_id=stacks["Дерево"].id, quantity=5),
+        _add("Камень", 2),
+    ])
+
+    assert {row["name"]: row["quantity"] for row in result} == {"Камень": 5, "Зелье HP": 4, "Дерево": 15}
+    stacks = _stacks(db, player.id)
+    assert (stacks["Камень"].quantity, stacks["Зелье HP"].quantity, stacks["Дерево"].quantity) == (5, 4, 15)
+    # Весь пакет — одна версия инвентаря, ею помечены все затронутые стопки
+    version = inventory_sync.current_version(db, player.id)[0]
+    assert version == version_before + 1
+    assert {stacks[name].version for name in ("Камень", "Зелье HP", "Дерево")} == {version}
+    assert stacks["Еда"].version < version
+
+
+def test_invalid_operation_rolls_back_whole_batch(db, player):
+    stacks = _stacks(db, player.id)
+    version_before = inventory_sync.current_version(db, player.id)[0]
+
+    with pytest.raises(crud.InventoryBatchError) as error:
+        crud.apply_inventory_batch(db, player.id, [
+            _add("Камень", 3),
+            InventoryOperation(op="use", item_id=stacks["Еда"].id),
+            InventoryOperation(op="remove", item_id=999_999_999),
+        ])
+
+    assert (error.value.index, error.value.detail) == (2, "Item not found")
+    after = _stacks(db, player.id)
+    assert "Камень" not in after
+    assert after["Еда"].quantity == stacks["Еда"].quantity
+    assert inventory_sync.current_version(db, player.id)[0] == version_before
+
+
+@pytest.mark.parametrize("operation, detail", [
+    (InventoryOperation(op="add", name="Камень", icon="🪨", quantity=0), "Invalid quantity"),
+    (InventoryOperation(op="add", name="Камень"), "Item name and icon required"),
+    (InventoryOperation(op="sell", item_id=1), "Unknown operation"),
+])
+def test_operation_validation(db, player, operation, detail):
+    with pytest.raises(crud.InventoryBatchError) as error:
+        crud.apply_inventory_batch(db, player.id, [_add("Камень"), operation])
+    assert (error.value.index, error.value.detail) == (1, detail)
+
+
+def test_emptied_stack_is_deleted_at_the_end_of_batch(db, player):
+    wood = _stacks(db, player.id)["Дерево"]
+
+    result = crud.apply_inventory_batch(db, player.id, [
+        InventoryOperation(op="remove", item_id=wood.id, quantity=100),
+    ])
+
+    assert result == [{"item_id": wood.id, "name": "Дерево", "quantity": 0}]
+    assert "Дерево" not in _stacks(db, player.id)
+    version = inventory_sync.current_version(db, player.id)[0]
+    assert inventory_sync.get_changes(db, player.id, version - 1)[1] == [wood.id]
+
+
+def test_stack_emptied_earlier_in_batch_can_be_refilled(db, player):
+    wood = _stacks(db, player.id)["Дерево"]
+
+    result = crud.apply_inventory_batch(db, player.id, [
+        InventoryOperation(op="remove", item_id=wood.id, quantity=20),
+        _add("Дерево", 4),
+    ])
+
+    # Та же стопка, не удалённая и созданная заново
+    assert result == [{"item_id": wood.id, "name": "Дерево", "quantity": 4}]
+    assert _stacks(db, player.id)["Дерево"].id == wood.id
+
+
+def test_use_of_stack_emptied_earlier_in_batch_fails(db, player):
+    potion = _stacks(db, player.id)["Зелье HP"]
+
+    with pytest.raises(crud.InventoryBatchError) as error:
+        crud.apply_inventory_batch(db, player.id, [
+            InventoryOperation(op="remove", item_id=potion.id, quantity=5),
+            InventoryOperation(op="use", item_id=potion.id),
+        ])
+
+    assert (error.value.index, error.value.detail) == (1, "Item not found")
+    assert _stacks(db, player.id)["Зелье HP"].quantity == 5
+
+
+def test_concurrent_batches_do_not_lose_updates(player):
+    """Параллельные пакеты и одиночные добавления одной новой стопки: ни ошибок, ни потерь"""
+    threads, rounds = 6, 10
+    errors = []
+
+    def work(index: int):
+        db = ThreadSessionLocal()
+        try:
+            for _ in range(rounds):
+                if index % 2:
+                    crud.apply_inventory_batch(db, player.id, [_add("Кристалл"), _add("Кристалл")])
+                else:
+                    crud.add_inventory_item(db, player.id, crud.schemas.InventoryItemCreate(
+                        name="Кристалл", icon="💎", quantity=2
+                    ))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            db.close()
+
+    workers = [threading.Thread(target=work, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert errors == []
+    db = ThreadSessionLocal()
+    try:
+        quantity = db.scalar(select(models.InventoryItem.quantity).where(
+            models.InventoryItem.player_id == player.id, models.InventoryItem.name == "Кристалл"
+        ))
+    finally:
+        db.close()
+    assert quantity == threads * rounds * 2
@@ -0,0 +1,61 @@
+import logging
+import uuid
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, select
+
+from app import models
+from app.ledger import LedgerWriter
+
+
+def _events(count: int, reason: str) -> list:
+    return [(datetime.utcnow(), 1, "currency", "gold", 1, None, reason) for _ in range(count)]
+
+
+def _written(db, reason: str) -> int:
+    db.rollback()
+    return db.scalar(select(func.count()).where(models.LedgerEntry.reason == reason))
+
+
+def test_full_queue_waits_for_writer(engine, db):
+    reason = uuid.uuid4().hex
+    writer = LedgerWriter(engine, flush_size=100, flush_interval=3600, max_pending=5, emit_timeout=5)
+    try:
+        writer.emit(_events(5, reason))
+        # Места нет — emit ждёт, пока поток сбросит очередь
+        writer.emit(_events(3, reason))
+    finally:
+        writer.stop()
+
+    assert (writer.written, writer.spilled, writer.dropped) == (8, 0, 0)
+    assert _written(db, reason) == 8
+
+
+def test_full_queue_spills_to_direct_write(engine, db, monkeypatch):
+    reason = uuid.uuid4().hex
+    # Короткий интервал: поток, не сумевший сбросить очередь, спит его целиком
+    writer = LedgerWriter(engine, flush_size=100, flush_interval=0.05, max_pending=5, emit_timeout=0.05)
+    # Поток записи не успевает: очередь не разгружается
+    monkeypatch.setattr(writer, "flush", lambda: 0)
+    try:
+        writer.emit(_events(5, reason))
+        writer.emit(_events(3, reason))
+        assert (writer.pending(), writer.spilled, writer.dropped) == (5, 3, 0)
+        assert _written(db, reason) == 3
+    finally:
+        monkeypatch.undo()
+        writer.stop()
+
+    assert _written(db, reason) == 8
+
+
+def test_failed_direct_write_is_counted_and_logged(tmp_path, caplog):
+    broken = create_engine(f"sqlite:///{tmp_path / 'missing' / 'ledger.db'}")
+    writer = LedgerWriter(broken, flush_size=100, flush_interval=3600, max_pending=0, emit_timeout=0)
+    writer._thread = object()  # поток записи не запускаем
+
+    with caplog.at_level(logging.ERROR, logger="app.ledger"):
+        writer.emit(_events(2, "lost"))
+
+    assert writer.dropped == 2
+    assert "2 events lost" in caplog.text
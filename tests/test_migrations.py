@@ -0,0 +1,93 @@
+import shutil
+from pathlib import Path
+
+from sqlalchemy import create_engine, inspect
+
+from app import migrations, models
+
+# БД из репозитория — схема до версионированных миграций, без schema_version
+BUNDLED_DB = Path(__file__).resolve().parents[1] / "mmorpg_game.db"
+
+
+def _bundled_copy(tmp_path) -> str:
+    path = tmp_path / "bundled.db"
+    shutil.copyfile(BUNDLED_DB, path)
+    return f"sqlite:///{path}"
+
+
+def _schema(engine) -> dict:
+    """Схема БД в сравнимом виде: колонки, ключи, индексы и ограничения каждой таблицы"""
+    schema = inspect(engine)
+    result = {}
+    for table in schema.get_table_names():
+        if table == migrations.schema_version.name:
+            continue
+        result[table] = {
+            "columns": {
+                column["name"]: (
+                    str(column["type"]), column["nullable"],
+                    # DEFAULT 0 после ALTER TABLE и DEFAULT '0' из create_all — одно и то же
+                    (column["default"] or "").strip("()'\""),
+                )
+                for column in schema.get_columns(table)
+            },
+            "primary_key": schema.get_pk_constraint(table)["constrained_columns"],
+            "indexes": {
+                index["name"]: (tuple(index["column_names"]), bool(index["unique"]))
+                for index in schema.get_indexes(table)
+            },
+            "unique": sorted(tuple(unique["column_names"]) for unique in schema.get_unique_constraints(table)),
+            "foreign_keys": sorted(
+                (tuple(key["constrained_columns"]), key["referred_table"])
+                for key in schema.get_foreign_keys(table)
+            ),
+        }
+    return result
+
+
+def _without_market_player_keys(schema: dict) -> dict:
+    # Миграция 8 на SQLite ключи биржи на players не снимает (см. app/migrations.py)
+    for table in ("market_listings", "market_orders", "market_trades"):
+        keys = schema[table]["foreign_keys"]
+        schema[table]["foreign_keys"] = [key for key in keys if key[1] != "players"]
+    return schema
+
+
+def test_upgrade_bundled_database_to_head(tmp_path):
+    engine = create_engine(_bundled_copy(tmp_path))
+    try:
+        assert migrations.upgrade(engine) == migrations.LATEST_VERSION
+        assert migrations.check(engine) == migrations.LATEST_VERSION
+
+        schema = inspect(engine)
+        assert "version" in {column["name"] for column in schema.get_columns("inventory_items")}
+        indexes = {index["name"] for index in schema.get_indexes("inventory_items")}
+        assert {"uq_inventory_items_player_name", "ix_inventory_items_player_version"} <= indexes
+    finally:
+        engine.dispose()
+
+
+def test_upgrade_is_idempotent(tmp_path):
+    engine = create_engine(_bundled_copy(tmp_path))
+    try:
+        migrations.upgrade(engine)
+        assert migrations.upgrade(engine) == migrations.LATEST_VERSION
+    finally:
+        engine.dispose()
+
+
+def test_migrations_reproduce_models(tmp_path):
+    """Новая БД и БД из репозитория после миграций совпадают со схемой моделей"""
+    reference = create_engine(f"sqlite:///{tmp_path / 'models.db'}")
+    fresh = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    bundled = create_engine(_bundled_copy(tmp_path))
+    try:
+        models.Base.metadata.create_all(bind=reference)
+        migrations.upgrade(fresh)
+        migrations.upgrade(bundled)
+        expected = _schema(reference)
+        assert _without_market_player_keys(_schema(fresh)) == expected
+        assert _without_market_player_keys(_schema(bundled)) == expected
+    finally:
+        for engine in (reference, fresh, bundled):
+            engine.dispose()
@@ -0,0 +1,164 @@
+import asyncio
+
+from sqlalchemy import func, select
+
+from app import crud, models, schemas
+from app.database import AsyncDB
+from app.orderbook import BookOrder, MatchingEngine, OrderBook
+
+
+def _run(fn, *args):
+    """Выполнить async fn(db, *args) с сессией, как в обработчике запроса"""
+    async def main():
+        db = AsyncDB()
+        try:
+            return await fn(db, *args)
+        finally:
+            await db.close()
+    return asyncio.run(main())
+
+
+def _order(side: str, item_name: str, price: int, quantity: int) -> schemas.MarketOrderCreate:
+    return schemas.MarketOrderCreate(side=side, item_name=item_name, item_icon="🪨", price=price, quantity=quantity)
+
+
+def _seller(db, vk_id: int, item_name: str, quantity: int):
+    seller = crud.create_player(db, vk_id)
+    crud.add_inventory_item(db, seller.id, schemas.InventoryItemCreate(name=item_name, icon="🪨", quantity=quantity))
+    return seller
+
+
+def test_book_sees_changes_made_by_another_worker(db, player, vk_id):
+    """Стакан одного воркера видит заявки, сделки и отмены, сделанные через другой"""
+    item_name = f"Руда {vk_id}"
+    seller = _seller(db, vk_id + 1_000_000, item_name, 10)
+    serving, other = MatchingEngine(), MatchingEngine()
+
+    assert _run(serving.top_of_book, item_name)["asks"] == []
+
+    order, _ = _run(other.place, seller.id, _order("sell", item_name, 7, 10))
+    assert _run(serving.top_of_book, item_name)["asks"] == [{"price": 7, "quantity": 10}]
+
+    _run(other.place, player.id, _order("buy", item_name, 7, 4))
+    book = _run(serving.top_of_book, item_name)
+    assert (book["best_ask"], book["asks"]) == (7, [{"price": 7, "quantity": 6}])
+
+    _run(other.cancel, seller.id, order.id)
+    book = _run(serving.top_of_book, item_name)
+    assert (book["best_ask"], book["asks"], book["bids"]) == (None, [], [])
+
+
+def test_book_reloads_only_after_foreign_changes(db, player, vk_id, monkeypatch):
+    item_name = f"Руда {vk_id}"
+    seller = _seller(db, vk_id + 1_000_000, item_name, 10)
+    serving, other = MatchingEngine(), MatchingEngine()
+    _run(serving.place, seller.id, _order("sell", item_name, 7, 2))
+
+    reloads = []
+    get_market_book = crud.get_market_book
+    monkeypatch.setattr(crud, "get_market_book", lambda *args: reloads.append(args) or get_market_book(*args))
+
+    # Свои заявки и опрос без чужих изменений — только сверка версии
+    _run(serving.place, seller.id, _order("sell", item_name, 8, 1))
+    for _ in range(3):
+        _run(serving.top_of_book, item_name)
+    assert reloads == []
+
+    _run(other.place, seller.id, _order("sell", item_name, 6, 1))
+    book = _run(serving.top_of_book, item_name)
+    assert len(reloads) == 1
+    assert book["asks"] == [{"price": 6, "quantity": 1}, {"price": 7, "quantity": 2}, {"price": 8, "quantity": 1}]
+    _run(serving.top_of_book, item_name)
+    assert len(reloads) == 1
+
+
+def test_depth_levels_follow_fills_and_removals():
+    book = OrderBook("Руда")
+    for order_id, price, quantity in ((1, 5, 2), (2, 5, 3), (3, 4, 1), (4, 6, 1)):
+        book.add(BookOrder(order_id, 1, "sell", price, quantity))
+
+    book.fill(3, 1)
+    book.fill(1, 1)
+    book.remove(4)
+    assert book.depth("sell", 5) == [{"price": 5, "quantity": 4}]
+    book.remove(2)
+    book.fill(1, 5)
+    assert book.depth("sell", 5) == []
+    assert book.best("sell") is None
+
+
+# Читаем колонки, а не объекты: объекты из карты сессии могут быть устаревшими
+def _gold(db, player_id: int) -> int:
+    db.rollback()
+    return db.scalar(select(models.Player.gold).where(models.Player.id == player_id))
+
+
+def _quantity(db, player_id: int, item_name: str) -> int:
+    db.rollback()
+    return db.scalar(select(func.coalesce(func.sum(models.InventoryItem.quantity), 0)).where(
+        models.InventoryItem.player_id == player_id, models.InventoryItem.name == item_name
+    ))
+
+
+def test_matching_by_price_then_time(db, player, vk_id):
+    item_name = f"Руда {vk_id}"
+    cheap, first, second = (_seller(db, vk_id + offset * 1_000_000, item_name, 5) for offset in (1, 2, 3))
+    engine = MatchingEngine()
+
+    _run(engine.place, first.id, _order("sell", item_name, 5, 2))
+    _run(engine.place, second.id, _order("sell", item_name, 5, 2))
+    cheap_order, _ = _run(engine.place, cheap.id, _order("sell", item_name, 4, 1))
+    first_order, second_order = (
+        order for order in crud.get_open_market_orders(db, item_name) if order.id != cheap_order.id
+    )
+
+    order, trades = _run(engine.place, player.id, _order("buy", item_name, 5, 4))
+
+    # Сначала лучшая цена, на одной цене — кто раньше встал
+    assert trades == [
+        {"order_id": cheap_order.id, "price": 4, "quantity": 1},
+        {"order_id": first_order.id, "price": 5, "quantity": 2},
+        {"order_id": second_order.id, "price": 5, "quantity": 1},
+    ]
+    assert (order.status, order.remaining) == ("filled", 0)
+    # Сделка по цене встречной заявки: переплата за дешёвую возвращается
+    assert _gold(db, player.id) == 100 - 4 * 5 + 1
+    assert _quantity(db, player.id, item_name) == 4
+    assert _gold(db, cheap.id) == 100 + int(4 * crud.MARKET_FEE_KEEP)
+    assert _gold(db, first.id) == 100 + int(10 * crud.MARKET_FEE_KEEP)
+    assert _run(engine.top_of_book, item_name)["asks"] == [{"price": 5, "quantity": 1}]
+
+
+def test_partial_fill_leaves_rest_in_book(db, player, vk_id):
+    item_name = f"Руда {vk_id}"
+    seller = _seller(db, vk_id + 1_000_000, item_name, 5)
+    engine = MatchingEngine()
+
+    sell_order, _ = _run(engine.place, seller.id, _order("sell", item_name, 6, 1))
+    order, trades = _run(engine.place, player.id, _order("buy", item_name, 7, 3))
+
+    assert trades == [{"order_id": sell_order.id, "price": 6, "quantity": 1}]
+    assert (order.status, order.remaining) == ("open", 2)
+    book = _run(engine.top_of_book, item_name)
+    assert (book["best_bid"], book["bids"], book["asks"]) == (7, [{"price": 7, "quantity": 2}], [])
+
+    # Отмена возвращает резерв за неисполненный остаток
+    assert _run(engine.cancel, player.id, order.id) is not None
+    assert _gold(db, player.id) == 100 - 6
+    assert _run(engine.top_of_book, item_name)["bids"] == []
+
+
+def test_no_trade_without_crossing_or_with_self(db, player, vk_id):
+    item_name = f"Руда {vk_id}"
+    seller = _seller(db, vk_id + 1_000_000, item_name, 5)
+    engine = MatchingEngine()
+
+    _run(engine.place, seller.id, _order("sell", item_name, 8, 2))
+    order, trades = _run(engine.place, player.id, _order("buy", item_name, 7, 1))
+    assert (order.status, trades) == ("open", [])
+
+    # Свою заявку продавец не исполняет, даже если цены пересекаются
+    order, trades = _run(engine.place, seller.id, _order("buy", item_name, 9, 1))
+    assert (order.status, trades) == ("open", [])
+    book = _run(engine.top_of_book, item_name)
+    assert (book["best_bid"], book["best_ask"]) == (9, 8)
@@ -0,0 +1,193 @@
+import asyncio
+import itertools
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app import crud, migrations, models, schemas, shard_market, shards
+from app.database import AsyncDB
+
+# Свой диапазон vk_id: игроки шардов попадают и в справочник глобальной БД
+_vk_ids = itertools.count(60_000_000)
+
+
+class _Crash(BaseException):
+    """Падение процесса посреди переноса: except Exception в move_player его не ловит"""
+
+
+@pytest.fixture
+def router(engine, tmp_path, monkeypatch):
+    """Два шарда на отдельных файлах SQLite; глобальная БД — общая тестовая"""
+    router = shards.ShardRouter([f"sqlite:///{tmp_path / f'shard{index}.db'}" for index in range(2)])
+    for bind in router.engines():
+        migrations.upgrade(bind)
+    monkeypatch.setattr(shard_market, "shard_router", router)
+    yield router
+    asyncio.run(router.dispose())
+
+
+def _register(engine, router, shard: int) -> int:
+    """Игрок на шарде: запись справочника и стартовый набор"""
+    vk_id = next(_vk_ids)
+    with Session(engine) as g:
+        entry = shards.register_player(g, vk_id, shard)
+    with router.shards[shard].sessions() as db:
+        crud.create_player(db, vk_id, player_id=entry.id)
+    return entry.id
+
+
+def _give(router, shard: int, player_id: int, name: str, quantity: int):
+    with router.shards[shard].sessions() as db:
+        crud.add_inventory_item(db, player_id, schemas.InventoryItemCreate(name=name, icon="🦊", quantity=quantity))
+
+
+def _gold(router, shard: int, player_id: int) -> int:
+    with router.shards[shard].sessions() as db:
+        return db.scalar(select(models.Player.gold).where(models.Player.id == player_id))
+
+
+def _items(router, shard: int, player_id: int) -> dict:
+    with router.shards[shard].sessions() as db:
+        return {item.name: item.quantity for item in crud.get_inventory(db, player_id)}
+
+
+def _directory(engine, player_id: int) -> tuple:
+    with Session(engine) as g:
+        entry = g.get(models.PlayerDirectory, player_id)
+        return entry.shard, entry.moving_to
+
+
+def _crash_after_commit(monkeypatch, shard: shards.Shard):
+    """Сессии шарда падают сразу после commit: изменения записаны, следующий шаг не выполнен"""
+    sessions = shard.sessions
+
+    def crashing():
+        session = sessions()
+        commit = session.commit
+
+        def commit_and_crash():
+            commit()
+            raise _Crash()
+
+        session.commit = commit_and_crash
+        return session
+
+    monkeypatch.setattr(shard, "sessions", crashing)
+
+
+def test_message_delivered_twice_applies_once(engine, router):
+    player_id = _register(engine, router, 1)
+    with Session(engine) as g:
+        message = shards.send(g, 1, "credit", {"player_id": player_id, "gold": 50, "items": [], "reason": "test"})
+        g.commit()
+
+    asyncio.run(router.deliver(shards.GLOBAL, message))
+    asyncio.run(router.deliver(shards.GLOBAL, message))
+    with router.shards[1].sessions() as db:
+        assert shards.apply_message(db, message) is None
+        assert db.scalar(select(func.count()).where(models.ShardInbox.id == message["id"])) == 1
+
+    assert _gold(router, 1, player_id) == 150
+    with Session(engine) as g:
+        assert g.get(models.ShardMessage, message["id"]) is None
+
+
+def test_move_interrupted_before_source_delete_is_rolled_back(engine, router, monkeypatch):
+    player_id = _register(engine, router, 0)
+    _give(router, 0, player_id, "Шкура", 3)
+
+    with monkeypatch.context() as patch:
+        # Копия на цели записана, источник не тронут
+        _crash_after_commit(patch, router.shards[1])
+        with pytest.raises(_Crash):
+            shards.move_player(router, player_id, 1)
+    assert _directory(engine, player_id) == (0, 1)
+    assert _items(router, 1, player_id)["Шкура"] == 3
+
+    assert shards.repair(router) == {"finished": 0, "rolled_back": 1, "lost": 0}
+    assert _directory(engine, player_id) == (0, None)
+    assert _items(router, 0, player_id)["Шкура"] == 3
+    assert _items(router, 1, player_id) == {}
+
+
+def test_move_interrupted_after_source_delete_is_finished(engine, router, monkeypatch):
+    player_id = _register(engine, router, 0)
+    _give(router, 0, player_id, "Шкура", 3)
+
+    with monkeypatch.context() as patch:
+        # Источник уже удалил игрока, справочник не обновлён
+        _crash_after_commit(patch, router.shards[0])
+        with pytest.raises(_Crash):
+            shards.move_player(router, player_id, 1)
+    assert _directory(engine, player_id) == (0, 1)
+    # Устаревший маршрут ведёт на источник — забор не пускает туда записи
+    with router.shards[0].sessions() as db:
+        with pytest.raises(shards.PlayerMoved):
+            shards.fence(db, player_id)
+
+    assert shards.repair(router) == {"finished": 1, "rolled_back": 0, "lost": 0}
+    assert _directory(engine, player_id) == (1, None)
+    assert _items(router, 1, player_id)["Шкура"] == 3
+    assert _items(router, 0, player_id) == {}
+
+
+def test_fence_rejects_write_when_player_moved_meanwhile(engine, router):
+    player_id = _register(engine, router, 0)
+
+    db = router.shards[0].sessions()
+    try:
+        shards.fence(db, player_id)
+        # Перенос проходит между проверкой забора и commit записи
+        shards.move_player(router, player_id, 1)
+        with pytest.raises(shards.PlayerMoved):
+            crud.add_inventory_item(db, player_id, schemas.InventoryItemCreate(name="Шкура", icon="🦊", quantity=1))
+        db.rollback()
+    finally:
+        db.close()
+
+    assert _items(router, 0, player_id) == {}
+    assert "Шкура" not in _items(router, 1, player_id)
+    assert _directory(engine, player_id) == (1, None)
+
+
+def test_sharded_market_sell_buy_and_orders(engine, router):
+    seller = _register(engine, router, 0)
+    buyer = _register(engine, router, 1)
+    item_name = f"Шкура {seller}"
+    _give(router, 0, seller, item_name, 10)
+
+    # Лот: предметы списаны на шарде продавца, золото — на шарде покупателя
+    listing = schemas.MarketListingCreate(item_name=item_name, item_icon="🦊", price=10, quantity=3)
+    created, listing_id = asyncio.run(shard_market.sell(seller, 0, listing))
+    assert created and listing_id is not None
+    assert _items(router, 0, seller)[item_name] == 7
+
+    [result] = asyncio.run(shard_market.buy_listings(buyer, 1, [listing_id]))
+    assert (result["status"], result["quantity"]) == ("bought", 3)
+    assert _gold(router, 1, buyer) == 100 - 30
+    assert _items(router, 1, buyer)[item_name] == 3
+    assert _gold(router, 0, seller) == 100 + int(30 * crud.MARKET_FEE_KEEP)
+
+    # Заявки: продажа с шарда 0 частично исполняется покупкой с шарда 1, остаток отменяется
+    def order(side: str, price: int, quantity: int) -> schemas.MarketOrderCreate:
+        return schemas.MarketOrderCreate(side=side, item_name=item_name, item_icon="🦊", price=price, quantity=quantity)
+
+    sell_order, trades = asyncio.run(shard_market.place_order(AsyncDB(), seller, 0, order("sell", 5, 4)))
+    assert (sell_order.status, trades) == ("open", [])
+    assert _items(router, 0, seller)[item_name] == 3
+
+    buy_order, trades = asyncio.run(shard_market.place_order(AsyncDB(), buyer, 1, order("buy", 6, 1)))
+    assert (buy_order.status, trades) == ("filled", [{"order_id": sell_order.id, "price": 5, "quantity": 1}])
+    # Резерв по 6, сделка по 5 — разница возвращена
+    assert _gold(router, 1, buyer) == 70 - 5
+    assert _items(router, 1, buyer)[item_name] == 4
+    assert _gold(router, 0, seller) == 100 + int(30 * crud.MARKET_FEE_KEEP) + int(5 * crud.MARKET_FEE_KEEP)
+
+    assert asyncio.run(shard_market.cancel_order(AsyncDB(), seller, sell_order.id)) is not None
+    assert _items(router, 0, seller)[item_name] == 6
+
+    # Всё доставлено в запросах — досылать нечего
+    for shard in router.shards:
+        with shard.sessions() as db:
+            assert db.scalar(select(func.count()).select_from(models.ShardMessage)) == 0